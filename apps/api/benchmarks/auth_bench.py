@@ -0,0 +1,104 @@
+"""
+Firebase ID トークン検証のマイクロベンチマーク
+
+ローカルで生成した RSA 鍵で Firebase 形式の ID トークンに署名し、
+verify_firebase_token 依存関数の1リクエストあたりのコストを
+キャッシュなし（毎回署名検証）とキャッシュありで比較します。
+ネットワークには接続しません。
+
+実行例:
+    uv run python -m benchmarks.auth_bench --requests 20000 --users 200 --concurrency 100
+"""
+
+import argparse
+import asyncio
+import datetime
+import time
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt, jwt
+
+from src import firebase_auth
+
+PROJECT_ID = "enikki-bench"
+KEY_ID = "bench-key"
+
+
+def _make_signer_and_certs():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "bench")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(1)
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, algorithm=hashes.SHA256())
+    )
+    signer = crypt.RSASigner.from_string(pem, key_id=KEY_ID)
+    certs = {KEY_ID: cert.public_bytes(serialization.Encoding.PEM)}
+    return signer, certs
+
+
+def _make_token(signer, uid: str) -> str:
+    now = int(time.time())
+    payload = {
+        "iss": f"https://securetoken.google.com/{PROJECT_ID}",
+        "aud": PROJECT_ID,
+        "auth_time": now,
+        "iat": now,
+        "exp": now + 3600,
+        "sub": uid,
+        "uid": uid,
+    }
+    return jwt.encode(signer, payload).decode("utf-8")
+
+
+async def _run(tokens: list[str], requests: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            await firebase_auth.verify_firebase_token(tokens[i % len(tokens)])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=200, help="異なるトークンの数")
+    parser.add_argument("--concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    signer, certs = _make_signer_and_certs()
+    tokens = [_make_token(signer, f"user-{i}") for i in range(args.users)]
+
+    # firebase_admin の代わりにローカル証明書で同等の RS256 検証を行う
+    firebase_auth.verify_id_token = lambda token: jwt.decode(token, certs=certs, audience=PROJECT_ID)
+
+    results = {}
+    for label, cache_size in (("before (no cache)", 0), ("after (cached)", firebase_auth.FIREBASE_TOKEN_CACHE_SIZE)):
+        firebase_auth.token_cache = firebase_auth.VerifiedTokenCache(max_size=cache_size)
+        elapsed = asyncio.run(_run(tokens, args.requests, args.concurrency))
+        results[label] = elapsed
+
+    print(f"requests={args.requests} users={args.users} concurrency={args.concurrency}")
+    for label, elapsed in results.items():
+        per_request_us = elapsed / args.requests * 1e6
+        print(f"{label:>18}: {args.requests / elapsed:10.0f} req/s  {per_request_us:8.1f} us/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+絵日記生成のエンドツーエンドベンチマーク（オフライン）
+
+Vertex AI・Cloud Storage・Firestore・Discord Webhook をレイテンシ設定付きのローカルフェイク
+（benchmarks/fakes.py）に差し替え、fixtures の会話ログで POST /diaries を目標 RPS で叩きます。
+リクエストはアプリにインプロセス（ASGI）で送り、ジョブキュー・ワーカープール・ワークフロー・
+write-behind 書き込みは本番と同じコードを通ります。ネットワークには接続しません。
+
+出力:
+- スループット（完了した絵日記数 / 秒）
+- POST /diaries の応答時間と、投稿から completed / failed までの時間の p50 / p95 / p99
+- ノードごとの実行時間（日記ドキュメントに保存される usage から集計）
+- --image-cache on / shadow のとき、似た場面の画像のキャッシュのヒット率と節約できた画像生成の時間
+
+--max-p95 / --min-throughput を指定すると、下回った場合に終了コード 1 を返します（性能の回帰検知用）。
+
+実行例:
+    uv run python -m benchmarks.diary_bench --diaries 200 --rps 10 --workers 16
+    uv run python -m benchmarks.diary_bench --llm-ms 50 --image-ms 200 --json /tmp/bench.json --max-p95 5
+    uv run python -m benchmarks.diary_bench --image-cache on --scene-variety 6 --users 2
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+DEFAULT_FIXTURES = Path(__file__).resolve().parent.parent / "fixtures" / "sample_conversation_logs.json"
+WEBHOOK_URL = "https://discord.com/api/webhooks/0/bench"
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def summarize(values: list[float]) -> dict[str, float]:
+    return {
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else float("nan"),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--diaries", type=int, default=100, help="投稿する絵日記の数")
+    parser.add_argument("--rps", type=float, default=5.0, help="目標投稿レート（開ループ）")
+    parser.add_argument("--users", type=int, default=10, help="投稿するユーザー数")
+    parser.add_argument("--workers", type=int, default=None, help="JOB_QUEUE_WORKERS（未指定なら環境変数）")
+    parser.add_argument("--fixtures", default=str(DEFAULT_FIXTURES))
+    parser.add_argument("--timeout", type=float, default=600.0, help="1件の完了を待つ最大秒数")
+    parser.add_argument("--llm-ms", type=float, default=800.0, help="テキスト生成1回の中央値レイテンシ")
+    parser.add_argument("--image-ms", type=float, default=6000.0, help="画像生成1回の中央値レイテンシ")
+    parser.add_argument("--storage-ms", type=float, default=60.0, help="GCS アップロード1回の中央値レイテンシ")
+    parser.add_argument("--firestore-ms", type=float, default=20.0, help="Firestore 読み書き1回の中央値レイテンシ")
+    parser.add_argument("--discord-ms", type=float, default=150.0, help="Discord Webhook 1回の中央値レイテンシ")
+    parser.add_argument("--sigma", type=float, default=0.3, help="レイテンシのばらつき（対数正規分布の sigma）")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Vertex AI 呼び出しが 429 になる確率")
+    parser.add_argument(
+        "--low-quality-rate", type=float, default=0.0, help="LLM の品質チェックが不合格になる確率（LLM に回った下書きのみ）"
+    )
+    parser.add_argument("--prescore", default="on", help="QUALITY_PRESCORE（off にすると毎回 LLM で品質チェック）")
+    parser.add_argument(
+        "--image-cache", default="off", help="IMAGE_SEMANTIC_CACHE（on / shadow で似た場面の画像を再利用・計測する）"
+    )
+    parser.add_argument("--scene-variety", type=int, default=0, help="英訳の場面の種類（0 なら毎回別の場面）")
+    parser.add_argument("--no-discord", action="store_true", help="Discord Webhook URL を付けずに投稿する")
+    parser.add_argument("--llm-cache", default="off", help="LLM_CACHE_BACKEND（既定は off）")
+    parser.add_argument("--json", help="結果を JSON で書き出すパス")
+    parser.add_argument("--max-p95", type=float, help="エンドツーエンド p95（秒）の上限")
+    parser.add_argument("--min-throughput", type=float, help="スループット（件/秒）の下限")
+    parser.add_argument("--verbose", action="store_true", help="アプリのログを表示する")
+    return parser.parse_args()
+
+
+def setup(args: argparse.Namespace):
+    """環境変数とフェイクを設定してからアプリを import する"""
+    os.environ["LLM_CACHE_BACKEND"] = args.llm_cache
+    os.environ["QUALITY_PRESCORE"] = args.prescore
+    os.environ["IMAGE_SEMANTIC_CACHE"] = args.image_cache
+    # 前回の実行のインデックスを使わない
+    os.environ.setdefault("IMAGE_SEMANTIC_CACHE_DIR", tempfile.mkdtemp(prefix="enikki-bench-image-index-"))
+    os.environ.setdefault("JOB_QUEUE_BACKEND", "memory")
+    os.environ.setdefault("JOB_QUEUE_MAX_DEPTH", str(max(args.diaries, 200)))
+    # フェイクの Firestore はクエリに対応しないので回収スイープは止める。チェックポイントはプロセス内に置く
+    os.environ.setdefault("DIARY_RECOVERY_ENABLED", "false")
+    os.environ.setdefault("DIARY_CHECKPOINTER", "memory")
+    if args.workers is not None:
+        os.environ["JOB_QUEUE_WORKERS"] = str(args.workers)
+
+    from benchmarks import fakes
+
+    sigma = args.sigma
+    config = fakes.FakeConfig(
+        llm=fakes.Latency(args.llm_ms, sigma),
+        image=fakes.Latency(args.image_ms, sigma),
+        storage=fakes.Latency(args.storage_ms, sigma),
+        firestore=fakes.Latency(args.firestore_ms, sigma),
+        discord=fakes.Latency(args.discord_ms, sigma),
+        throttle_rate=args.throttle_rate,
+        low_quality_rate=args.low_quality_rate,
+        scene_variety=args.scene_variety,
+    )
+    image_regions = [r.strip() for r in os.getenv("IMAGE_REGIONS", "us-central1").split(",") if r.strip()]
+    store = fakes.install(config, image_regions)
+
+    from fastapi import Header
+
+    from src import main
+    from src.firebase_auth import verify_firebase_token
+
+    # X-Firebase-Token をそのまま uid として扱う
+    def bench_auth(x_firebase_token: str = Header(...)) -> dict:
+        return {"uid": x_firebase_token}
+
+    main.app.dependency_overrides[verify_firebase_token] = bench_auth
+    return main, store
+
+
+async def run(args: argparse.Namespace, main, logs: list[dict]) -> dict:
+    import httpx
+
+    from src.progress import TERMINAL_STATUSES, progress_broker
+
+    post_latencies: list[float] = []
+    e2e_latencies: list[float] = []
+    outcomes: dict[str, int] = {}
+    document_ids: list[str] = []
+
+    async def wait_done(document_id: str) -> str:
+        async for message in progress_broker.subscribe(document_id):
+            if message and message["event"] == "status" and message["data"]["status"] in TERMINAL_STATUSES:
+                return message["data"]["status"]
+        return "unknown"
+
+    async def one(client: httpx.AsyncClient, i: int) -> None:
+        log = logs[i % len(logs)]
+        body = {**log, "discordWebhookUrl": None if args.no_discord else WEBHOOK_URL}
+        started = time.perf_counter()
+        response = await client.post("/diaries", json=body, headers={"X-Firebase-Token": f"user-{i % args.users}"})
+        post_latencies.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            outcome = f"http_{response.status_code}"
+        else:
+            document_id = response.json()["id"]
+            document_ids.append(document_id)
+            try:
+                outcome = await asyncio.wait_for(wait_done(document_id), timeout=args.timeout)
+            except TimeoutError:
+                outcome = "timeout"
+            if outcome in TERMINAL_STATUSES:
+                e2e_latencies.append(time.perf_counter() - started)
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            started = time.perf_counter()
+            tasks = []
+            for i in range(args.diaries):
+                # 開ループ: 前の応答を待たず、予定時刻になったら投稿する
+                delay = started + i / args.rps - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(one(client, i)))
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+        # 書き込みが残っていれば送る（usage の集計に使う）
+        await main.diary_writer.flush()
+
+    return {
+        "elapsed": elapsed,
+        "post_latencies": post_latencies,
+        "e2e_latencies": e2e_latencies,
+        "outcomes": outcomes,
+        "document_ids": document_ids,
+    }
+
+
+def node_breakdown(store, document_ids: list[str]) -> dict[str, dict[str, float]]:
+    """日記ドキュメントの usage.nodes からノードごとの実行時間を集計する"""
+    documents = store.documents("diaries")
+    seconds: dict[str, list[float]] = {}
+    retries: dict[str, int] = {}
+    for document_id in document_ids:
+        nodes = (documents.get(document_id) or {}).get("usage", {}).get("nodes", {})
+        for node, stats in nodes.items():
+            seconds.setdefault(node, []).append(stats["seconds"])
+            retries[node] = retries.get(node, 0) + stats["retries"]
+    return {
+        node: {"count": len(values), "mean": sum(values) / len(values), **summarize(values), "retries": retries[node]}
+        for node, values in seconds.items()
+    }
+
+
+def image_cache_summary() -> dict:
+    """セマンティック画像キャッシュのヒット率と節約できた時間（src/image_semantic_cache.py のメトリクス）"""
+    from src import metrics
+    from src.image_semantic_cache import IMAGE_SEMANTIC_CACHE
+
+    counts = {
+        result: int(metrics.get_value("image_semantic_cache_total", result=result, mode=IMAGE_SEMANTIC_CACHE))
+        for result in ("hit", "miss", "error")
+    }
+    lookups = counts["hit"] + counts["miss"]
+    return {
+        **counts,
+        "hit_ratio": counts["hit"] / lookups if lookups else 0.0,
+        "saved_seconds": metrics.get_value("image_semantic_cache_saved_seconds_total"),
+    }
+
+
+def report(args: argparse.Namespace, result: dict, nodes: dict) -> dict:
+    completed = result["outcomes"].get("completed", 0)
+    throughput = completed / result["elapsed"] if result["elapsed"] else 0.0
+    summary = {
+        "diaries": args.diaries,
+        "target_rps": args.rps,
+        "workers": int(os.getenv("JOB_QUEUE_WORKERS", "4")),
+        "elapsed_seconds": result["elapsed"],
+        "throughput_per_second": throughput,
+        "outcomes": result["outcomes"],
+        "post_latency_seconds": summarize(result["post_latencies"]),
+        "e2e_latency_seconds": summarize(result["e2e_latencies"]),
+        "nodes": nodes,
+    }
+
+    print(
+        f"diaries={args.diaries} rps={args.rps} workers={summary['workers']} users={args.users} "
+        f"llm={args.llm_ms:.0f}ms image={args.image_ms:.0f}ms"
+    )
+    print(f"elapsed: {result['elapsed']:.1f}s  throughput: {throughput:.2f} diaries/s  outcomes: {result['outcomes']}")
+    for label, key in (("POST /diaries", "post_latency_seconds"), ("end-to-end", "e2e_latency_seconds")):
+        s = summary[key]
+        print(f"{label:>14}: p50={s['p50']:.3f}s p95={s['p95']:.3f}s p99={s['p99']:.3f}s max={s['max']:.3f}s")
+    print(f"{'node':<20} {'count':>6} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'retries':>8}")
+    for node, s in sorted(nodes.items(), key=lambda item: -item[1]["mean"]):
+        print(
+            f"{node:<20} {s['count']:>6} {s['mean']:>7.3f}s {s['p50']:>7.3f}s {s['p95']:>7.3f}s "
+            f"{s['p99']:>7.3f}s {s['retries']:>8}"
+        )
+    if args.image_cache != "off":
+        cache = summary["image_semantic_cache"] = image_cache_summary()
+        # shadow では再利用しないので、節約できた時間は on のときだけ
+        print(
+            f"image semantic cache ({args.image_cache}): hit={cache['hit']} miss={cache['miss']} "
+            f"error={cache['error']} hit_ratio={cache['hit_ratio']:.1%} saved={cache['saved_seconds']:.1f}s"
+        )
+    return summary
+
+
+def main() -> None:
+    args = parse_args()
+    app_main, store = setup(args)
+
+    from src.diary_batch import load_conversation_logs
+
+    logs = load_conversation_logs(args.fixtures)
+
+    # アプリのログ（1件ごとの print）は結果が読めなくなるので既定では捨てる
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+            result = asyncio.run(run(args, app_main, logs))
+
+    summary = report(args, result, node_breakdown(store, result["document_ids"]))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    failed = []
+    if args.max_p95 is not None and not summary["e2e_latency_seconds"]["p95"] <= args.max_p95:
+        failed.append(f"end-to-end p95 {summary['e2e_latency_seconds']['p95']:.3f}s > {args.max_p95}s")
+    if args.min_throughput is not None and summary["throughput_per_second"] < args.min_throughput:
+        failed.append(f"throughput {summary['throughput_per_second']:.2f}/s < {args.min_throughput}/s")
+    if result["outcomes"].get("completed", 0) < args.diaries:
+        failed.append(f"only {result['outcomes'].get('completed', 0)}/{args.diaries} diaries completed")
+    for message in failed:
+        print(f"FAIL: {message}")
+    if failed and (args.max_p95 is not None or args.min_throughput is not None):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
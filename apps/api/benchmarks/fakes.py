@@ -0,0 +1,442 @@
+"""
+ベンチマーク用のローカルフェイク
+
+Vertex AI (ChatVertexAI / genai.Client)・Cloud Storage・Firestore・Discord Webhook の代わりに、
+設定したレイテンシだけ待って応答するプロセス内のフェイクです。ネットワークには接続しません。
+
+install() で src.clients のレジストリと google.cloud.firestore のクライアントを差し替えます。
+src.main / src.diary_workflow を import する前に呼ぶこと。
+"""
+
+import asyncio
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+import types
+import uuid
+from dataclasses import dataclass
+from typing import Any
+
+import httpx
+from google.api_core import exceptions as gexc
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+
+@dataclass
+class Latency:
+    """対数正規分布のレイテンシ（中央値 median_ms、ばらつき sigma）"""
+
+    median_ms: float
+    sigma: float = 0.3
+
+    def sample(self) -> float:
+        if self.median_ms <= 0:
+            return 0.0
+        return self.median_ms / 1000 * random.lognormvariate(0, self.sigma)
+
+
+@dataclass
+class FakeConfig:
+    """フェイクの応答時間・失敗率"""
+
+    llm: Latency
+    image: Latency
+    storage: Latency
+    firestore: Latency
+    discord: Latency
+    throttle_rate: float = 0.0  # Vertex AI 呼び出しが 429 を返す確率
+    low_quality_rate: float = 0.0  # 品質チェックが不合格になる確率
+    scene_variety: int = 0  # 英訳の場面の種類（0 なら入力ごとに別の場面）
+
+
+def _maybe_throttle(config: FakeConfig) -> None:
+    if config.throttle_rate and random.random() < config.throttle_rate:
+        raise gexc.TooManyRequests("fake quota exceeded")
+
+
+# --- Vertex AI (テキスト) ---
+
+# ローカルの品質スコア（src/quality_prescore.py）で合格になる下書き
+DIARY_TEXT = (
+    "きょうは こうえんで ブランコに のったよ。かぜが びゅーっと ふいて、ほっぺたが ひんやりした。"
+    "たくさん こいだら そらまで とんでいけそうで、とっても たのしかった。かえりに のんだ ジュースは "
+    "つめたくて あまかった。おとなになっても ブランコは たのしい（ひざが いたい）。"
+)
+
+
+def _fake_scene(config: FakeConfig) -> tuple[str, str] | None:
+    """英訳の場面（SCENES から選び、要素に天気・時間帯を1つ足して少しずつ違う英訳にする）"""
+    if not config.scene_variety:
+        return None
+    scene, elements = SCENES[random.randrange(min(config.scene_variety, len(SCENES)))]
+    return scene, f"{elements}, {random.choice(SCENE_DETAILS)}"
+
+
+def _fake_value(name: str, spec: dict, seed: str, config: FakeConfig, scene: tuple[str, str] | None = None) -> Any:
+    if spec.get("type") == "array":
+        return ["こうえん", "ブランコ", "かぜ", "たのしい"]
+    if spec.get("type") in ("number", "integer"):
+        # 品質スコア
+        return 0.3 if random.random() < config.low_quality_rate else 0.85
+    if name == "diary_text":
+        return DIARY_TEXT
+    if scene and name in ("scene", "elements"):
+        return scene[0] if name == "scene" else scene[1]
+    # 英訳は入力ごとに変える（画像キャッシュに当たらないように）
+    return f"{name} {seed}"
+
+
+# セマンティック画像キャッシュ（src/image_semantic_cache.py）のベンチマーク用の場面
+SCENES = [
+    ("a child riding a swing in the park", "swing, trees, blue sky, friends"),
+    ("a family playing video games at home", "living room, sofa, game controller, snacks"),
+    ("shopping for groceries with mom at the supermarket", "shopping cart, vegetables, fruits, mom"),
+    ("building a sandcastle at the beach", "sand, bucket, waves, sun"),
+    ("eating birthday cake with the family", "cake, candles, presents, balloons"),
+    ("playing soccer with friends at school", "soccer ball, goal, playground, friends"),
+    ("visiting the zoo and seeing elephants", "elephants, giraffe, fence, trees"),
+    ("a picnic under cherry blossoms", "cherry blossoms, picnic sheet, rice balls, family"),
+    ("swimming in the pool in summer", "pool, swim ring, splash, sun"),
+    ("making a snowman in the snow", "snowman, scarf, snowflakes, mittens"),
+    ("fishing at the river with grandpa", "fishing rod, river, fish, grandpa"),
+    ("drawing pictures in the classroom", "crayons, paper, desk, teacher"),
+]
+SCENE_DETAILS = ["sunny", "morning", "afternoon", "cloudy", "smiling"]
+
+
+class FakeChatModel(BaseChatModel):
+    """ChatVertexAI の代わり。response_schema が bind されていればスキーマに合う JSON を返す"""
+
+    config: Any
+    model_name: str = "gemini-2.0-flash"
+    location: str = "fake"
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-vertex"
+
+    def _respond(self, messages: list[BaseMessage], response_schema: dict | None = None) -> ChatResult:
+        _maybe_throttle(self.config)
+        prompt = "".join(str(m.content) for m in messages)
+        if response_schema:
+            seed = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+            scene = _fake_scene(self.config)
+            content = json.dumps(
+                {
+                    name: _fake_value(name, spec, seed, self.config, scene)
+                    for name, spec in response_schema.get("properties", {}).items()
+                },
+                ensure_ascii=False,
+            )
+        else:
+            content = DIARY_TEXT
+        input_tokens = len(prompt) // 2
+        output_tokens = len(content) // 2
+        message = AIMessage(
+            content=content,
+            usage_metadata={
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+            },
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.config.llm.sample())
+        return self._respond(messages, kwargs.get("response_schema"))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.config.llm.sample())
+        return self._respond(messages, kwargs.get("response_schema"))
+
+
+# --- Vertex AI (画像) ---
+
+
+def sample_png(size: int = 1024) -> bytes:
+    """エンコード・縮小のコストが実際の画像に近いよう、紙のテクスチャと図形を描いた PNG を作る"""
+    from PIL import Image, ImageDraw
+
+    paper = Image.new("RGB", (size, size), (250, 244, 230))
+    texture = Image.effect_noise((size, size), 24).convert("RGB")
+    image = Image.blend(paper, texture, 0.15)
+    draw = ImageDraw.Draw(image)
+    for i in range(12):
+        x, y = random.randrange(size), random.randrange(size)
+        draw.ellipse((x, y, x + size // 6, y + size // 6), fill=(255, 160 + i * 7, 40))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeGenaiClient:
+    """genai.Client の代わり（models / aio.models の generate_content と embed_content のみ）"""
+
+    def __init__(self, config: FakeConfig, image_data: bytes):
+        self.config = config
+        self.image_data = image_data
+        self.models = types.SimpleNamespace(
+            generate_content=self._generate_content, embed_content=self._embed_content
+        )
+        self.aio = types.SimpleNamespace(
+            models=types.SimpleNamespace(generate_content=self._agenerate_content, embed_content=self._aembed_content)
+        )
+
+    def _response(self):
+        _maybe_throttle(self.config)
+        part = types.SimpleNamespace(
+            inline_data=types.SimpleNamespace(data=self.image_data, mime_type="image/png"), text=None
+        )
+        usage = types.SimpleNamespace(prompt_token_count=300, candidates_token_count=1290)
+        return types.SimpleNamespace(parts=[part], usage_metadata=usage)
+
+    def _generate_content(self, **kwargs):
+        time.sleep(self.config.image.sample())
+        return self._response()
+
+    async def _agenerate_content(self, **kwargs):
+        await asyncio.sleep(self.config.image.sample())
+        return self._response()
+
+    @staticmethod
+    def _embedding(contents: str, config) -> types.SimpleNamespace:
+        # 単語のハッシュで次元を決める（同じ単語が多いほど類似度が高い）
+        values = [0.0] * (getattr(config, "output_dimensionality", None) or 256)
+        for word in contents.lower().replace(",", " ").split():
+            digest = hashlib.sha256(word.encode("utf-8")).digest()
+            values[int.from_bytes(digest[:4], "big") % len(values)] += 1.0 if digest[4] % 2 else -1.0
+        return types.SimpleNamespace(embeddings=[types.SimpleNamespace(values=values)])
+
+    def _embed_content(self, model: str, contents: str, config=None):
+        time.sleep(self.config.llm.sample() / 4)
+        return self._embedding(contents, config)
+
+    async def _aembed_content(self, model: str, contents: str, config=None):
+        await asyncio.sleep(self.config.llm.sample() / 4)
+        return self._embedding(contents, config)
+
+
+# --- Cloud Storage ---
+
+
+class FakeBlob:
+    def __init__(self, bucket: "FakeBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.cache_control = None
+
+    def upload_from_string(self, data: bytes, content_type: str | None = None) -> None:
+        time.sleep(self.bucket.config.storage.sample())
+        with self.bucket.lock:
+            self.bucket.objects[self.name] = data
+
+    def download_as_bytes(self) -> bytes:
+        time.sleep(self.bucket.config.storage.sample())
+        with self.bucket.lock:
+            return self.bucket.objects[self.name]
+
+
+class FakeBucket:
+    def __init__(self, name: str, config: FakeConfig):
+        self.name = name
+        self.config = config
+        self.objects: dict[str, bytes] = {}
+        self.lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return True
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+
+class FakeStorageClient:
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.buckets: dict[str, FakeBucket] = {}
+
+    def bucket(self, name: str) -> FakeBucket:
+        return self.buckets.setdefault(name, FakeBucket(name, self.config))
+
+    def create_bucket(self, name: str, location: str | None = None) -> FakeBucket:
+        return self.bucket(name)
+
+
+# --- Firestore ---
+
+
+class FakeFirestoreStore:
+    """コレクション名 -> {ドキュメント ID: データ}（同期・非同期クライアントで共有）"""
+
+    def __init__(self):
+        self.collections: dict[str, dict[str, dict]] = {}
+        self.lock = threading.Lock()
+
+    def documents(self, collection: str) -> dict[str, dict]:
+        with self.lock:
+            return self.collections.setdefault(collection, {})
+
+    def apply(self, collection: str, document_id: str, op: str, data: dict) -> None:
+        with self.lock:
+            documents = self.collections.setdefault(collection, {})
+            if op == "create" and document_id in documents:
+                raise gexc.AlreadyExists(f"{collection}/{document_id}")
+            if op == "update":
+                if document_id not in documents:
+                    raise gexc.NotFound(f"{collection}/{document_id}")
+                documents[document_id] = {**documents[document_id], **data}
+            elif op == "delete":
+                documents.pop(document_id, None)
+            else:
+                documents[document_id] = dict(data)
+
+
+class FakeSnapshot:
+    def __init__(self, document_id: str, data: dict | None):
+        self.id = document_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> dict | None:
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocumentReference:
+    def __init__(self, client: "FakeFirestoreClient", collection: str, document_id: str):
+        self._client = client
+        self._collection = collection
+        self.id = document_id
+
+    def _write(self, op: str, data: dict | None = None) -> None:
+        time.sleep(self._client.config.firestore.sample())
+        self._client.store.apply(self._collection, self.id, op, data or {})
+
+    def get(self) -> FakeSnapshot:
+        time.sleep(self._client.config.firestore.sample())
+        return FakeSnapshot(self.id, self._client.store.documents(self._collection).get(self.id))
+
+    def create(self, data: dict) -> None:
+        self._write("create", data)
+
+    def set(self, data: dict) -> None:
+        self._write("set", data)
+
+    def update(self, data: dict) -> None:
+        self._write("update", data)
+
+    def delete(self) -> None:
+        self._write("delete")
+
+
+class FakeCollectionReference:
+    def __init__(self, client: "FakeFirestoreClient", name: str):
+        self._client = client
+        self._name = name
+
+    def document(self, document_id: str | None = None) -> FakeDocumentReference:
+        return FakeDocumentReference(self._client, self._name, document_id or uuid.uuid4().hex[:20])
+
+
+class FakeWriteBatch:
+    def __init__(self, client: "FakeFirestoreClient"):
+        self._client = client
+        self._writes: list[tuple[FakeDocumentReference, str, dict]] = []
+
+    def set(self, doc_ref: FakeDocumentReference, data: dict) -> None:
+        self._writes.append((doc_ref, "set", data))
+
+    def update(self, doc_ref: FakeDocumentReference, data: dict) -> None:
+        self._writes.append((doc_ref, "update", data))
+
+    def _apply(self) -> None:
+        store = self._client.store
+        # WriteBatch はアトミック: 存在しないドキュメントへの update があれば何も書かない
+        with store.lock:
+            for doc_ref, op, _ in self._writes:
+                if op == "update" and doc_ref.id not in store.collections.get(doc_ref._collection, {}):
+                    raise gexc.NotFound(f"{doc_ref._collection}/{doc_ref.id}")
+        for doc_ref, op, data in self._writes:
+            store.apply(doc_ref._collection, doc_ref.id, op, data)
+
+    def commit(self) -> None:
+        time.sleep(self._client.config.firestore.sample())
+        self._apply()
+
+
+class FakeAsyncWriteBatch(FakeWriteBatch):
+    async def commit(self) -> None:
+        await asyncio.sleep(self._client.config.firestore.sample())
+        self._apply()
+
+
+class FakeFirestoreClient:
+    """firestore.Client の代わり（collection / document / batch のみ）"""
+
+    def __init__(self, store: FakeFirestoreStore, config: FakeConfig):
+        self.store = store
+        self.config = config
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def close(self) -> None:
+        pass
+
+
+class FakeAsyncFirestoreClient(FakeFirestoreClient):
+    """firestore.AsyncClient の代わり（DiaryWriter が使う範囲のみ）"""
+
+    def batch(self) -> FakeAsyncWriteBatch:
+        return FakeAsyncWriteBatch(self)
+
+
+# --- Discord Webhook ---
+
+
+def discord_transports(config: FakeConfig) -> tuple[httpx.MockTransport, httpx.MockTransport]:
+    """Webhook への POST に 204 を返す (同期, 非同期) トランスポート"""
+    sent = {"count": 0}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        time.sleep(config.discord.sample())
+        sent["count"] += 1
+        return httpx.Response(204)
+
+    async def async_handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(config.discord.sample())
+        sent["count"] += 1
+        return httpx.Response(204)
+
+    return httpx.MockTransport(handler), httpx.MockTransport(async_handler)
+
+
+def install(config: FakeConfig, image_regions: list[str]) -> FakeFirestoreStore:
+    """src.clients のレジストリと Firestore クライアントをフェイクに差し替え、共有ストアを返す"""
+    from google.cloud import firestore
+
+    from src import clients
+
+    store = FakeFirestoreStore()
+    firestore.Client = lambda *args, **kwargs: FakeFirestoreClient(store, config)
+    firestore.AsyncClient = lambda *args, **kwargs: FakeAsyncFirestoreClient(store, config)
+
+    image_data = sample_png()
+    storage_client = FakeStorageClient(config)
+    sync_transport, async_transport = discord_transports(config)
+    clients.override("vertex_llm", FakeChatModel(config=config))
+    for region in image_regions:
+        clients.override(f"genai:{region}", FakeGenaiClient(config, image_data))
+    clients.override("storage", storage_client)
+    clients.override("image_bucket", storage_client.bucket(clients.GCS_BUCKET_NAME))
+    clients.override("http_sync", httpx.Client(transport=sync_transport))
+    clients.override("http_async", httpx.AsyncClient(transport=async_transport))
+    return store
@@ -0,0 +1,186 @@
+"""
+ローカル品質スコア（src/quality_prescore.py）の較正
+
+日記テキストのコーパス（JSON Lines。1行に {"text": ..., "llm_score": ...}）について、
+ローカルの判定（accept / reject / escalate）と LLM の品質チェックのスコアを比べ、次を表示します。
+- 判定ごとの件数と、LLM の合否（QUALITY_THRESHOLD）との一致率
+- ローカルで決まった割合（LLM 呼び出しを省ける割合）
+- ローカルスコアと LLM スコアの相関・平均絶対誤差、特徴ごとの LLM 合格・不合格での平均
+- --sweep: accept / reject のしきい値の組み合わせごとの一致率と省ける割合
+
+llm_score のない行は --judge を付けると LLM（check_quality と同じプロンプト）で採点します
+（Vertex AI の認証情報が必要）。--write-labels で採点結果をコーパスとして書き出せば、次回からは LLM を呼ばずに較正できます。
+
+実行例:
+    uv run python -m benchmarks.quality_calibration --corpus fixtures/sample_diary_texts.jsonl
+    uv run python -m benchmarks.quality_calibration --corpus diaries.jsonl --judge --write-labels labeled.jsonl
+    uv run python -m benchmarks.quality_calibration --corpus labeled.jsonl --sweep --target 0.95
+"""
+
+import argparse
+import json
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from src import quality_prescore
+
+API_DIR = Path(__file__).resolve().parent.parent
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=str(API_DIR / "fixtures" / "sample_diary_texts.jsonl"))
+    parser.add_argument("--judge", action="store_true", help="llm_score のない行を LLM で採点する")
+    parser.add_argument("--concurrency", type=int, default=4, help="LLM で採点する並列数")
+    parser.add_argument("--write-labels", help="llm_score を付けたコーパスを書き出すパス")
+    parser.add_argument("--threshold", type=float, default=0.6, help="LLM スコアの合格ライン（QUALITY_THRESHOLD）")
+    parser.add_argument("--accept", type=float, default=quality_prescore.QUALITY_PRESCORE_ACCEPT)
+    parser.add_argument("--reject", type=float, default=quality_prescore.QUALITY_PRESCORE_REJECT)
+    parser.add_argument("--weights", help='重み（例: "length=0.3,sensory=0.1"。指定のない特徴は既定値）')
+    parser.add_argument("--sweep", action="store_true", help="しきい値の組み合わせごとの一致率を表示する")
+    parser.add_argument("--target", type=float, default=0.95, help="--sweep で推奨するしきい値の最低一致率")
+    parser.add_argument("--json", help="結果を JSON で書き出すパス")
+    return parser.parse_args()
+
+
+def load_corpus(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def judge(rows: list[dict], concurrency: int) -> None:
+    """llm_score のない行を check_quality と同じプロンプトで採点する"""
+    from src.diary_workflow import QualityOutput, _quality_prompt, llm
+    from src.llm_output import invoke_structured
+
+    targets = [row for row in rows if row.get("llm_score") is None]
+
+    def score(row: dict) -> None:
+        try:
+            result = invoke_structured(llm, _quality_prompt(row["text"]), QualityOutput, node="check_quality")
+            row["llm_score"] = result.score
+        except Exception as e:
+            print(f"Failed to judge: {e}")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(score, targets))
+    print(f"Judged {sum(1 for row in targets if row.get('llm_score') is not None)}/{len(targets)} texts with the LLM")
+
+
+def evaluate(rows: list[dict], weights: dict, accept: float, reject: float, threshold: float) -> dict:
+    """ローカルの判定と LLM の合否の一致を集計する"""
+    counts = {decision: {"total": 0, "labeled": 0, "agree": 0} for decision in ("accept", "reject", "escalate")}
+    for row in rows:
+        result = quality_prescore.prescore(row["text"], weights=weights, accept=accept, reject=reject)
+        count = counts[result.decision]
+        count["total"] += 1
+        if row.get("llm_score") is None:
+            continue
+        count["labeled"] += 1
+        if result.decision != "escalate" and (result.decision == "accept") == (row["llm_score"] >= threshold):
+            count["agree"] += 1
+    decided = counts["accept"]["labeled"] + counts["reject"]["labeled"]
+    labeled = decided + counts["escalate"]["labeled"]
+    agree = counts["accept"]["agree"] + counts["reject"]["agree"]
+    return {
+        "counts": counts,
+        "coverage": (counts["accept"]["total"] + counts["reject"]["total"]) / len(rows) if rows else 0.0,
+        "agreement": agree / decided if decided else None,
+        "labeled": labeled,
+    }
+
+
+def feature_report(rows: list[dict], threshold: float) -> dict:
+    """特徴ごとの平均（LLM 合格 / 不合格）"""
+    groups: dict[str, dict[str, list[float]]] = {}
+    for row in rows:
+        if row.get("llm_score") is None:
+            continue
+        label = "pass" if row["llm_score"] >= threshold else "fail"
+        for name, value in quality_prescore.features(row["text"]).items():
+            groups.setdefault(name, {"pass": [], "fail": []})[label].append(value)
+    return {
+        name: {label: statistics.mean(values) if values else None for label, values in by_label.items()}
+        for name, by_label in groups.items()
+    }
+
+
+def sweep(rows: list[dict], weights: dict, threshold: float, target: float) -> tuple[list[dict], dict | None]:
+    """しきい値の組み合わせごとの一致率と省ける割合。target 以上の一致率で最も多く省けるものを推奨する"""
+    results = []
+    for accept in [round(0.6 + 0.05 * i, 2) for i in range(9)]:
+        for reject in [round(0.05 * i, 2) for i in range(12)]:
+            if reject >= accept:
+                continue
+            summary = evaluate(rows, weights, accept, reject, threshold)
+            results.append({"accept": accept, "reject": reject, "coverage": summary["coverage"], "agreement": summary["agreement"]})
+    candidates = [r for r in results if r["agreement"] is not None and r["agreement"] >= target]
+    best = max(candidates, key=lambda r: (r["coverage"], r["agreement"]), default=None)
+    return results, best
+
+
+def _fmt(value: float | None) -> str:
+    return "-" if value is None else f"{value:.3f}"
+
+
+def main() -> None:
+    args = parse_args()
+    rows = load_corpus(args.corpus)
+    weights = quality_prescore.parse_weights(args.weights) if args.weights else quality_prescore.QUALITY_PRESCORE_WEIGHTS
+
+    if args.judge:
+        judge(rows, args.concurrency)
+    if args.write_labels:
+        with open(args.write_labels, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    summary = evaluate(rows, weights, args.accept, args.reject, args.threshold)
+    print(f"corpus={len(rows)} labeled={summary['labeled']} accept>={args.accept} reject<={args.reject} threshold={args.threshold}")
+    print(f"{'decision':<10} {'count':>6} {'labeled':>8} {'agree':>6}")
+    for decision, count in summary["counts"].items():
+        agree = "-" if decision == "escalate" else str(count["agree"])
+        print(f"{decision:<10} {count['total']:>6} {count['labeled']:>8} {agree:>6}")
+    print(f"decided locally: {summary['coverage']:.1%}  agreement with LLM: {_fmt(summary['agreement'])}")
+
+    labeled = [row for row in rows if row.get("llm_score") is not None]
+    if len(labeled) >= 2:
+        local = [quality_prescore.prescore(row["text"], weights=weights).score for row in labeled]
+        llm = [row["llm_score"] for row in labeled]
+        summary["mae"] = statistics.mean(abs(a - b) for a, b in zip(local, llm))
+        try:
+            summary["correlation"] = statistics.correlation(local, llm)
+        except statistics.StatisticsError:
+            summary["correlation"] = None
+        print(f"local vs LLM score: correlation={_fmt(summary['correlation'])} mae={summary['mae']:.3f}")
+
+        summary["features"] = feature_report(rows, args.threshold)
+        print(f"{'feature':<10} {'weight':>6} {'LLM pass':>9} {'LLM fail':>9}")
+        for name, means in summary["features"].items():
+            print(f"{name:<10} {weights[name]:>6.2f} {_fmt(means['pass']):>9} {_fmt(means['fail']):>9}")
+    else:
+        print("No LLM scores in the corpus; run with --judge to compare against the LLM")
+
+    if args.sweep:
+        results, best = sweep(rows, weights, args.threshold, args.target)
+        summary["sweep"] = results
+        summary["recommended"] = best
+        print(f"{'accept':>6} {'reject':>6} {'coverage':>9} {'agreement':>10}")
+        for r in sorted(results, key=lambda r: (-r["coverage"], r["accept"], -r["reject"]))[:15]:
+            print(f"{r['accept']:>6.2f} {r['reject']:>6.2f} {r['coverage']:>8.1%} {_fmt(r['agreement']):>10}")
+        if best:
+            print(
+                f"recommended: QUALITY_PRESCORE_ACCEPT={best['accept']} QUALITY_PRESCORE_REJECT={best['reject']} "
+                f"(coverage {best['coverage']:.1%}, agreement {best['agreement']:.3f})"
+            )
+        else:
+            print(f"No thresholds reach agreement {args.target}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+コールドスタートのベンチマーク（オフライン）
+
+毎回新しいプロセスで次を計測します。
+- import プロファイル: `python -X importtime -c "import src.main"` の合計時間と、時間のかかったモジュール
+- 起動: src.main の import、lifespan の開始から /health が 200 になるまで（STARTUP_WARMUP なし / あり）
+- 最初の絵日記と2件目の絵日記の完了までの時間（差が初回の import・コンパイル待ち）
+
+起動の計測は benchmarks/fakes.py のフェイクを使う（フェイクの準備で読み込むモジュールは
+import 時間に含まれない。import そのものの比較は import プロファイルを見ること）。
+
+実行例:
+    uv run python -m benchmarks.startup_bench
+    uv run python -m benchmarks.startup_bench --runs 5 --top 20 --json /tmp/startup.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+API_DIR = Path(__file__).resolve().parent.parent
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="計測の繰り返し回数（それぞれ新しいプロセス）")
+    parser.add_argument("--top", type=int, default=15, help="表示するモジュール数")
+    parser.add_argument("--llm-ms", type=float, default=20.0, help="フェイクのテキスト生成1回のレイテンシ")
+    parser.add_argument("--image-ms", type=float, default=50.0, help="フェイクの画像生成1回のレイテンシ")
+    parser.add_argument("--json", help="結果を JSON で書き出すパス")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def _python_env(**extra: str) -> dict[str, str]:
+    env = {**os.environ, **extra}
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(API_DIR), env.get("PYTHONPATH")]))
+    return env
+
+
+def import_profile(runs: int) -> dict:
+    """-X importtime の出力から、src.main の import 時間とモジュールごとの累積時間（中央値）を求める"""
+    totals: list[float] = []
+    modules: dict[str, list[float]] = {}
+    for _ in range(runs):
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import src.main"],
+            cwd=API_DIR,
+            env=_python_env(),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        for line in completed.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line[len("import time:") :].split("|")
+            # 字下げはネストの深さ。トップレベルと1段下だけを集計する
+            depth = (len(name) - len(name.lstrip())) // 2
+            seconds = int(cumulative) / 1e6
+            if name.strip() == "src.main":
+                totals.append(seconds)
+            elif depth <= 2:
+                modules.setdefault(name.strip(), []).append(seconds)
+    return {
+        "src_main_seconds": statistics.median(totals),
+        "modules": {name: statistics.median(values) for name, values in modules.items()},
+    }
+
+
+async def _cold_start(args: argparse.Namespace, started: float, imported: float, main) -> dict:
+    import httpx
+
+    from src.diary_batch import load_conversation_logs
+    from src.progress import TERMINAL_STATUSES, progress_broker
+
+    logs = load_conversation_logs(str(API_DIR / "fixtures" / "sample_conversation_logs.json"))
+    result = {"import_seconds": imported - started}
+
+    async def wait_done(document_id: str) -> str:
+        async for message in progress_broker.subscribe(document_id):
+            if message and message["event"] == "status" and message["data"]["status"] in TERMINAL_STATUSES:
+                return message["data"]["status"]
+        return "unknown"
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            while (await client.get("/health")).status_code != 200:
+                await asyncio.sleep(0.01)
+            result["ready_seconds"] = time.perf_counter() - started
+            for label in ("first_diary_seconds", "second_diary_seconds"):
+                posted = time.perf_counter()
+                response = await client.post("/diaries", json=logs[0], headers={"X-Firebase-Token": "bench-user"})
+                status = await wait_done(response.json()["id"])
+                result[label] = time.perf_counter() - posted
+                result[label.replace("seconds", "status")] = status
+            result["startup"] = (await client.get("/metrics/startup")).json()
+    return result
+
+
+def child(args: argparse.Namespace) -> None:
+    """新しいプロセスで起動から2件の絵日記までを計測し、結果を JSON で標準出力の最後の行に書く"""
+    import contextlib
+
+    os.environ.setdefault("JOB_QUEUE_BACKEND", "memory")
+    os.environ.setdefault("LLM_CACHE_BACKEND", "off")
+    os.environ.setdefault("DIARY_CHECKPOINTER", "memory")
+    os.environ.setdefault("DIARY_RECOVERY_ENABLED", "false")
+
+    from benchmarks import fakes
+
+    latency = fakes.Latency
+    config = fakes.FakeConfig(
+        llm=latency(args.llm_ms), image=latency(args.image_ms), storage=latency(5), firestore=latency(5), discord=latency(5)
+    )
+    image_regions = [r.strip() for r in os.getenv("IMAGE_REGIONS", "us-central1").split(",") if r.strip()]
+    fakes.install(config, image_regions)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        started = time.perf_counter()
+        from src import main
+
+        imported = time.perf_counter()
+
+        from fastapi import Header
+
+        from src.firebase_auth import verify_firebase_token
+
+        def bench_auth(x_firebase_token: str = Header(...)) -> dict:
+            return {"uid": x_firebase_token}
+
+        main.app.dependency_overrides[verify_firebase_token] = bench_auth
+        result = asyncio.run(_cold_start(args, started, imported, main))
+    print(json.dumps(result))
+
+
+def cold_start(args: argparse.Namespace, warmup: bool) -> list[dict]:
+    results = []
+    for _ in range(args.runs):
+        completed = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.startup_bench",
+                "--child",
+                "--llm-ms",
+                str(args.llm_ms),
+                "--image-ms",
+                str(args.image_ms),
+            ],
+            cwd=API_DIR,
+            env=_python_env(STARTUP_WARMUP="true" if warmup else "false"),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    return results
+
+
+def main() -> None:
+    args = parse_args()
+    if args.child:
+        child(args)
+        return
+
+    imports = import_profile(args.runs)
+    print(f"import src.main: {imports['src_main_seconds']:.3f}s (median of {args.runs})")
+    for name, seconds in sorted(imports["modules"].items(), key=lambda item: -item[1])[: args.top]:
+        print(f"  {seconds:>7.3f}s  {name}")
+
+    summary = {"imports": imports, "cold_start": {}}
+    print(f"{'STARTUP_WARMUP':<15} {'import':>8} {'ready':>8} {'1st diary':>10} {'2nd diary':>10}")
+    for warmup in (False, True):
+        runs = cold_start(args, warmup)
+        summary["cold_start"]["warmup" if warmup else "default"] = runs
+        median = {
+            key: statistics.median(run[key] for run in runs)
+            for key in ("import_seconds", "ready_seconds", "first_diary_seconds", "second_diary_seconds")
+        }
+        print(
+            f"{str(warmup).lower():<15} {median['import_seconds']:>7.3f}s {median['ready_seconds']:>7.3f}s "
+            f"{median['first_diary_seconds']:>9.3f}s {median['second_diary_seconds']:>9.3f}s"
+        )
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
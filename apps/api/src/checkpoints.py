@@ -0,0 +1,562 @@
+"""
+ワークフローのチェックポイント（LangGraph）
+
+ノードが完了するたびにワークフローの状態を保存し、インスタンスが途中で落ちても、
+同じ document_id で再実行したときに最後に完了したノードの次から再開します。
+成功済みの LLM 呼び出し・画像生成をもう一度行わない（二重に課金しない）ためです。
+
+バックエンド（DIARY_CHECKPOINTER）:
+- auto: Firestore クライアントを作成できれば firestore、できなければ sqlite（既定）
+- off: 保存しない（毎回最初から実行する）
+- memory: プロセス内（テスト・ベンチマーク用）
+- sqlite: ローカル SQLite ファイル（DIARY_CHECKPOINT_SQLITE_PATH）。インスタンスが入れ替わると失われるので、
+  同じインスタンスでの再起動後に再開する用途（ローカル開発・単一インスタンス）向け
+- firestore: Firestore の diaryCheckpoints コレクション（インスタンス間で共有。本番用）
+
+スレッド ID は document_id です。絵日記の結果を保存したらそのスレッドのチェックポイントは削除します
+（Firestore では expiresAt に TTL ポリシーを設定すると、削除されずに残ったものも消えます。
+SQLite では最後の保存から DIARY_CHECKPOINT_TTL_HOURS 経過したスレッドを起動時と1時間ごとに削除します）。
+"""
+
+import abc
+import asyncio
+import datetime
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import AsyncIterator, Iterator, Sequence
+from typing import Any
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+from src import clients, metrics
+
+DIARY_CHECKPOINTER = os.getenv("DIARY_CHECKPOINTER", "auto")  # auto / off / memory / sqlite / firestore
+DIARY_CHECKPOINT_SQLITE_PATH = os.getenv("DIARY_CHECKPOINT_SQLITE_PATH", "/tmp/enikki-checkpoints.sqlite3")
+DIARY_CHECKPOINT_COLLECTION = os.getenv("DIARY_CHECKPOINT_COLLECTION", "diaryCheckpoints")
+DIARY_CHECKPOINT_TTL_HOURS = float(os.getenv("DIARY_CHECKPOINT_TTL_HOURS", "72"))
+
+# SQLite の期限切れチェックポイントを削除する間隔（秒）
+_SQLITE_PRUNE_INTERVAL = 3600
+
+# Firestore ドキュメントの上限（1 MiB）に収まるよう、大きな値（生成済みの画像など）は分割して保存する
+_FIRESTORE_CHUNK_BYTES = 900 * 1024
+
+# (task_id, idx, channel, (type, bytes), task_path)
+WriteRow = tuple[str, int, str, tuple[str, bytes], str]
+
+
+class _CheckpointRecord(dict):
+    """保存される1件のチェックポイント
+
+    checkpoint_id, parent_checkpoint_id, checkpoint (type, bytes), metadata (type, bytes)
+    """
+
+
+class StoredCheckpointSaver(BaseCheckpointSaver[str], abc.ABC):
+    """チェックポイントをレコード単位で保存するセーバーの共通部分
+
+    サブクラスは _get_record / _list_records / _put_record / _get_writes / _put_writes / delete_thread を実装する。
+    状態はチェックポイントごとに丸ごと保存する（1件の絵日記のチェックポイントは十数件なので差分にはしない）。
+    非同期版はスレッドで同期版を呼ぶ。
+    """
+
+    @abc.abstractmethod
+    def _get_record(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str | None) -> _CheckpointRecord | None:
+        """checkpoint_id が None なら最新のもの"""
+
+    @abc.abstractmethod
+    def _list_records(self, thread_id: str | None, checkpoint_ns: str | None) -> Iterator[tuple[str, str, _CheckpointRecord]]:
+        """(thread_id, checkpoint_ns, レコード) を新しい順に返す"""
+
+    @abc.abstractmethod
+    def _put_record(self, thread_id: str, checkpoint_ns: str, record: _CheckpointRecord) -> None:
+        """チェックポイントを1件保存する"""
+
+    @abc.abstractmethod
+    def _get_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> list[WriteRow]:
+        """チェックポイントに紐づく書き込みを (task_path, task_id, idx) の順に返す"""
+
+    @abc.abstractmethod
+    def _put_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str, rows: list[WriteRow]) -> None:
+        """idx が負（特殊なチャンネル）の書き込みは上書き、それ以外は既存のものを残す"""
+
+    @abc.abstractmethod
+    def delete_thread(self, thread_id: str) -> None:
+        """スレッドのチェックポイントと書き込みをすべて削除する"""
+
+    def _tuple(self, thread_id: str, checkpoint_ns: str, record: _CheckpointRecord) -> CheckpointTuple:
+        checkpoint_id = record["checkpoint_id"]
+        parent_id = record.get("parent_checkpoint_id")
+        writes = self._get_writes(thread_id, checkpoint_ns, checkpoint_id)
+        return CheckpointTuple(
+            config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": checkpoint_id,
+                }
+            },
+            checkpoint=self.serde.loads_typed(record["checkpoint"]),
+            metadata=self.serde.loads_typed(record["metadata"]),
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_id}}
+                if parent_id
+                else None
+            ),
+            pending_writes=[(task_id, channel, self.serde.loads_typed(value)) for task_id, _, channel, value, _ in writes],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        record = self._get_record(thread_id, checkpoint_ns, get_checkpoint_id(config))
+        return self._tuple(thread_id, checkpoint_ns, record) if record else None
+
+    def list(
+        self,
+        config: RunnableConfig | None,
+        *,
+        filter: dict[str, Any] | None = None,
+        before: RunnableConfig | None = None,
+        limit: int | None = None,
+    ) -> Iterator[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"] if config else None
+        checkpoint_ns = config["configurable"].get("checkpoint_ns") if config else None
+        config_checkpoint_id = get_checkpoint_id(config) if config else None
+        before_id = get_checkpoint_id(before) if before else None
+        for record_thread_id, record_ns, record in self._list_records(thread_id, checkpoint_ns):
+            checkpoint_id = record["checkpoint_id"]
+            if config_checkpoint_id and checkpoint_id != config_checkpoint_id:
+                continue
+            if before_id and checkpoint_id >= before_id:
+                continue
+            if filter:
+                metadata = self.serde.loads_typed(record["metadata"])
+                if not all(metadata.get(key) == value for key, value in filter.items()):
+                    continue
+            if limit is not None:
+                if limit <= 0:
+                    break
+                limit -= 1
+            yield self._tuple(record_thread_id, record_ns, record)
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        record = _CheckpointRecord(
+            checkpoint_id=checkpoint["id"],
+            parent_checkpoint_id=config["configurable"].get("checkpoint_id"),
+            checkpoint=self.serde.dumps_typed(checkpoint),
+            metadata=self.serde.dumps_typed(get_checkpoint_metadata(config, metadata)),
+        )
+        self._put_record(thread_id, checkpoint_ns, record)
+        metrics.inc("diary_checkpoints_total", backend=type(self).__name__)
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        rows = [
+            (task_id, WRITES_IDX_MAP.get(channel, idx), channel, self.serde.dumps_typed(value), task_path)
+            for idx, (channel, value) in enumerate(writes)
+        ]
+        self._put_writes(
+            config["configurable"]["thread_id"],
+            config["configurable"].get("checkpoint_ns", ""),
+            config["configurable"]["checkpoint_id"],
+            rows,
+        )
+
+    async def aget_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: RunnableConfig | None,
+        *,
+        filter: dict[str, Any] | None = None,
+        before: RunnableConfig | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        items = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in items:
+            yield item
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+
+class SQLiteCheckpointSaver(StoredCheckpointSaver):
+    """ローカル SQLite ファイルに保存する（同じインスタンスでの再起動後に再開できる）"""
+
+    def __init__(self, path: str = DIARY_CHECKPOINT_SQLITE_PATH):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                parent_checkpoint_id TEXT,
+                type TEXT NOT NULL,
+                checkpoint BLOB NOT NULL,
+                metadata_type TEXT NOT NULL,
+                metadata BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+            );
+            CREATE TABLE IF NOT EXISTS checkpoint_writes (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                type TEXT NOT NULL,
+                value BLOB NOT NULL,
+                task_path TEXT NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+            );
+            CREATE INDEX IF NOT EXISTS checkpoints_created_at ON checkpoints (created_at);
+            """
+        )
+        self._pruned_at = 0.0
+        self.delete_expired()
+
+    def delete_expired(self) -> int:
+        """最後の保存から DIARY_CHECKPOINT_TTL_HOURS 経過したスレッドを削除し、その数を返す
+
+        failed になった絵日記のスレッドなど、delete_thread されずに残ったもの（Firestore の expiresAt に相当）。
+        """
+        cutoff = time.time() - DIARY_CHECKPOINT_TTL_HOURS * 3600
+        with self._lock:
+            self._pruned_at = time.time()
+            thread_ids = [
+                row[0]
+                for row in self._conn.execute(
+                    "SELECT thread_id FROM checkpoints GROUP BY thread_id HAVING MAX(created_at) < ?", (cutoff,)
+                ).fetchall()
+            ]
+            for thread_id in thread_ids:
+                self._conn.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+                self._conn.execute("DELETE FROM checkpoint_writes WHERE thread_id = ?", (thread_id,))
+        if thread_ids:
+            metrics.inc("diary_checkpoints_expired_total", len(thread_ids), backend=type(self).__name__)
+            print(f"Deleted expired checkpoints of {len(thread_ids)} diaries")
+        return len(thread_ids)
+
+    @staticmethod
+    def _record(row) -> _CheckpointRecord:
+        checkpoint_id, parent_id, type_, checkpoint, metadata_type, metadata = row
+        return _CheckpointRecord(
+            checkpoint_id=checkpoint_id,
+            parent_checkpoint_id=parent_id,
+            checkpoint=(type_, checkpoint),
+            metadata=(metadata_type, metadata),
+        )
+
+    def _get_record(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str | None) -> _CheckpointRecord | None:
+        columns = "checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata"
+        with self._lock:
+            if checkpoint_id:
+                row = self._conn.execute(
+                    f"SELECT {columns} FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    (thread_id, checkpoint_ns, checkpoint_id),
+                ).fetchone()
+            else:
+                row = self._conn.execute(
+                    f"SELECT {columns} FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+                    "ORDER BY checkpoint_id DESC LIMIT 1",
+                    (thread_id, checkpoint_ns),
+                ).fetchone()
+        return self._record(row) if row else None
+
+    def _list_records(self, thread_id: str | None, checkpoint_ns: str | None):
+        query = (
+            "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata "
+            "FROM checkpoints WHERE (? IS NULL OR thread_id = ?) AND (? IS NULL OR checkpoint_ns = ?) "
+            "ORDER BY checkpoint_id DESC"
+        )
+        with self._lock:
+            rows = self._conn.execute(query, (thread_id, thread_id, checkpoint_ns, checkpoint_ns)).fetchall()
+        for row in rows:
+            yield row[0], row[1], self._record(row[2:])
+
+    def _put_record(self, thread_id: str, checkpoint_ns: str, record: _CheckpointRecord) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    thread_id,
+                    checkpoint_ns,
+                    record["checkpoint_id"],
+                    record["parent_checkpoint_id"],
+                    *record["checkpoint"],
+                    *record["metadata"],
+                    time.time(),
+                ),
+            )
+        if time.time() - self._pruned_at >= _SQLITE_PRUNE_INTERVAL:
+            self.delete_expired()
+
+    def _get_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> list[WriteRow]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT task_id, idx, channel, type, value, task_path FROM checkpoint_writes "
+                "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_path, task_id, idx",
+                (thread_id, checkpoint_ns, checkpoint_id),
+            ).fetchall()
+        return [(task_id, idx, channel, (type_, value), task_path) for task_id, idx, channel, type_, value, task_path in rows]
+
+    def _put_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str, rows: list[WriteRow]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for task_id, idx, channel, (type_, value), task_path in rows:
+                    self._conn.execute(
+                        f"INSERT OR {'REPLACE' if idx < 0 else 'IGNORE'} INTO checkpoint_writes "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type_, value, task_path),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+            self._conn.execute("DELETE FROM checkpoint_writes WHERE thread_id = ?", (thread_id,))
+
+
+class FirestoreCheckpointSaver(StoredCheckpointSaver):
+    """Firestore に保存する（別のインスタンスでも再開できる）
+
+    diaryCheckpoints/{thread_id}                      最新のチェックポイント ID（名前空間ごと）
+      /checkpoints/{checkpoint_ns}|{checkpoint_id}    チェックポイント
+      /writes/{checkpoint_ns}|{checkpoint_id}|{task_id}|{idx}
+      /chunks/{親ドキュメント ID}|{n}                  1 MiB を超える値の分割
+    """
+
+    def __init__(self, collection: str = DIARY_CHECKPOINT_COLLECTION, client=None):
+        super().__init__()
+        self.db = client if client is not None else clients.get_firestore_client()
+        self.collection = collection
+
+    def _thread(self, thread_id: str):
+        return self.db.collection(self.collection).document(thread_id)
+
+    @staticmethod
+    def _latest_key(checkpoint_ns: str) -> str:
+        # Firestore のフィールド名は空文字列にできない（ルートグラフの名前空間は ""）
+        return checkpoint_ns or "_root"
+
+    @staticmethod
+    def _expires_at() -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=DIARY_CHECKPOINT_TTL_HOURS)
+
+    def _put_value(self, batch, thread_ref, doc_id: str, fields: dict, value: bytes) -> None:
+        """value が大きければ chunks に分けて書く"""
+        if len(value) <= _FIRESTORE_CHUNK_BYTES:
+            batch.set(thread_ref.collection(fields.pop("_kind")).document(doc_id), {**fields, "value": value, "chunks": 0})
+            return
+        chunks = [value[i : i + _FIRESTORE_CHUNK_BYTES] for i in range(0, len(value), _FIRESTORE_CHUNK_BYTES)]
+        for n, chunk in enumerate(chunks):
+            batch.set(
+                thread_ref.collection("chunks").document(f"{doc_id}|{n}"),
+                {"value": chunk, "expiresAt": fields["expiresAt"]},
+            )
+        batch.set(thread_ref.collection(fields.pop("_kind")).document(doc_id), {**fields, "value": None, "chunks": len(chunks)})
+
+    def _value(self, thread_ref, doc_id: str, data: dict) -> bytes:
+        if not data.get("chunks"):
+            return data["value"]
+        refs = [thread_ref.collection("chunks").document(f"{doc_id}|{n}") for n in range(data["chunks"])]
+        snapshots = {snapshot.id: snapshot.to_dict() for snapshot in self.db.get_all(refs)}
+        return b"".join(snapshots[ref.id]["value"] for ref in refs)
+
+    def _record(self, thread_ref, doc_id: str, data: dict) -> _CheckpointRecord:
+        return _CheckpointRecord(
+            checkpoint_id=data["checkpoint_id"],
+            parent_checkpoint_id=data.get("parent_checkpoint_id"),
+            checkpoint=(data["type"], self._value(thread_ref, doc_id, data)),
+            metadata=(data["metadata_type"], data["metadata"]),
+        )
+
+    def _get_record(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str | None) -> _CheckpointRecord | None:
+        thread_ref = self._thread(thread_id)
+        if not checkpoint_id:
+            thread = thread_ref.get()
+            latest = (thread.to_dict() or {}).get("latest", {}) if thread.exists else {}
+            checkpoint_id = latest.get(self._latest_key(checkpoint_ns))
+            if not checkpoint_id:
+                return None
+        doc_id = f"{checkpoint_ns}|{checkpoint_id}"
+        snapshot = thread_ref.collection("checkpoints").document(doc_id).get()
+        return self._record(thread_ref, doc_id, snapshot.to_dict()) if snapshot.exists else None
+
+    def _list_records(self, thread_id: str | None, checkpoint_ns: str | None):
+        if thread_id is None:
+            thread_ids = [ref.id for ref in self.db.collection(self.collection).list_documents()]
+        else:
+            thread_ids = [thread_id]
+        for current in thread_ids:
+            thread_ref = self._thread(current)
+            records = []
+            for snapshot in thread_ref.collection("checkpoints").stream():
+                data = snapshot.to_dict()
+                if checkpoint_ns is None or data["checkpoint_ns"] == checkpoint_ns:
+                    records.append((data["checkpoint_ns"], snapshot.id, data))
+            for ns, doc_id, data in sorted(records, key=lambda r: r[2]["checkpoint_id"], reverse=True):
+                yield current, ns, self._record(thread_ref, doc_id, data)
+
+    def _put_record(self, thread_id: str, checkpoint_ns: str, record: _CheckpointRecord) -> None:
+        thread_ref = self._thread(thread_id)
+        expires_at = self._expires_at()
+        batch = self.db.batch()
+        type_, value = record["checkpoint"]
+        metadata_type, metadata = record["metadata"]
+        self._put_value(
+            batch,
+            thread_ref,
+            f"{checkpoint_ns}|{record['checkpoint_id']}",
+            {
+                "_kind": "checkpoints",
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": record["checkpoint_id"],
+                "parent_checkpoint_id": record["parent_checkpoint_id"],
+                "type": type_,
+                "metadata_type": metadata_type,
+                "metadata": metadata,
+                "expiresAt": expires_at,
+            },
+            value,
+        )
+        batch.set(
+            thread_ref,
+            {"latest": {self._latest_key(checkpoint_ns): record["checkpoint_id"]}, "expiresAt": expires_at},
+            merge=True,
+        )
+        batch.commit()
+
+    def _get_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> list[WriteRow]:
+        from google.cloud.firestore import FieldFilter
+
+        thread_ref = self._thread(thread_id)
+        query = (
+            thread_ref.collection("writes")
+            .where(filter=FieldFilter("checkpoint_ns", "==", checkpoint_ns))
+            .where(filter=FieldFilter("checkpoint_id", "==", checkpoint_id))
+        )
+        rows = []
+        for snapshot in query.stream():
+            data = snapshot.to_dict()
+            value = self._value(thread_ref, snapshot.id, data)
+            rows.append((data["task_id"], data["idx"], data["channel"], (data["type"], value), data["task_path"]))
+        rows.sort(key=lambda row: (row[4], row[0], row[1]))
+        return rows
+
+    def _put_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str, rows: list[WriteRow]) -> None:
+        thread_ref = self._thread(thread_id)
+        expires_at = self._expires_at()
+        doc_ids = [f"{checkpoint_ns}|{checkpoint_id}|{task_id}|{idx}" for task_id, idx, *_ in rows]
+        existing = {
+            snapshot.id
+            for snapshot in self.db.get_all([thread_ref.collection("writes").document(doc_id) for doc_id in doc_ids])
+            if snapshot.exists
+        }
+        batch = self.db.batch()
+        for doc_id, (task_id, idx, channel, (type_, value), task_path) in zip(doc_ids, rows):
+            if idx >= 0 and doc_id in existing:
+                continue
+            self._put_value(
+                batch,
+                thread_ref,
+                doc_id,
+                {
+                    "_kind": "writes",
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": checkpoint_id,
+                    "task_id": task_id,
+                    "idx": idx,
+                    "channel": channel,
+                    "type": type_,
+                    "task_path": task_path,
+                    "expiresAt": expires_at,
+                },
+                value,
+            )
+        batch.commit()
+
+    def delete_thread(self, thread_id: str) -> None:
+        self.db.recursive_delete(self._thread(thread_id))
+
+
+def create_checkpointer(backend: str = DIARY_CHECKPOINTER) -> BaseCheckpointSaver | None:
+    """環境変数 DIARY_CHECKPOINTER に応じたチェックポインター（off なら None）"""
+    if backend == "auto":
+        try:
+            return FirestoreCheckpointSaver(client=clients.get_firestore_client())
+        except Exception as e:
+            print(f"Firestore is not available for checkpoints; using sqlite (lost when the instance is replaced): {e}")
+            backend = "sqlite"
+    if backend == "off":
+        return None
+    if backend == "memory":
+        from langgraph.checkpoint.memory import InMemorySaver
+
+        return InMemorySaver()
+    if backend == "sqlite":
+        return SQLiteCheckpointSaver()
+    if backend == "firestore":
+        return FirestoreCheckpointSaver()
+    raise ValueError(f"Unknown DIARY_CHECKPOINTER: {backend}")
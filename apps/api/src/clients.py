@@ -0,0 +1,168 @@
+"""
+クライアントレジストリ
+
+Vertex AI (LangChain) / GenAI / Cloud Storage / Firestore / HTTP クライアントを初回利用時に作成し、
+プロセス内で使い回します。絵日記ごとにクライアントを作り直すと、TLS ハンドシェイクや
+認証情報の探索、バケット確認のための GCS 呼び出しが毎回発生するためです。
+
+作成・再利用の回数は client_registry_total メトリクスで確認できます。
+ライブラリの import も各 get_* の中で行い、起動時には読み込みません。
+"""
+
+import os
+import threading
+
+import httpx
+
+from src import metrics
+
+PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "enikki-cloud")
+REGION = os.getenv("GCP_REGION", "asia-northeast1")
+GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME", f"{PROJECT_ID}-enikki-images")
+
+# HTTP クライアントの接続プール設定
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+
+_lock = threading.Lock()
+_clients: dict[str, object] = {}
+
+
+def _get_or_create(name: str, factory):
+    client = _clients.get(name)
+    if client is not None:
+        metrics.inc("client_registry_total", client=name, event="reused")
+        return client
+    with _lock:
+        client = _clients.get(name)
+        if client is None:
+            client = factory()
+            _clients[name] = client
+            metrics.inc("client_registry_total", client=name, event="created")
+            print(f"Created shared client: {name}")
+        else:
+            metrics.inc("client_registry_total", client=name, event="reused")
+        return client
+
+
+def override(name: str, client) -> None:
+    """共有クライアントを差し替える（ベンチマークなどでローカルのフェイクを使うため）"""
+    with _lock:
+        _clients[name] = client
+
+
+def get_llm(cached: bool = True):
+    """テキスト生成用の ChatVertexAI
+
+    cached=False は LLM_CACHE_BACKEND のキャッシュを使わないもの。日記の生成と品質チェックは
+    リトライで同じプロンプトを送るので、キャッシュすると不合格の下書きとスコアが繰り返し返ってしまう。
+    """
+    if not cached:
+        return _get_or_create("vertex_llm_uncached", lambda: get_llm().model_copy(update={"cache": False}))
+
+    from langchain_google_vertexai import ChatVertexAI
+
+    from src import llm_cache
+
+    return _get_or_create(
+        "vertex_llm",
+        lambda: ChatVertexAI(
+            model="gemini-2.0-flash",
+            project=PROJECT_ID,
+            location=REGION,
+            temperature=0.7,
+            cache=llm_cache.llm_cache(),
+            # リトライは src/rate_limiter.py がレート制限と合わせて行う
+            max_retries=0,
+        ),
+    )
+
+
+def get_firestore_client():
+    """Firestore（同期）クライアント"""
+    from google.cloud import firestore
+
+    return _get_or_create("firestore", lambda: firestore.Client(project=PROJECT_ID))
+
+
+def get_genai_client(location: str = "us-central1"):
+    """GenAI (Vertex AI) クライアント（リージョンごとに1つ）"""
+    from google import genai
+
+    return _get_or_create(
+        f"genai:{location}",
+        lambda: genai.Client(vertexai=True, project=PROJECT_ID, location=location),
+    )
+
+
+def get_storage_client():
+    """Cloud Storage クライアント"""
+    from google.cloud import storage
+
+    return _get_or_create("storage", lambda: storage.Client(project=PROJECT_ID))
+
+
+def get_image_bucket():
+    """画像保存用バケット（存在確認は validate_image_bucket で起動時に1回だけ行う）"""
+    return _get_or_create("image_bucket", lambda: get_storage_client().bucket(GCS_BUCKET_NAME))
+
+
+def validate_image_bucket() -> None:
+    """画像保存用バケットの存在を確認し、なければ作成する（起動時に呼ぶ）"""
+    storage_client = get_storage_client()
+    try:
+        bucket = storage_client.bucket(GCS_BUCKET_NAME)
+        if not bucket.exists():
+            bucket = storage_client.create_bucket(GCS_BUCKET_NAME, location=REGION)
+            print(f"Created bucket: {GCS_BUCKET_NAME}")
+        with _lock:
+            _clients["image_bucket"] = bucket
+    except Exception as e:
+        print(f"Bucket access error: {e}")
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """非同期 HTTP クライアント（keep-alive・HTTP/2。h2 は httpx[http2] で入る）"""
+    return _get_or_create(
+        "http_async",
+        lambda: httpx.AsyncClient(http2=True, limits=_http_limits(), timeout=10.0),
+    )
+
+
+def get_sync_http_client() -> httpx.Client:
+    """同期 HTTP クライアント（keep-alive・HTTP/2）"""
+    return _get_or_create(
+        "http_sync",
+        lambda: httpx.Client(http2=True, limits=_http_limits(), timeout=10.0),
+    )
+
+
+def connection_stats() -> dict[str, dict[str, float]]:
+    """クライアントごとの作成・再利用回数"""
+    stats: dict[str, dict[str, float]] = {}
+    for name in list(_clients):
+        stats[name] = {
+            event: metrics.get_value("client_registry_total", client=name, event=event)
+            for event in ("created", "reused")
+        }
+    return stats
+
+
+async def aclose_clients() -> None:
+    """HTTP クライアントを閉じる（シャットダウン時に呼ぶ）"""
+    with _lock:
+        async_client = _clients.pop("http_async", None)
+        sync_client = _clients.pop("http_sync", None)
+    if async_client is not None:
+        await async_client.aclose()
+    if sync_client is not None:
+        sync_client.close()
@@ -0,0 +1,179 @@
+"""
+絵日記のバッチ生成ランナー
+
+夜間のバックフィルや負荷試験で、大量の会話ログからまとめて絵日記を生成します。
+1件ずつ POST /diaries を呼ぶ代わりに、
+
+- pending ドキュメントを Firestore の WriteBatch でまとめて作成する
+- ワークフローを --concurrency 件ずつ並列に実行する（スループットの上限はモデルのクォータ）
+- 結果も WriteBatch でまとめて反映する（--flush-size 件ごと）
+
+入力は fixtures/sample_conversation_logs.json 形式（summary を持つ要約データ）か、
+POST /diaries と同じ {date, transcript} 形式の JSON 配列です。
+
+実行例:
+    # Firestore には書き込まず、結果を JSON Lines で出力
+    uv run python -m src.diary_batch fixtures/sample_conversation_logs.json --concurrency 8 --output out.jsonl
+
+    # diaries コレクションに書き込む
+    uv run python -m src.diary_batch logs.json --firestore --user-id backfill
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import time
+from typing import Awaitable, Callable
+
+DIARY_BATCH_CONCURRENCY = int(os.getenv("DIARY_BATCH_CONCURRENCY", "8"))
+
+
+def to_conversation_log(item: dict) -> dict:
+    """fixtures 形式の要約データを {date, transcript} 形式に変換する"""
+    if "transcript" in item:
+        return {"date": item["date"], "transcript": item["transcript"]}
+
+    date = item.get("date") or datetime.date.today().isoformat()
+    timestamp = int(datetime.datetime.fromisoformat(date).replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+    text = item.get("summary") or "。".join(
+        value for value in (item.get("location"), item.get("activity"), item.get("feeling")) if value
+    )
+    return {"date": date, "transcript": [{"role": "user", "text": text, "timestamp": timestamp}]}
+
+
+def load_conversation_logs(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [to_conversation_log(item) for item in json.load(f)]
+
+
+async def run_batch(
+    items: list[tuple[str, dict]],
+    concurrency: int = DIARY_BATCH_CONCURRENCY,
+    on_result: Callable[[str, dict | None, Exception | None], Awaitable[None]] | None = None,
+) -> dict[str, int]:
+    """(document_id, 会話ログ) のリストを並列数 concurrency でワークフローに流す"""
+    from src.diary_workflow import run_diary_workflow_async
+
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = {"completed": 0, "failed": 0}
+
+    async def run_one(document_id: str, conversation_log: dict):
+        async with semaphore:
+            try:
+                result = await run_diary_workflow_async(document_id, conversation_log)
+                error = None
+            except Exception as e:
+                print(f"Error processing diary {document_id}: {e}")
+                result, error = None, e
+        counts["completed" if error is None and result.get("status") != "failed" else "failed"] += 1
+        if on_result:
+            await on_result(document_id, result, error)
+
+    await asyncio.gather(*(run_one(document_id, log) for document_id, log in items))
+    return counts
+
+
+class _FirestoreSink:
+    """pending ドキュメントの作成と結果の反映を WriteBatch でまとめて行う"""
+
+    def __init__(self, user_id: str, flush_size: int):
+        from src import clients
+        from src.diary_store import FIRESTORE_BATCH_LIMIT
+
+        # API と同じ共有クライアント（接続プール・認証情報を使い回す）
+        self.db = clients.get_firestore_client()
+        self.user_id = user_id
+        self.flush_size = min(flush_size, FIRESTORE_BATCH_LIMIT)
+        self._updates: list[tuple[object, dict]] = []
+
+    def create(self, logs: list[dict]) -> list[str]:
+        from src.diary_store import batch_set, pending_document
+
+        writes = []
+        for log in logs:
+            doc_ref = self.db.collection("diaries").document()
+            writes.append((doc_ref, pending_document(log, self.user_id)))
+        batch_set(self.db, writes)
+        return [doc_ref.id for doc_ref, _ in writes]
+
+    async def on_result(self, document_id: str, result: dict | None, error: Exception | None):
+        from src.diary_store import failed_update, result_update
+
+        update = failed_update(error) if error else result_update(result)
+        self._updates.append((self.db.collection("diaries").document(document_id), update))
+        if len(self._updates) >= self.flush_size:
+            await self.flush()
+
+    async def flush(self):
+        from src.diary_store import batch_update
+
+        updates, self._updates = self._updates, []
+        if updates:
+            await asyncio.to_thread(batch_update, self.db, updates)
+
+
+class _JsonlSink:
+    """結果を JSON Lines で出力する"""
+
+    def __init__(self, path: str | None):
+        self.file = open(path, "w", encoding="utf-8") if path else None
+
+    async def on_result(self, document_id: str, result: dict | None, error: Exception | None):
+        from src.diary_store import failed_update, result_update
+
+        update = failed_update(error) if error else result_update(result)
+        update["id"] = document_id
+        line = json.dumps(update, ensure_ascii=False, default=str)
+        if self.file:
+            self.file.write(line + "\n")
+        else:
+            print(line)
+
+    async def flush(self):
+        if self.file:
+            self.file.close()
+
+
+async def _main(args) -> None:
+    logs = load_conversation_logs(args.input)[: args.limit or None]
+    print(f"Loaded {len(logs)} conversation logs from {args.input}")
+
+    if args.firestore:
+        sink = _FirestoreSink(args.user_id, args.flush_size)
+        started = time.perf_counter()
+        document_ids = await asyncio.to_thread(sink.create, logs)
+        print(f"Created {len(document_ids)} pending diaries in {time.perf_counter() - started:.2f}s")
+    else:
+        sink = _JsonlSink(args.output)
+        document_ids = [f"batch-{i}" for i in range(len(logs))]
+
+    started = time.perf_counter()
+    counts = await run_batch(list(zip(document_ids, logs)), args.concurrency, sink.on_result)
+    await sink.flush()
+    elapsed = time.perf_counter() - started
+
+    from src import clients
+
+    await clients.aclose_clients()
+    print(
+        f"completed={counts['completed']} failed={counts['failed']} "
+        f"elapsed={elapsed:.1f}s throughput={len(logs) / elapsed:.2f} diaries/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="会話ログの JSON 配列")
+    parser.add_argument("--concurrency", type=int, default=DIARY_BATCH_CONCURRENCY)
+    parser.add_argument("--limit", type=int, default=0, help="先頭から処理する件数（0 は全件）")
+    parser.add_argument("--firestore", action="store_true", help="diaries コレクションに書き込む")
+    parser.add_argument("--user-id", default="batch", help="--firestore 時に設定する userId")
+    parser.add_argument("--flush-size", type=int, default=100, help="結果をまとめて書き込む件数")
+    parser.add_argument("--output", help="結果の出力先（JSON Lines。省略時は標準出力）")
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""
+日記の読み取り（GET /diaries・GET /diaries/{id}）
+
+一覧と詳細は DiaryCard の表示に必要なフィールドだけを Firestore から読み出し（select によるプロジェクション）、
+transcriptBlob・usage・Discord の Webhook URL は返しません。
+
+- 一覧は userId ごとに createdAt の新しい順。続きは nextCursor（createdAt とドキュメント ID を
+  base64 にしたもの）を cursor に渡して取得する
+- レスポンスはプロセス内で DIARY_READ_CACHE_TTL_SECONDS だけキャッシュする。ワークフローの完了・失敗と
+  日記の作成時に、その日記と持ち主の一覧のキャッシュを捨てる（他のインスタンスでの更新は TTL で反映される）
+- ETag を付けて返し、If-None-Match が一致すれば 304 を返す（本文を送らない）
+
+Firestore では diaries の (userId, createdAt 降順) の複合インデックスが必要です。
+"""
+
+import base64
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from src import metrics
+
+DIARY_READ_CACHE_TTL_SECONDS = float(os.getenv("DIARY_READ_CACHE_TTL_SECONDS", "30"))
+DIARY_READ_CACHE_MAX_ENTRIES = int(os.getenv("DIARY_READ_CACHE_MAX_ENTRIES", "2000"))
+DIARY_LIST_DEFAULT_LIMIT = int(os.getenv("DIARY_LIST_DEFAULT_LIMIT", "20"))
+DIARY_LIST_MAX_LIMIT = int(os.getenv("DIARY_LIST_MAX_LIMIT", "100"))
+
+# 一覧・詳細で返すフィールド（transcript 関連は含めない）
+DIARY_FIELDS = [
+    "date",
+    "status",
+    "keywords",
+    "diaryText",
+    "imageUrl",
+    "imageRenditions",
+    "error",
+    "discordNotification",
+    "createdAt",
+    "updatedAt",
+]
+
+
+class InvalidCursorError(ValueError):
+    """cursor が壊れている・別の形式"""
+
+
+class CachedBody:
+    """シリアライズ済みのレスポンス本文と ETag"""
+
+    def __init__(self, body: bytes, owner: str, document_ids: list[str]):
+        self.body = body
+        self.etag = 'W/"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        self.owner = owner
+        self.document_ids = document_ids
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """If-None-Match（カンマ区切り・弱い比較）が ETag に一致するか"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # 弱い比較なので W/ の有無は区別しない
+    return _opaque_tag(etag) in {_opaque_tag(tag) for tag in if_none_match.split(",")}
+
+
+def _opaque_tag(tag: str) -> str:
+    return tag.strip().removeprefix("W/")
+
+
+def encode_cursor(created_at: datetime.datetime, document_id: str) -> str:
+    payload = json.dumps({"createdAt": created_at.isoformat(), "id": document_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, str]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        created_at = datetime.datetime.fromisoformat(payload["createdAt"])
+        document_id = payload["id"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise InvalidCursorError("Invalid cursor") from e
+    if not isinstance(document_id, str) or not document_id or "/" in document_id:
+        raise InvalidCursorError("Invalid cursor")
+    return created_at, document_id
+
+
+def serialize(document_id: str, doc_data: dict) -> dict:
+    """プロジェクションしたドキュメントをレスポンスの dict にする"""
+    item = {"id": document_id}
+    for field in DIARY_FIELDS:
+        value = doc_data.get(field)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        item[field] = value
+    return item
+
+
+class DiaryReadCache:
+    """一覧・詳細のレスポンスの短い TTL のキャッシュ（LRU）"""
+
+    def __init__(self, ttl_seconds: float = DIARY_READ_CACHE_TTL_SECONDS, max_entries: int = DIARY_READ_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, CachedBody]] = OrderedDict()
+        # 日記 ID → 持ち主（完了時に持ち主の一覧を捨てるため）
+        self._owners: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def detail_key(document_id: str) -> str:
+        return f"diary:{document_id}"
+
+    @staticmethod
+    def list_key(user_id: str, cursor: str | None, limit: int) -> str:
+        return f"list:{user_id}:{cursor or ''}:{limit}"
+
+    def get(self, key: str) -> CachedBody | None:
+        if self.ttl_seconds <= 0:
+            return None
+        kind = key.split(":", 1)[0]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                metrics.inc("diary_read_cache_total", kind=kind, result="miss")
+                return None
+            self._entries.move_to_end(key)
+        metrics.inc("diary_read_cache_total", kind=kind, result="hit")
+        return entry[1]
+
+    def set(self, key: str, cached: CachedBody) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, cached)
+            self._entries.move_to_end(key)
+            for document_id in cached.document_ids:
+                self._owners[document_id] = cached.owner
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if len(self._owners) > self.max_entries * 10:
+                # 一覧のページ数ぶん増えるので、上限を超えたら古いものから捨てる
+                for document_id in list(self._owners)[: len(self._owners) // 2]:
+                    del self._owners[document_id]
+
+    def invalidate(self, document_id: str, user_id: str | None = None) -> None:
+        """日記の詳細と、持ち主の一覧（全ページ）のキャッシュを捨てる"""
+        with self._lock:
+            self._entries.pop(self.detail_key(document_id), None)
+            owner = self._owners.pop(document_id, None)
+            owner = user_id or owner
+            if owner is not None:
+                self._drop_lists(owner)
+        metrics.inc("diary_read_cache_invalidations_total")
+
+    def invalidate_lists(self, user_id: str) -> None:
+        """持ち主の一覧（全ページ）のキャッシュを捨てる（日記の作成時）"""
+        with self._lock:
+            self._drop_lists(user_id)
+        metrics.inc("diary_read_cache_invalidations_total")
+
+    def _drop_lists(self, user_id: str) -> None:
+        prefix = f"list:{user_id}:"
+        for key in [key for key in self._entries if key.startswith(prefix)]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._owners.clear()
+
+
+read_cache = DiaryReadCache()
+
+
+def list_page(db, user_id: str, limit: int, cursor: str | None) -> tuple[list[dict], str | None]:
+    """持ち主の日記を createdAt の新しい順に1ページ読む（同期。スレッドで呼ぶ）"""
+    from google.cloud.firestore import FieldFilter, Query
+    from google.cloud.firestore_v1.field_path import FieldPath
+
+    collection = db.collection("diaries")
+    # 同じ createdAt の日記があってもページの境目で重複・欠落しないよう、ドキュメント ID も並びに使う
+    query = (
+        collection.where(filter=FieldFilter("userId", "==", user_id))
+        .order_by("createdAt", direction=Query.DESCENDING)
+        .order_by(FieldPath.document_id(), direction=Query.DESCENDING)
+        .select(DIARY_FIELDS)
+    )
+    if cursor:
+        created_at, document_id = decode_cursor(cursor)
+        query = query.start_after([created_at, collection.document(document_id)])
+    # 1件多く読んで、続きがあるかを判定する
+    snapshots = list(query.limit(limit + 1).stream())
+    metrics.inc("diary_read_documents_total", len(snapshots), kind="list")
+
+    items = [serialize(snapshot.id, snapshot.to_dict()) for snapshot in snapshots[:limit]]
+    next_cursor = None
+    if len(snapshots) > limit:
+        last = snapshots[limit - 1]
+        next_cursor = encode_cursor(last.to_dict()["createdAt"], last.id)
+    return items, next_cursor
+
+
+def get_diary(db, document_id: str, user_id: str) -> dict | None:
+    """持ち主の日記を1件読む。存在しない・他人の日記なら None（同期。スレッドで呼ぶ）"""
+    snapshot = db.collection("diaries").document(document_id).get(field_paths=DIARY_FIELDS + ["userId"])
+    metrics.inc("diary_read_documents_total", kind="detail")
+    if not snapshot.exists:
+        return None
+    doc_data = snapshot.to_dict()
+    if doc_data.get("userId") != user_id:
+        return None
+    return serialize(document_id, doc_data)
@@ -0,0 +1,315 @@
+"""
+diaries コレクションへの書き込み
+
+絵日記ドキュメントの作成・結果の反映に使うデータの組み立てと、
+Firestore の WriteBatch を使ったまとめ書きを提供します。
+POST /diaries、POST /diaries:batch、バッチランナーで共有します。
+
+DiaryWriter は非同期 Firestore クライアントを使う write-behind 層です。
+- 同じドキュメントへの未送信の書き込みは1つにまとめる（processing → completed なら1回）
+- FIRESTORE_WRITE_LINGER_MS だけ待って、最大 FIRESTORE_WRITE_BATCH_SIZE 件を1回のバッチで送る
+- 競合・一時的なエラーは指数バックオフでリトライする
+- write() の戻り値を await すると、その書き込みが永続化されるまで待てる
+
+transcript は配列のままではなく、JSON を zlib で圧縮した1つのバイト列（transcriptBlob）として保存します。
+エントリ数の多い会話でもドキュメントが Firestore の上限（1 MiB）に近づかず、読み出しも軽くなります。
+"""
+
+import asyncio
+import datetime
+import os
+import random
+import zlib
+
+from google.api_core import exceptions as gexc
+from pydantic import TypeAdapter
+
+from src import metrics
+from src.models import TranscriptEntry
+
+# Firestore の WriteBatch 1回あたりの書き込み上限
+FIRESTORE_BATCH_LIMIT = 500
+
+FIRESTORE_WRITE_BATCH_SIZE = min(int(os.getenv("FIRESTORE_WRITE_BATCH_SIZE", "100")), FIRESTORE_BATCH_LIMIT)
+FIRESTORE_WRITE_LINGER_MS = float(os.getenv("FIRESTORE_WRITE_LINGER_MS", "20"))
+FIRESTORE_WRITE_MAX_RETRIES = int(os.getenv("FIRESTORE_WRITE_MAX_RETRIES", "5"))
+
+# transcriptBlob の上限（ドキュメントの他のフィールドの分を空けておく）
+TRANSCRIPT_BLOB_MAX_BYTES = int(os.getenv("TRANSCRIPT_BLOB_MAX_BYTES", str(768 * 1024)))
+TRANSCRIPT_ENCODING = "json+zlib"
+
+_transcript_adapter = TypeAdapter(list[TranscriptEntry])
+
+# リトライすれば成功しうるエラー
+RETRYABLE_ERRORS = (
+    gexc.Aborted,
+    gexc.DeadlineExceeded,
+    gexc.InternalServerError,
+    gexc.ResourceExhausted,
+    gexc.ServiceUnavailable,
+)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class TranscriptTooLargeError(ValueError):
+    """圧縮しても transcript が TRANSCRIPT_BLOB_MAX_BYTES に収まらない"""
+
+
+def encode_transcript(transcript: list[dict]) -> bytes:
+    """transcript を圧縮したバイト列にする"""
+    blob = zlib.compress(_transcript_adapter.dump_json(transcript), 6)
+    if len(blob) > TRANSCRIPT_BLOB_MAX_BYTES:
+        raise TranscriptTooLargeError(f"Transcript too large ({len(blob)} bytes compressed)")
+    return blob
+
+
+def decode_transcript(doc_data: dict) -> list[dict]:
+    """日記ドキュメントから transcript を取り出す（配列で保存された古いドキュメントにも対応）"""
+    if doc_data.get("transcriptBlob") is not None:
+        return _transcript_adapter.validate_json(zlib.decompress(doc_data["transcriptBlob"]))
+    return doc_data.get("transcript") or []
+
+
+def pending_document(request_data: dict, user_id: str) -> dict:
+    """作成時（pending）の日記ドキュメント"""
+    doc_data = {key: value for key, value in request_data.items() if key != "transcript"}
+    if "transcript" in request_data:
+        blob = encode_transcript(request_data["transcript"])
+        doc_data.update(
+            {
+                "transcriptBlob": blob,
+                "transcriptEncoding": TRANSCRIPT_ENCODING,
+                "transcriptEntries": len(request_data["transcript"]),
+            }
+        )
+        metrics.inc("transcript_blob_bytes_total", len(blob))
+    doc_data.update(
+        {
+            "userId": user_id,
+            "status": "pending",  # 待機中
+            "createdAt": _now(),
+            "updatedAt": _now(),
+        }
+    )
+    return doc_data
+
+
+def image_reuse_user(doc_data: dict) -> str | None:
+    """画像の再利用を許可しているなら持ち主のユーザー ID（imageReuse=false なら None）"""
+    return doc_data.get("userId") if doc_data.get("imageReuse", True) else None
+
+
+def result_update(result: dict) -> dict:
+    """ワークフロー結果から Firestore の更新内容を作る"""
+    update_data = {
+        "status": result.get("status", "completed"),
+        "keywords": result.get("keywords"),
+        "diaryText": result.get("diary_text"),
+        "imageUrl": result.get("image_url"),
+        "imageRenditions": result.get("image_renditions"),
+        "updatedAt": _now(),
+    }
+    if result.get("trace_id"):
+        update_data["traceId"] = result["trace_id"]
+    if result.get("usage"):
+        # ノードごとの実行時間・リトライ回数と推定コスト
+        update_data["usage"] = result["usage"]
+    if result.get("error"):
+        update_data["error"] = result["error"]
+    return update_data
+
+
+def failed_update(error: Exception | str) -> dict:
+    return {
+        "status": "failed",
+        "error": str(error),
+        "updatedAt": _now(),
+    }
+
+
+def _chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def batch_set(db, writes: list[tuple[object, dict]]) -> None:
+    """(DocumentReference, データ) を WriteBatch でまとめて作成する"""
+    for chunk in _chunks(writes, FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for doc_ref, data in chunk:
+            batch.set(doc_ref, data)
+        batch.commit()
+
+
+def batch_update(db, updates: list[tuple[object, dict]]) -> None:
+    """(DocumentReference, 更新内容) を WriteBatch でまとめて更新する"""
+    for chunk in _chunks(updates, FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for doc_ref, data in chunk:
+            batch.update(doc_ref, data)
+        batch.commit()
+
+
+class _PendingWrite:
+    def __init__(self, op: str, data: dict):
+        self.op = op  # "set" or "update"
+        self.data = data
+        self.futures: list[asyncio.Future] = []
+
+    def merge(self, op: str, data: dict) -> None:
+        if op == "set":
+            self.op, self.data = "set", dict(data)
+        else:
+            # set の後の update は set の内容に重ねる
+            self.data.update(data)
+        metrics.inc("firestore_writes_coalesced_total")
+
+
+class DiaryWriter:
+    """diaries コレクションへの write-behind ライター"""
+
+    def __init__(
+        self,
+        project: str | None = None,
+        collection: str = "diaries",
+        batch_size: int = FIRESTORE_WRITE_BATCH_SIZE,
+        linger_ms: float = FIRESTORE_WRITE_LINGER_MS,
+        max_retries: int = FIRESTORE_WRITE_MAX_RETRIES,
+    ):
+        self.project = project
+        self.collection = collection
+        self.batch_size = batch_size
+        self.linger = linger_ms / 1000
+        self.max_retries = max_retries
+        self.client = None
+        self._pending: dict[str, _PendingWrite] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    def _ensure_started(self) -> None:
+        if self.client is None:
+            from google.cloud import firestore
+
+            self.client = firestore.AsyncClient(project=self.project)
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    def write(self, document_id: str, data: dict, op: str = "update") -> asyncio.Future:
+        """書き込みを予約する。戻り値を await すると永続化（または失敗）まで待つ"""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending.get(document_id)
+        if pending is None:
+            pending = self._pending[document_id] = _PendingWrite(op, dict(data))
+        else:
+            pending.merge(op, data)
+        pending.futures.append(future)
+        metrics.set_gauge("firestore_write_pending", len(self._pending))
+        self._wakeup.set()
+        return future
+
+    def set(self, document_id: str, data: dict) -> asyncio.Future:
+        return self.write(document_id, data, op="set")
+
+    def update(self, document_id: str, data: dict) -> asyncio.Future:
+        return self.write(document_id, data, op="update")
+
+    async def _run(self) -> None:
+        while not (self._stopping and not self._pending):
+            if not self._pending:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            # 少し待って、同じドキュメントへの後続の書き込みや他のドキュメントをまとめる
+            if not self._stopping and len(self._pending) < self.batch_size:
+                await asyncio.sleep(self.linger)
+            await self._flush_once()
+
+    def _take_batch(self) -> dict[str, _PendingWrite]:
+        batch = {}
+        for document_id in list(self._pending)[: self.batch_size]:
+            batch[document_id] = self._pending.pop(document_id)
+        metrics.set_gauge("firestore_write_pending", len(self._pending))
+        return batch
+
+    async def _commit(self, writes: dict[str, _PendingWrite]) -> None:
+        batch = self.client.batch()
+        for document_id, pending in writes.items():
+            doc_ref = self.client.collection(self.collection).document(document_id)
+            if pending.op == "set":
+                batch.set(doc_ref, pending.data)
+            else:
+                batch.update(doc_ref, pending.data)
+        await batch.commit()
+        metrics.inc("firestore_write_batches_total")
+        metrics.inc("firestore_writes_total", len(writes))
+
+    async def _commit_with_retry(self, writes: dict[str, _PendingWrite]) -> None:
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._commit(writes)
+                return
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(0.1 * 2**attempt, 5.0) * (0.5 + random.random())
+                print(f"Firestore batch write failed ({e}), retrying in {delay:.2f}s")
+                metrics.inc("firestore_write_retries_total")
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _resolve(pending: _PendingWrite, error: Exception | None) -> None:
+        for future in pending.futures:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+                # 待っている呼び出しがなければ例外を取り出して警告を抑える
+                future.exception()
+
+    async def _flush_once(self) -> None:
+        writes = self._take_batch()
+        try:
+            await self._commit_with_retry(writes)
+        except Exception as e:
+            if len(writes) == 1:
+                print(f"Firestore write failed: {e}")
+                metrics.inc("firestore_write_failures_total")
+                for pending in writes.values():
+                    self._resolve(pending, e)
+                return
+            # バッチはアトミックなので、1件の失敗（存在しないドキュメントの update など）が
+            # 他を巻き込まないよう1件ずつ送り直す
+            for document_id, pending in writes.items():
+                try:
+                    await self._commit_with_retry({document_id: pending})
+                    self._resolve(pending, None)
+                except Exception as single_error:
+                    print(f"Firestore write to {document_id} failed: {single_error}")
+                    metrics.inc("firestore_write_failures_total")
+                    self._resolve(pending, single_error)
+            return
+        for pending in writes.values():
+            self._resolve(pending, None)
+
+    async def flush(self) -> None:
+        """予約済みの書き込みをすべて送る"""
+        while self._pending:
+            await self._flush_once()
+
+    async def stop(self) -> None:
+        """残りの書き込みを送ってから停止する（シャットダウン時に呼ぶ）"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        if self.client is not None:
+            self.client.close()
@@ -2,30 +2,67 @@
 絵日記生成ワークフロー (LangGraph)
 
 会話ログを入力として、以下のステップで絵日記を生成します:
+0. 会話ログの圧縮とトークン予算の適用（src/transcript.py。長い会話は前半を要約）
 1. キーワード抽出 (Gemini)
 2. 日記文章生成 (Gemini)
 3. 品質チェック (Gemini) -> NG なら 2 に戻る
 4. 画像生成 (Imagen 3)
 5. Firestore 保存
+
+ノードが完了するたびに document_id をスレッド ID としてチェックポイントを保存します（src/checkpoints.py）。
+同じ document_id で再実行すると、最後に完了したノードの次から再開します。
+
+DIARY_WORKFLOW_MODE=single_shot の場合は 1〜3 と画像用の英訳を1回の構造化出力で行い、
+失敗したときだけ上記の通常フローに戻ります。
 """
 
-import json
+import asyncio
 import os
-from typing import TypedDict
+from typing import Callable, TypedDict
 
-from langchain_google_vertexai import ChatVertexAI
 from langgraph.graph import END, START, StateGraph
+from pydantic import BaseModel, Field
+
+from src import (
+    checkpoints,
+    clients,
+    image_renditions,
+    image_semantic_cache,
+    llm_cache,
+    metrics,
+    quality_prescore,
+    tracing,
+    transcript,
+)
+from src.llm_output import ainvoke_structured, record_fallback
+from src.rate_limiter import PRIORITY_IMAGE, get_limiter, limiter_for_llm
+from src.region_pool import RegionPool
+from src.transcript import format_transcript
 
 # Gemini モデルの初期化
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "enikki-cloud")
 REGION = os.getenv("GCP_REGION", "asia-northeast1")
 
-llm = ChatVertexAI(
-    model="gemini-2.0-flash",
-    project=PROJECT_ID,
-    location=REGION,
-    temperature=0.7,
-)
+# 品質チェックの合格ライン
+QUALITY_THRESHOLD = 0.6
+
+# 投機実行モード（非同期ワークフローのみ）
+# off: 逐次実行 / translate: 品質チェックと並行して英訳 / image: 英訳に加えて画像生成も並行
+DIARY_SPECULATION = os.getenv("DIARY_SPECULATION", "translate")
+
+# ワークフローモード
+# graph: ノードごとに LLM を呼ぶ / single_shot: 1回の構造化出力で済ませ、失敗時のみ graph に戻る
+DIARY_WORKFLOW_MODE = os.getenv("DIARY_WORKFLOW_MODE", "graph")
+
+llm = clients.get_llm()
+# 日記の生成・品質チェック・single_shot は同じプロンプトでも毎回生成し直す（リトライで別の下書きにするため）
+generation_llm = clients.get_llm(cached=False)
+
+IMAGE_MODEL = "gemini-2.5-flash-image"
+# 画像生成に使うリージョン（Gemini 2.5 Flash Image が利用可能なもの。カンマ区切り）
+IMAGE_REGIONS = [r.strip() for r in os.getenv("IMAGE_REGIONS", "us-central1").split(",") if r.strip()]
+IMAGE_HEDGING = os.getenv("IMAGE_HEDGING", "true").lower() == "true"
+IMAGE_ASPECT_RATIO = "1:1"
 
 
 class DiaryState(TypedDict):
@@ -33,43 +70,98 @@ class DiaryState(TypedDict):
 
     document_id: str  # Firestore ドキュメント ID
     conversation_log: dict  # 入力: 会話ログ（report_diary_event の引数）
+    transcript_text: str | None  # 圧縮・トークン予算適用済みの会話テキスト（prepare_transcript で1回だけ作る）
     keywords: list[str] | None  # 抽出されたキーワード
     diary_text: str | None  # 生成された日記テキスト
     quality_score: float | None  # 品質スコア (0.0 - 1.0)
     retry_count: int  # リトライ回数
     image_url: str | None  # 生成された画像の URL
+    image_renditions: dict[str, str] | None  # レンディション名 -> URL（original / avif / webp / thumbnail / discord）
     status: str  # pending / processing / completed / failed
     error: str | None  # エラーメッセージ
-    discord_webhook_url: str | None  # ユーザー設定の Discord Webhook URL
+    # 投機実行の結果（品質チェックに合格した下書きに対してのみ保持する）
+    speculative_for: str | None  # 投機実行の対象となった日記テキスト
+    scene_desc: str | None  # 英訳済みのシーン説明
+    scene_elements: str | None  # 英訳済みの主要な要素
+    speculative_image: bytes | None  # 生成済みの画像データ
+    image_reuse_user: str | None  # 似た場面の画像を再利用してよい持ち主（オプトアウトなら None）
+    trace_id: str | None  # 計測のトレース ID（src/tracing.py）
+
+
+# --- 構造化出力のスキーマ ---
 
 
-# --- ヘルパー関数 ---
+class KeywordsOutput(BaseModel):
+    """extract_keywords の出力"""
 
+    keywords: list[str] = Field(description="絵に描きやすい重要なキーワード4つ", min_length=1)
 
-def format_transcript(transcript: list[dict] | None) -> str:
-    """transcript を読みやすいテキスト形式に変換する"""
-    if not transcript:
-        return ""
 
-    lines = []
-    for entry in transcript:
-        role_label = "ユーザー" if entry.get("role") == "user" else "AI"
-        text = entry.get("text", "").strip()
-        if text:
-            lines.append(f"{role_label}: {text}")
+class QualityOutput(BaseModel):
+    """check_quality の出力"""
 
-    return "\n".join(lines)
+    score: float = Field(description="総合スコア", ge=0.0, le=1.0)
+
+
+class TranslationOutput(BaseModel):
+    """画像生成用の英訳"""
+
+    scene: str = Field(description="English description of the scene")
+    elements: str = Field(description="key visual elements")
 
 
 # --- ノード定義 ---
 
 
-def extract_keywords(state: DiaryState) -> dict:
-    """会話ログから4つのキーワードを抽出"""
-    log = state["conversation_log"]
-    transcript_text = format_transcript(log.get("transcript"))
+def _transcript_summary_prompt(older: list[dict]) -> str:
+    return f"""以下はユーザーとAIインタビュアーの会話の前半です。
+絵日記を書くための材料として、ユーザーが話した出来事・場所・人・食べ物・気持ちを漏らさず、
+{transcript.TRANSCRIPT_SUMMARY_MAX_TOKENS}文字以内で要約してください。要約のみを出力してください。
+
+{transcript.summary_source(older)}
+"""
+
+
+def _compact_transcript(state: DiaryState) -> tuple[list[dict], list[dict]]:
+    """会話ログを圧縮し、(要約するターン, そのまま残すターン) に分ける"""
+    raw = state["conversation_log"].get("transcript")
+    turns = transcript.compact(raw)
+    for stage, entries in (("raw", raw), ("compacted", turns)):
+        tokens = transcript.estimate_tokens(format_transcript(entries))
+        metrics.observe("transcript_tokens", tokens, tracing.TOKEN_BUCKETS, stage=stage)
+    return transcript.split_for_budget(turns)
+
+
+def _prepared_transcript(older: list[dict], recent: list[dict], summary: str | None) -> dict:
+    text = transcript.render(recent, older=older, summary=summary)
+    metrics.observe("transcript_tokens", transcript.estimate_tokens(text), tracing.TOKEN_BUCKETS, stage="prompt")
+    return {"transcript_text": text}
 
-    prompt = f"""以下の会話の全文から、絵日記に使う重要な4つのキーワードを抽出してください。
+
+async def aprepare_transcript(state: DiaryState) -> dict:
+    """会話ログを圧縮してトークン予算に収め、以降のノードで使う会話テキストを作る"""
+    older, recent = _compact_transcript(state)
+    summary = None
+    if older and transcript.TRANSCRIPT_SUMMARY_ENABLED:
+        prompt = _transcript_summary_prompt(older)
+        try:
+            response = await limiter_for_llm(llm).call(lambda: llm.ainvoke(prompt))
+            tracing.record_llm_usage(llm.model_name, response)
+            summary = response.content.strip()
+        except Exception as e:
+            record_fallback("prepare_transcript", e)
+    return _prepared_transcript(older, recent, summary)
+
+
+def _transcript_text(state: DiaryState) -> str:
+    """prepare_transcript の結果（なければ会話ログをそのまま整形する）"""
+    if state.get("transcript_text") is not None:
+        return state["transcript_text"]
+    return format_transcript(state["conversation_log"].get("transcript"))
+
+
+def _keywords_prompt(log: dict, transcript_text: str) -> str:
+    return f"""以下の会話の全文から、絵日記に使う重要な4つのキーワードを抽出してください。
 キーワードは名詞や動詞など、絵に描きやすいものを選んでください。
 
 会話全文:
@@ -77,44 +169,28 @@ def extract_keywords(state: DiaryState) -> dict:
 
 日付: {log.get("date", "不明")}
 
-JSON形式で出力してください（キーワードの配列のみ）:
-["キーワード1", "キーワード2", "キーワード3", "キーワード4"]
+JSON形式で出力してください:
+{{"keywords": ["キーワード1", "キーワード2", "キーワード3", "キーワード4"]}}
 """
 
-    try:
-        response = llm.invoke(prompt)
-        content = response.content.strip()
-        # JSON部分を抽出
-        if "```json" in content:
-            content = content.split("```json")[1].split("```")[0].strip()
-        elif "```" in content:
-            content = content.split("```")[1].split("```")[0].strip()
-        keywords = json.loads(content)
-        return {"keywords": keywords[:4], "status": "processing"}
-    except Exception as e:
-        print(f"Error extracting keywords: {e}")
-        # フォールバック
-        return {"keywords": ["今日", "楽しい", "おでかけ", "きもち"], "status": "processing"}
-
 
-def generate_diary(state: DiaryState) -> dict:
-    """キーワードと transcript を元に絵日記テキストを生成"""
-    keywords = state.get("keywords", [])
-    log = state["conversation_log"]
-    transcript_text = format_transcript(log.get("transcript"))
+KEYWORDS_FALLBACK = ["今日", "楽しい", "おでかけ", "きもち"]
 
-    prompt = f"""以下の情報を元に、小学生が書くような「ぼくの夏休み」風の絵日記テキストを生成してください。
-ただし、実際の読者は大人なので、大人がクスッと笑える要素を入れてください。
 
-## 会話全文（最も重要な情報源）
-以下はユーザーとAIインタビュアーの会話全文です。この内容を元に、ユーザーが実際に話した体験やエピソードを忠実に反映してください。
+async def aextract_keywords(state: DiaryState) -> dict:
+    """会話ログから4つのキーワードを抽出"""
+    prompt = _keywords_prompt(state["conversation_log"], _transcript_text(state))
 
-{transcript_text}
+    try:
+        result = await ainvoke_structured(llm, prompt, KeywordsOutput, node="extract_keywords")
+        return {"keywords": result.keywords[:4], "status": "processing"}
+    except Exception as e:
+        record_fallback("extract_keywords", e)
+        return {"keywords": KEYWORDS_FALLBACK, "status": "processing"}
 
-## 抽出済みキーワード
-{", ".join(keywords)}
 
-## ルール
+# 日記本文のルールと例（generate_diary / single_shot で共通）
+DIARY_GUIDE = """## ルール
 - 100〜150文字程度
 - 子供らしい素直な文体（ですます調ではなく、だ・である調やカジュアルな表現）
 - 「今日は〜」で始める
@@ -148,27 +224,45 @@ def generate_diary(state: DiaryState) -> dict:
 - 「公園は入場料がタダ。すごい」
 - 「昼寝は人生のごほうび」
 - 「おばあちゃんの料理はやっぱりちがう」
+"""
+
+
+def _diary_prompt(keywords: list[str], transcript_text: str) -> str:
+    return f"""以下の情報を元に、小学生が書くような「ぼくの夏休み」風の絵日記テキストを生成してください。
+ただし、実際の読者は大人なので、大人がクスッと笑える要素を入れてください。
+
+## 会話全文（最も重要な情報源）
+以下はユーザーとAIインタビュアーの会話全文です。この内容を元に、ユーザーが実際に話した体験やエピソードを忠実に反映してください。
+
+{transcript_text}
 
+## 抽出済みキーワード
+{", ".join(keywords)}
+
+{DIARY_GUIDE}
 ## 出力
 絵日記テキストのみを出力してください（説明や注釈は不要）:
 """
 
+
+DIARY_FALLBACK = "今日はたのしい一日だった。またあしたあそびたい。"
+
+
+async def agenerate_diary(state: DiaryState) -> dict:
+    """キーワードと transcript を元に絵日記テキストを生成"""
+    prompt = _diary_prompt(state.get("keywords") or [], _transcript_text(state))
+
     try:
-        response = llm.invoke(prompt)
-        diary_text = response.content.strip()
-        return {"diary_text": diary_text}
+        response = await limiter_for_llm(generation_llm).call(lambda: generation_llm.ainvoke(prompt))
+        tracing.record_llm_usage(generation_llm.model_name, response)
+        return {"diary_text": response.content.strip()}
     except Exception as e:
-        print(f"Error generating diary: {e}")
-        # フォールバック
-        diary_text = "今日はたのしい一日だった。またあしたあそびたい。"
-        return {"diary_text": diary_text}
+        record_fallback("generate_diary", e)
+        return {"diary_text": DIARY_FALLBACK}
 
 
-def check_quality(state: DiaryState) -> dict:
-    """生成された日記の品質をチェック"""
-    diary_text = state.get("diary_text", "")
-
-    prompt = f"""以下の絵日記テキストを評価してください。
+def _quality_prompt(diary_text: str) -> str:
+    return f"""以下の絵日記テキストを評価してください。
 
 テキスト:
 {diary_text}
@@ -183,21 +277,101 @@ JSON形式で総合スコア（0.0-1.0）のみを出力:
 {{"score": 0.8}}
 """
 
+
+QUALITY_FALLBACK = 0.8
+
+
+def _local_quality_score(prescore: quality_prescore.Prescore) -> float:
+    """ローカルの判定を品質スコアにする（合格なら合格ライン以上、不合格なら未満にそろえる）"""
+    if prescore.decision == "accept":
+        return max(prescore.score, QUALITY_THRESHOLD)
+    return min(prescore.score, QUALITY_THRESHOLD - 0.01)
+
+
+async def acheck_quality(state: DiaryState) -> dict:
+    """生成された日記の品質をチェック（明らかな合格・不合格はローカルのスコアで決め、LLM を呼ばない）"""
+    diary_text = state.get("diary_text", "")
+    prescore = quality_prescore.evaluate(diary_text)
+    if quality_prescore.is_decisive(prescore):
+        return {"quality_score": _local_quality_score(prescore)}
+
+    prompt = _quality_prompt(diary_text)
     try:
-        response = llm.invoke(prompt)
-        content = response.content.strip()
-        # JSON部分を抽出
-        if "```json" in content:
-            content = content.split("```json")[1].split("```")[0].strip()
-        elif "```" in content:
-            content = content.split("```")[1].split("```")[0].strip()
-        result = json.loads(content)
-        score = result.get("score", 0.8)
-        return {"quality_score": score}
+        result = await ainvoke_structured(generation_llm, prompt, QualityOutput, node="check_quality")
+        quality_prescore.record_agreement(prescore, result.score, QUALITY_THRESHOLD)
+        return {"quality_score": result.score}
     except Exception as e:
-        print(f"Error checking quality: {e}")
-        # フォールバック: 合格扱い
-        return {"quality_score": 0.8}
+        record_fallback("check_quality", e)
+        return {"quality_score": QUALITY_FALLBACK}
+
+
+class SingleShotDiary(BaseModel):
+    """single_shot モードの構造化出力"""
+
+    keywords: list[str] = Field(description="絵に描きやすい重要なキーワード4つ", min_length=1)
+    diary_text: str = Field(description="絵日記テキスト", min_length=1)
+    quality_score: float = Field(description="評価基準に基づく自己評価の総合スコア", ge=0.0, le=1.0)
+    scene: str = Field(description="English description of the diary scene for image generation")
+    elements: str = Field(description="Key visual elements in English")
+
+
+def _single_shot_prompt(log: dict, transcript_text: str) -> str:
+    return f"""以下の会話から、小学生が書くような「ぼくの夏休み」風の絵日記を作成してください。
+ただし、実際の読者は大人なので、大人がクスッと笑える要素を入れてください。
+
+## 会話全文（最も重要な情報源）
+以下はユーザーとAIインタビュアーの会話全文です。この内容を元に、ユーザーが実際に話した体験やエピソードを忠実に反映してください。
+
+{transcript_text}
+
+日付: {log.get("date", "不明")}
+
+{DIARY_GUIDE}
+## 出力項目
+- keywords: 会話から抽出した、絵に描きやすい重要なキーワード4つ（名詞や動詞など）
+- diary_text: 上記ルールに従った絵日記テキスト
+- quality_score: diary_text を以下の基準で自己評価した総合スコア (0.0-1.0)
+  1. 子供らしい文体か / 2. 感情表現があるか / 3. 100-200文字程度か / 4. 絵日記として自然か
+- scene: diary_text の場面を画像生成用に英訳した簡潔な説明（英語）
+- elements: 絵に描く主要な要素（英語）
+"""
+
+
+def _single_shot_update(result: SingleShotDiary) -> dict:
+    """構造化出力を状態に反映する（英訳も済んでいるので画像生成で再利用する）"""
+    return {
+        "keywords": result.keywords[:4],
+        "diary_text": result.diary_text.strip(),
+        "quality_score": result.quality_score,
+        "speculative_for": result.diary_text.strip(),
+        "scene_desc": result.scene,
+        "scene_elements": result.elements,
+        "status": "processing",
+    }
+
+
+async def asingle_shot(state: DiaryState) -> dict:
+    """キーワード抽出・日記生成・自己評価・英訳を1回の LLM 呼び出しで行う"""
+    prompt = _single_shot_prompt(state["conversation_log"], _transcript_text(state))
+
+    try:
+        result = await ainvoke_structured(generation_llm, prompt, SingleShotDiary, node="single_shot")
+        return _single_shot_update(result)
+    except Exception as e:
+        record_fallback("single_shot", e)
+        return {"status": "processing"}
+
+
+def route_single_shot(state: DiaryState) -> str:
+    """single_shot の結果が使えれば画像生成へ、使えなければ通常のグラフへ"""
+    if not state.get("diary_text"):
+        metrics.inc("diary_single_shot_total", outcome="invalid")
+        return "extract_keywords"
+    if (state.get("quality_score") or 0.0) < QUALITY_THRESHOLD:
+        metrics.inc("diary_single_shot_total", outcome="low_score")
+        return "extract_keywords"
+    metrics.inc("diary_single_shot_total", outcome="accepted")
+    return "generate_image"
 
 
 def should_retry(state: DiaryState) -> str:
@@ -205,7 +379,7 @@ def should_retry(state: DiaryState) -> str:
     quality_score = state.get("quality_score", 0.0)
     retry_count = state.get("retry_count", 0)
 
-    if quality_score >= 0.6:
+    if quality_score >= QUALITY_THRESHOLD:
         return "generate_image"
     elif retry_count < 3:
         return "generate_diary"
@@ -218,21 +392,12 @@ def increment_retry(state: DiaryState) -> dict:
     return {"retry_count": state.get("retry_count", 0) + 1}
 
 
-def generate_image(state: DiaryState) -> dict:
-    """絵日記用の画像を生成 (Gemini 2.5 Flash Image)"""
-    import uuid
-    from io import BytesIO
-    from google.cloud import storage
-    from google import genai
-    from google.genai import types
+PLACEHOLDER_IMAGE_URL = "https://images.unsplash.com/photo-1516934024742-b461fba47600?w=800&auto=format&fit=crop&q=60"
 
-    diary_text = state.get("diary_text", "")
-    keywords = state.get("keywords", [])
-    document_id = state.get("document_id", "unknown")
-    log = state["conversation_log"]
 
-    # 日本語を英語に翻訳（Gemini を使用）
-    translate_prompt = f"""Translate the following Japanese text to English for image generation.
+def _translate_prompt(keywords: list[str], diary_text: str) -> str:
+    """日本語を英語に翻訳するプロンプト（画像生成用）"""
+    return f"""Translate the following Japanese text to English for image generation.
 Keep it simple and descriptive.
 
 Keywords: {", ".join(keywords)}
@@ -242,27 +407,13 @@ Output format (JSON):
 {{"scene": "English description of the scene", "elements": "key visual elements"}}
 """
 
-    try:
-        translate_response = llm.invoke(translate_prompt)
-        translate_content = translate_response.content.strip()
-        if "```json" in translate_content:
-            translate_content = (
-                translate_content.split("```json")[1].split("```")[0].strip()
-            )
-        elif "```" in translate_content:
-            translate_content = (
-                translate_content.split("```")[1].split("```")[0].strip()
-            )
-        translated = json.loads(translate_content)
-        scene_desc = translated.get("scene", "a happy day")
-        elements = translated.get("elements", "sunshine, nature")
-    except Exception as e:
-        print(f"Translation error: {e}")
-        scene_desc = "a happy day at home"
-        elements = "warm atmosphere, family"
 
-    # 画像生成プロンプト（英語に翻訳済み）
-    prompt = f"""Create an image that looks like it was drawn by a 10-year-old child with crayons.
+TRANSLATION_FALLBACK = ("a happy day at home", "warm atmosphere, family")
+
+
+def _image_prompt(scene_desc: str, elements: str) -> str:
+    """画像生成プロンプト（英語に翻訳済み）"""
+    return f"""Create an image that looks like it was drawn by a 10-year-old child with crayons.
 Theme: {scene_desc}
 Key elements: {elements}
 Style: Colorful, cheerful, simple shapes, crayon-like texture, picture diary style.
@@ -276,74 +427,182 @@ Style requirements:
 
 IMPORTANT: Do NOT include any text, letters, numbers, or written words in the image."""
 
+
+# 画像生成リクエストをリージョン間で振り分ける
+image_region_pool = RegionPool("image", IMAGE_REGIONS, hedge=IMAGE_HEDGING)
+
+
+def _image_client(region: str):
+    """Gemini 2.5 Flash Image クライアント（リージョンごと）"""
+    return clients.get_genai_client(region)
+
+
+def _image_config():
+    from google.genai import types
+
+    return types.GenerateContentConfig(
+        response_modalities=["IMAGE"],
+        image_config=types.ImageConfig(
+            aspect_ratio=IMAGE_ASPECT_RATIO,
+        ),
+    )
+
+
+def _extract_image_data(response) -> bytes | None:
+    """レスポンスから画像を取得"""
+    for part in response.parts:
+        if part.inline_data:
+            print(f"Image generated! MIME type: {part.inline_data.mime_type}")
+            # inline_data.data から直接バイトデータを取得
+            return part.inline_data.data
+    return None
+
+
+def _upload_image(document_id: str, image_data: bytes) -> dict:
+    """画像のレンディションを作成して Cloud Storage にアップロードし、状態の更新内容を返す"""
+    # バケットの存在確認は起動時に済ませている (clients.validate_image_bucket)
+    bucket = clients.get_image_bucket()
+
+    renditions = image_renditions.upload_renditions(bucket, document_id, image_data)
+    return {"image_url": image_renditions.primary_url(renditions), "image_renditions": renditions}
+
+
+async def _atranslate_scene(keywords: list[str], diary_text: str) -> tuple[str, str]:
+    """日記を画像生成用に英訳する（失敗時はフォールバック）"""
     try:
-        # Gemini 2.5 Flash Image クライアント作成
-        # us-central1 で利用可能
-        client = genai.Client(
-            vertexai=True,
-            project=PROJECT_ID,
-            location="us-central1"
+        translated = await ainvoke_structured(
+            llm,
+            _translate_prompt(keywords, diary_text),
+            TranslationOutput,
+            node="translate_scene",
+            priority=PRIORITY_IMAGE,
         )
-
-        # 画像生成
-        print(f"Generating image with Gemini 2.5 Flash Image: {prompt[:100]}...")
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-image",
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                response_modalities=["IMAGE"],
-                image_config=types.ImageConfig(
-                    aspect_ratio="1:1",
-                ),
-            ),
+        return translated.scene, translated.elements
+    except Exception as e:
+        record_fallback("translate_scene", e)
+        return TRANSLATION_FALLBACK
+
+
+async def _agenerate_image_data(scene_desc: str, elements: str) -> bytes | None:
+    """英訳済みのシーンから画像を生成する（同じプロンプトの結果はキャッシュを使う）"""
+    prompt = _image_prompt(scene_desc, elements)
+    key = llm_cache.image_cache_key(IMAGE_MODEL, prompt, IMAGE_ASPECT_RATIO)
+    cached = await llm_cache.aget_image(key)
+    if cached:
+        print("Image cache hit")
+        return cached
+
+    async def generate(region: str):
+        client = _image_client(region)
+        return await get_limiter(IMAGE_MODEL, region).call(
+            lambda: client.aio.models.generate_content(model=IMAGE_MODEL, contents=prompt, config=_image_config()),
+            PRIORITY_IMAGE,
         )
 
-        # レスポンスから画像を取得
-        image_data = None
-        for part in response.parts:
-            if part.inline_data:
-                print(f"Image generated! MIME type: {part.inline_data.mime_type}")
-                # inline_data.data から直接バイトデータを取得
-                image_data = part.inline_data.data
-                break
+    # 遅いリージョンにはヘッジを送り、先に返った結果を使う
+    print(f"Generating image with Gemini 2.5 Flash Image: {prompt[:100]}...")
+    response = await image_region_pool.call(generate)
+    image_data = _extract_image_data(response)
+    tracing.record_llm_usage(IMAGE_MODEL, response, images=1 if image_data else 0)
+    if image_data:
+        await llm_cache.aset_image(key, image_data)
+    return image_data
+
+
+async def agenerate_image(state: DiaryState) -> dict:
+    """絵日記用の画像を生成 (Gemini 2.5 Flash Image)
+
+    似た場面の画像があれば生成せずに使う（src/image_semantic_cache.py）。画像生成は genai の非同期クライアント、アップロードはスレッドで実行し、
+    イベントループをブロックしない。品質チェックと並行して投機実行した
+    英訳・画像があればそれを使う。
+    """
+    diary_text = state.get("diary_text", "")
+    keywords = state.get("keywords", [])
+    document_id = state.get("document_id", "unknown")
+    speculated = state.get("speculative_for") == diary_text
+
+    if speculated and state.get("scene_desc"):
+        scene_desc, elements = state["scene_desc"], state["scene_elements"]
+    else:
+        scene_desc, elements = await _atranslate_scene(keywords, diary_text)
+
+    reuse_user = state.get("image_reuse_user")
+    try:
+        found = None
+        if speculated and state.get("speculative_image"):
+            image_data = state["speculative_image"]
+        else:
+            found = await image_semantic_cache.alookup(scene_desc, elements, reuse_user)
+            if found and found.hit:
+                uploaded = await asyncio.to_thread(image_semantic_cache.reuse, found, document_id, _upload_image)
+                return {**uploaded, "speculative_image": None}
+            image_data = await _agenerate_image_data(scene_desc, elements)
 
         if not image_data:
             print("No image generated in response")
-            return {"image_url": None}
+            return {"image_url": None, "speculative_image": None}
+
+        # google-cloud-storage は同期 API のみのためスレッドで実行
+        uploaded = await asyncio.to_thread(_upload_image, document_id, image_data)
+        await asyncio.to_thread(
+            image_semantic_cache.remember, found, document_id, reuse_user, scene_desc, elements, uploaded
+        )
 
-        # Cloud Storage にアップロード
-        bucket_name = os.getenv("GCS_BUCKET_NAME", f"{PROJECT_ID}-enikki-images")
-        storage_client = storage.Client(project=PROJECT_ID)
+        print(f"Image uploaded: {uploaded['image_url']}")
+        return {**uploaded, "speculative_image": None}
 
+    except Exception as e:
+        record_fallback("generate_image", e)
+        import traceback
+        traceback.print_exc()
+        return {"image_url": PLACEHOLDER_IMAGE_URL, "speculative_image": None}
+
+
+async def _aspeculate_image(state: DiaryState, with_image: bool) -> dict:
+    """現在の下書きに対する英訳（と画像生成）を先行して行う"""
+    diary_text = state.get("diary_text", "")
+    scene_desc, elements = await _atranslate_scene(state.get("keywords", []), diary_text)
+    image_data = None
+    if with_image:
         try:
-            bucket = storage_client.bucket(bucket_name)
-            if not bucket.exists():
-                bucket = storage_client.create_bucket(bucket_name, location=REGION)
+            # 似た場面の画像を再利用するなら先に生成しない（generate_image で再利用する）
+            found = await image_semantic_cache.alookup(scene_desc, elements, state.get("image_reuse_user"))
+            if not (found and found.hit):
+                image_data = await _agenerate_image_data(scene_desc, elements)
         except Exception as e:
-            print(f"Bucket access error: {e}")
-            bucket = storage_client.bucket(bucket_name)
+            # 本番の generate_image で改めて生成する
+            print(f"Speculative image generation failed: {e}")
+    return {
+        "speculative_for": diary_text,
+        "scene_desc": scene_desc,
+        "scene_elements": elements,
+        "speculative_image": image_data,
+    }
 
-        # ファイル名を生成
-        filename = f"diaries/{document_id}/{uuid.uuid4()}.png"
-        blob = bucket.blob(filename)
 
-        # 画像データをアップロード
-        blob.upload_from_string(image_data, content_type="image/png")
+def make_speculative_check_quality(with_image: bool):
+    """品質チェックと画像用の英訳（・画像生成）を並行実行するノードを作る
 
-        # 公開URL（バケットレベルでallUsers読み取り権限設定済み）
-        image_url = f"https://storage.googleapis.com/{bucket_name}/{filename}"
+    品質チェックに合格すれば投機結果を状態に反映し、不合格なら破棄する。
+    """
 
-        print(f"Image uploaded: {image_url}")
-        return {"image_url": image_url}
+    mode = "image" if with_image else "translate"
 
-    except Exception as e:
-        print(f"Error generating image: {e}")
-        import traceback
-        traceback.print_exc()
-        # フォールバック: プレースホルダー
-        return {
-            "image_url": "https://images.unsplash.com/photo-1516934024742-b461fba47600?w=800&auto=format&fit=crop&q=60"
-        }
+    async def acheck_quality_speculative(state: DiaryState) -> dict:
+        speculation = asyncio.create_task(_aspeculate_image(state, with_image))
+        quality = await acheck_quality(state)
+
+        if quality["quality_score"] < QUALITY_THRESHOLD:
+            # リトライになるので投機結果は使わない（未完了なら打ち切る）
+            speculation.cancel()
+            await asyncio.gather(speculation, return_exceptions=True)
+            metrics.inc("diary_speculation_total", outcome="wasted", mode=mode)
+            return {**quality, "speculative_for": None, "speculative_image": None}
+
+        metrics.inc("diary_speculation_total", outcome="committed", mode=mode)
+        return {**quality, **(await speculation)}
+
+    return acheck_quality_speculative
 
 
 def fallback(state: DiaryState) -> dict:
@@ -354,50 +613,64 @@ def fallback(state: DiaryState) -> dict:
     }
 
 
-def save_result(state: DiaryState) -> dict:
-    """結果を Firestore に保存し、Discord に通知"""
-    from src.discord_notifier import send_discord_notification_sync
-
-    # Discord通知を送信（webhook URL が設定されている場合のみ）
-    log = state["conversation_log"]
-    document_id = state.get("document_id")
-    title = log.get("date", "今日の絵日記")
-    diary_text = state.get("diary_text", "")
-    image_url = state.get("image_url")
-    keywords = state.get("keywords")
-    webhook_url = state.get("discord_webhook_url")
-
-    if diary_text and webhook_url:
-        send_discord_notification_sync(
-            webhook_url=webhook_url,
-            title=title,
-            diary_text=diary_text,
-            diary_id=document_id,
-            image_url=image_url,
-            keywords=keywords,
-        )
+async def asave_result(state: DiaryState) -> dict:
+    """結果を確定する
 
+    Firestore への保存と Discord への通知はワークフローの外で行う（src/main.py・src/discord_outbox.py）。
+    通知の遅れやレート制限が絵日記の完了を待たせないようにするため。
+    """
     return {"status": "completed"}
 
 
 # --- グラフ構築 ---
 
 
-def build_diary_workflow() -> StateGraph:
-    """絵日記生成ワークフローのグラフを構築"""
+def build_diary_workflow(speculation: str = "off", mode: str = "graph") -> StateGraph:
+    """絵日記生成ワークフローのグラフを構築
+
+    ノードは非同期なので ainvoke / astream で実行すること。
+    speculation が "translate" / "image" の場合、品質チェックと並行して
+    画像用の英訳（・画像生成）を投機実行する。
+    mode が "single_shot" の場合、まず1回の構造化出力で日記を作り、
+    スキーマ検証か自己評価スコアが不合格のときだけ通常のノード列に進む。
+    """
     graph = StateGraph(DiaryState)
 
+    def add_node(name: str, fn):
+        # ノードごとの実行時間・トークン数・コストを計測する
+        graph.add_node(name, tracing.instrument_node(name, fn))
+
+    if speculation in ("translate", "image"):
+        check_quality_node = make_speculative_check_quality(with_image=speculation == "image")
+    else:
+        check_quality_node = acheck_quality
+
     # ノード追加
-    graph.add_node("extract_keywords", extract_keywords)
-    graph.add_node("generate_diary", generate_diary)
-    graph.add_node("check_quality", check_quality)
-    graph.add_node("increment_retry", increment_retry)
-    graph.add_node("generate_image", generate_image)
-    graph.add_node("fallback", fallback)
-    graph.add_node("save_result", save_result)
+    add_node("prepare_transcript", aprepare_transcript)
+    add_node("extract_keywords", aextract_keywords)
+    add_node("generate_diary", agenerate_diary)
+    add_node("check_quality", check_quality_node)
+    add_node("increment_retry", increment_retry)
+    add_node("generate_image", agenerate_image)
+    add_node("fallback", fallback)
+    add_node("save_result", asave_result)
 
     # エッジ追加
-    graph.add_edge(START, "extract_keywords")
+    if mode == "single_shot":
+        add_node("single_shot", asingle_shot)
+        graph.add_edge(START, "prepare_transcript")
+        graph.add_edge("prepare_transcript", "single_shot")
+        graph.add_conditional_edges(
+            "single_shot",
+            route_single_shot,
+            {
+                "generate_image": "generate_image",
+                "extract_keywords": "extract_keywords",
+            },
+        )
+    else:
+        graph.add_edge(START, "prepare_transcript")
+        graph.add_edge("prepare_transcript", "extract_keywords")
     graph.add_edge("extract_keywords", "generate_diary")
     graph.add_edge("generate_diary", "check_quality")
 
@@ -419,27 +692,123 @@ def build_diary_workflow() -> StateGraph:
     return graph
 
 
-# コンパイル済みワークフロー
-diary_workflow = build_diary_workflow().compile()
+# コンパイル済みワークフロー（チェックポイントは document_id ごと）
+checkpointer = checkpoints.create_checkpointer()
+diary_workflow_async = build_diary_workflow(speculation=DIARY_SPECULATION, mode=DIARY_WORKFLOW_MODE).compile(
+    checkpointer=checkpointer
+)
 
 
 # --- 実行用ヘルパー ---
 
 
-def run_diary_workflow(document_id: str, conversation_log: dict, discord_webhook_url: str | None = None) -> DiaryState:
-    """ワークフローを実行"""
-    initial_state: DiaryState = {
+def _initial_state(document_id: str, conversation_log: dict, image_reuse_user: str | None = None) -> DiaryState:
+    return {
         "document_id": document_id,
         "conversation_log": conversation_log,
+        "transcript_text": None,
         "keywords": None,
         "diary_text": None,
         "quality_score": None,
         "retry_count": 0,
         "image_url": None,
+        "image_renditions": None,
         "status": "pending",
         "error": None,
-        "discord_webhook_url": discord_webhook_url,
+        "speculative_for": None,
+        "scene_desc": None,
+        "scene_elements": None,
+        "speculative_image": None,
+        "image_reuse_user": image_reuse_user,
+        "trace_id": tracing.current_trace_id(),
     }
 
-    result = diary_workflow.invoke(initial_state)
+
+def _workflow_config(document_id: str) -> dict:
+    return {"configurable": {"thread_id": document_id}}
+
+
+def _resume_point(document_id: str, snapshot) -> str:
+    """チェックポイントの状態から、どこから続けるかを返す
+
+    - "start": チェックポイントなし（最初から実行する）
+    - "resume": 途中まで完了している（次のノードから再開する）
+    - "done": 最後まで完了している（結果の保存だけ失敗した場合など。再実行しない）
+    """
+    if snapshot is None or not snapshot.values:
+        return "start"
+    if snapshot.next:
+        print(f"Resuming diary workflow {document_id} at {', '.join(snapshot.next)}")
+        metrics.inc("diary_workflow_resumed_total", node=snapshot.next[0])
+        return "resume"
+    print(f"Diary workflow {document_id} already completed; reusing checkpointed result")
+    metrics.inc("diary_workflow_resumed_total", node="completed")
+    return "done"
+
+
+async def aclear_checkpoints(document_id: str) -> None:
+    """結果を保存した絵日記のチェックポイントを削除する"""
+    if checkpointer:
+        await checkpointer.adelete_thread(document_id)
+
+
+# 進捗イベントとして配信する状態のキー（画像データなど大きな値は含めない）
+PROGRESS_FIELDS = (
+    "keywords",
+    "diary_text",
+    "quality_score",
+    "retry_count",
+    "image_url",
+    "image_renditions",
+    "status",
+    "error",
+)
+
+
+async def run_diary_workflow_async(
+    document_id: str,
+    conversation_log: dict,
+    image_reuse_user: str | None = None,
+    on_event: Callable[[str, dict], None] | None = None,
+) -> DiaryState:
+    """ワークフローを非同期で実行（スレッドを占有しない）
+
+    on_event を渡すと LangGraph のストリーミングで進捗を通知する:
+    - ("node", {"node": ノード名, ...更新された値}) ノード完了ごと
+    - ("token", {"text": 断片}) generate_diary が生成中の日記テキスト
+    """
+    config = _workflow_config(document_id)
+    with tracing.diary_trace(document_id) as diary:
+        snapshot = await diary_workflow_async.aget_state(config) if checkpointer else None
+        point = _resume_point(document_id, snapshot)
+        if point == "done":
+            result = snapshot.values
+        else:
+            # 再開時は入力を渡さない（チェックポイントの状態から続ける）
+            workflow_input = _initial_state(document_id, conversation_log, image_reuse_user) if point == "start" else None
+            if on_event is None:
+                result = await diary_workflow_async.ainvoke(workflow_input, config)
+            else:
+                result = await _astream_workflow(workflow_input, config, on_event)
+    return {**result, "usage": diary.usage()}
+
+
+async def _astream_workflow(
+    workflow_input: DiaryState | None, config: dict, on_event: Callable[[str, dict], None]
+) -> DiaryState:
+    """ストリーミングで実行し、進捗を on_event に通知する"""
+    result = workflow_input
+    async for mode, chunk in diary_workflow_async.astream(
+        workflow_input, config, stream_mode=["updates", "messages", "values"]
+    ):
+        if mode == "values":
+            result = chunk
+        elif mode == "updates":
+            for node, update in chunk.items():
+                fields = {k: v for k, v in (update or {}).items() if k in PROGRESS_FIELDS}
+                on_event("node", {"node": node, **fields})
+        elif mode == "messages":
+            message, metadata = chunk
+            if metadata.get("langgraph_node") == "generate_diary" and isinstance(message.content, str) and message.content:
+                on_event("token", {"text": message.content})
     return result
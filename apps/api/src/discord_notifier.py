@@ -1,43 +1,24 @@
 """
 Discord通知ヘルパー
 
-絵日記生成完了時にDiscord Webhookへ通知を送信します。
+絵日記生成完了時に Discord Webhook へ送る通知の内容を組み立てます。
 Webhook URL はユーザーがフロントエンドで設定し、リクエスト経由で渡されます。
+送信は src/discord_outbox.py のディスパッチャーが行います（レート制限・リトライ・まとめ送り）。
 """
 
 import os
-import httpx
-
 
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
 
 
-def send_discord_notification_sync(
-    webhook_url: str,
+def build_discord_payload(
     title: str,
     diary_text: str,
     diary_id: str | None = None,
     image_url: str | None = None,
     keywords: list[str] | None = None,
-) -> bool:
-    """
-    Discord Webhookに絵日記完了通知を送信
-
-    Args:
-        webhook_url: Discord Webhook URL
-        title: 日記のタイトル（日付など）
-        diary_text: 日記本文
-        diary_id: FirestoreドキュメントID（URLリンク用）
-        image_url: 生成された画像のURL（オプション）
-        keywords: 抽出されたキーワード（オプション）
-
-    Returns:
-        送信成功したかどうか
-    """
-    if not webhook_url:
-        print("Discord Webhook URL is not provided, skipping notification")
-        return False
-
+) -> dict:
+    """Discord Webhook に送信するペイロードを組み立てる"""
     # 日記ページのURL
     diary_url = f"{FRONTEND_URL}/diaries/{diary_id}" if diary_id else None
 
@@ -66,20 +47,6 @@ def send_discord_notification_sync(
     if image_url:
         embed["image"] = {"url": image_url}
 
-    payload = {
+    return {
         "embeds": [embed],
     }
-
-    try:
-        with httpx.Client() as client:
-            response = client.post(
-                webhook_url,
-                json=payload,
-                timeout=10.0,
-            )
-            response.raise_for_status()
-            print(f"Discord notification sent successfully")
-            return True
-    except httpx.HTTPError as e:
-        print(f"Failed to send Discord notification: {e}")
-        return False
@@ -0,0 +1,322 @@
+"""
+Discord 通知のアウトボックス
+
+絵日記の完了通知はワークフローの中では送らず、結果を保存したあとにジョブキュー
+（src/job_queue.py の "discord" キュー。JOB_QUEUE_BACKEND=sqlite なら再起動後も再配信される）に積み、
+DiscordDispatcher が非同期に送ります。Discord が遅い・レート制限中でも絵日記の完了は待たされません。
+
+- Webhook ごとに送信タスクを分け、Discord のレート制限（429 の retry_after / Retry-After、
+  X-RateLimit-Remaining と X-RateLimit-Reset-After）を Webhook 単位で守る。グローバル制限なら全 Webhook を止める
+- 同じ Webhook への通知は DISCORD_COALESCE_SECONDS だけ待ってまとめ、1回の POST で送る
+  （1メッセージの埋め込みは10件・合計6000文字まで）
+- 通信エラーと 5xx は指数バックオフでリトライし、DISCORD_MAX_ATTEMPTS 回で諦める（429 は回数に数えない）。
+  それ以外の 4xx はリトライしない
+- 配信状況は日記ドキュメントの discordNotification（queued / sent / failed と試行回数）に記録する
+
+ジョブの user_id には Webhook URL のハッシュを使うので、キューからの取り出しは Webhook ごとのラウンドロビンになります。
+"""
+
+import asyncio
+import datetime
+import hashlib
+import os
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+import httpx
+
+from src import clients, metrics
+from src.discord_notifier import build_discord_payload
+from src.job_queue import JOB_LEASE_SECONDS, Job, JobQueue, QueueFullError
+
+DISCORD_COALESCE_SECONDS = float(os.getenv("DISCORD_COALESCE_SECONDS", "2"))
+DISCORD_MAX_ATTEMPTS = int(os.getenv("DISCORD_MAX_ATTEMPTS", "6"))
+DISCORD_RETRY_BASE_SECONDS = float(os.getenv("DISCORD_RETRY_BASE_SECONDS", "2"))
+DISCORD_RETRY_MAX_SECONDS = float(os.getenv("DISCORD_RETRY_MAX_SECONDS", "300"))
+DISCORD_TIMEOUT_SECONDS = float(os.getenv("DISCORD_TIMEOUT_SECONDS", "10"))
+# ディスパッチャーが一度に抱える（キューから取り出して送信待ちの）通知の上限
+DISCORD_OUTBOX_MAX_HELD = int(os.getenv("DISCORD_OUTBOX_MAX_HELD", "500"))
+
+# Discord の1メッセージあたりの上限
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
+
+StatusCallback = Callable[[str, dict], Awaitable[None]]
+
+
+def webhook_key(webhook_url: str) -> str:
+    """Webhook URL のハッシュ（URL にはトークンが含まれるのでログやキューの user_id にはこちらを使う）"""
+    return hashlib.sha256(webhook_url.encode("utf-8")).hexdigest()[:16]
+
+
+def notification_payload(
+    document_id: str,
+    webhook_url: str | None,
+    title: str,
+    diary_text: str | None,
+    image_url: str | None = None,
+    image_renditions: dict | None = None,
+    keywords: list[str] | None = None,
+) -> dict | None:
+    """通知ジョブの payload。Webhook URL か本文がなければ None（通知しない）"""
+    if not webhook_url or not diary_text:
+        return None
+    # Discord の埋め込みには軽量なレンディションを使う
+    image = (image_renditions or {}).get("discord") or image_url
+    payload = build_discord_payload(title, diary_text, document_id, image, keywords)
+    return {"document_id": document_id, "webhook_url": webhook_url, "embed": payload["embeds"][0]}
+
+
+def notification_status(status: str, attempts: int = 0, error: str | None = None) -> dict:
+    """日記ドキュメントの discordNotification に書く内容"""
+    return {
+        "status": status,
+        "attempts": attempts,
+        "error": error,
+        "updatedAt": datetime.datetime.now(datetime.timezone.utc),
+    }
+
+
+def _embed_chars(embed: dict) -> int:
+    """埋め込みの文字数（Discord の合計6000文字の制限で数えられる部分）"""
+    chars = len(embed.get("title", "")) + len(embed.get("description", ""))
+    for field in embed.get("fields", []):
+        chars += len(field.get("name", "")) + len(field.get("value", ""))
+    return chars
+
+
+def _retry_after(response: httpx.Response) -> float:
+    """429 のレスポンスから待つ秒数を取り出す（本文の retry_after を優先）"""
+    try:
+        return float(response.json()["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        pass
+    try:
+        return float(response.headers.get("Retry-After", "1"))
+    except ValueError:
+        return 1.0
+
+
+class _Notification:
+    def __init__(self, job: Job):
+        self.job = job
+        self.held_at = time.monotonic()
+        self.attempts = 0
+
+
+class _Webhook:
+    """Webhook ごとの送信待ちの通知とレート制限の状態"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.pending: deque[_Notification] = deque()
+        self.blocked_until = 0.0
+        self.failures = 0
+        self.task: asyncio.Task | None = None
+
+
+class DiscordDispatcher:
+    """通知キューから取り出した通知を Webhook ごとに送る"""
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        on_status: StatusCallback | None = None,
+        coalesce_seconds: float = DISCORD_COALESCE_SECONDS,
+        max_attempts: int = DISCORD_MAX_ATTEMPTS,
+        lease_seconds: float = JOB_LEASE_SECONDS,
+        max_held: int = DISCORD_OUTBOX_MAX_HELD,
+        poll_interval: float = 1.0,
+    ):
+        self.queue = queue
+        self.on_status = on_status
+        self.coalesce_seconds = coalesce_seconds
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.max_held = max_held
+        self.poll_interval = poll_interval
+        self._webhooks: dict[str, _Webhook] = {}
+        self._held = 0
+        self._global_blocked_until = 0.0
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._claim_loop(), name="discord-dispatcher"),
+            asyncio.create_task(self._heartbeat_loop(), name="discord-heartbeat"),
+        ]
+        print(f"Started Discord dispatcher (coalesce {self.coalesce_seconds:.1f}s, max attempts {self.max_attempts})")
+
+    async def stop(self) -> None:
+        """送信を止める。送れていない通知は ack していないので、リースが切れた後に再配信される"""
+        tasks = self._tasks + [webhook.task for webhook in self._webhooks.values() if webhook.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self._webhooks.clear()
+        self._held = 0
+
+    async def enqueue(self, payload: dict) -> bool:
+        """通知をキューに積む。積めなければ failed を記録して False を返す"""
+        try:
+            await self.queue.enqueue(webhook_key(payload["webhook_url"]), payload)
+        except QueueFullError:
+            print(f"Discord notification queue full; dropping notification for diary {payload['document_id']}")
+            metrics.inc("discord_notifications_total", result="dropped")
+            await self._record(payload["document_id"], notification_status("failed", error="queue full"))
+            return False
+        return True
+
+    async def _record(self, document_id: str, status: dict) -> None:
+        if self.on_status is None:
+            return
+        try:
+            await self.on_status(document_id, status)
+        except Exception as e:
+            print(f"Failed to record Discord notification status for diary {document_id}: {e}")
+
+    async def _claim_loop(self) -> None:
+        while True:
+            if self._held >= self.max_held:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            try:
+                job = await self.queue.claim(self.lease_seconds)
+            except Exception as e:
+                print(f"Failed to claim job from '{self.queue.name}': {e}")
+                await asyncio.sleep(self.poll_interval)
+                continue
+            if job is None:
+                await self.queue.wait_available(self.poll_interval)
+                continue
+            await self._hold(job)
+
+    async def _heartbeat_loop(self) -> None:
+        # 送信待ちで抱えている通知のリースを延長し、使われなくなった Webhook の状態を捨てる
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            now = time.monotonic()
+            for key, webhook in list(self._webhooks.items()):
+                if not webhook.pending and webhook.blocked_until <= now and (webhook.task is None or webhook.task.done()):
+                    del self._webhooks[key]
+                for notification in list(webhook.pending):
+                    await self.queue.heartbeat(notification.job, self.lease_seconds)
+
+    async def _hold(self, job: Job) -> None:
+        if job.attempts > self.max_attempts:
+            # リース切れで再配信され続けた通知（インスタンスごと落ちるなど）
+            await self._finish([_Notification(job)], "failed", "max attempts exceeded", held=False)
+            return
+        url = job.payload["webhook_url"]
+        key = webhook_key(url)
+        webhook = self._webhooks.get(key)
+        if webhook is None:
+            webhook = self._webhooks[key] = _Webhook(url)
+        webhook.pending.append(_Notification(job))
+        self._held += 1
+        metrics.set_gauge("discord_outbox_held", self._held)
+        if webhook.task is None or webhook.task.done():
+            webhook.task = asyncio.create_task(self._send_loop(key, webhook), name=f"discord-{key}")
+
+    async def _send_loop(self, key: str, webhook: _Webhook) -> None:
+        while webhook.pending:
+            # バーストをまとめるため最初の通知から coalesce_seconds 待つ。レート制限中は解除まで待つ
+            now = time.monotonic()
+            delay = max(
+                webhook.pending[0].held_at + self.coalesce_seconds - now,
+                webhook.blocked_until - now,
+                self._global_blocked_until - now,
+            )
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            await self._deliver(webhook, self._take(webhook))
+        # レート制限の状態が残っていなければ Webhook の状態を捨てる
+        if webhook.blocked_until <= time.monotonic() and self._webhooks.get(key) is webhook:
+            del self._webhooks[key]
+
+    @staticmethod
+    def _take(webhook: _Webhook) -> list[_Notification]:
+        batch = [webhook.pending.popleft()]
+        chars = _embed_chars(batch[0].job.payload["embed"])
+        while webhook.pending and len(batch) < MAX_EMBEDS_PER_MESSAGE:
+            next_chars = _embed_chars(webhook.pending[0].job.payload["embed"])
+            if chars + next_chars > MAX_EMBED_CHARS_PER_MESSAGE:
+                break
+            batch.append(webhook.pending.popleft())
+            chars += next_chars
+        return batch
+
+    async def _deliver(self, webhook: _Webhook, batch: list[_Notification]) -> None:
+        for notification in batch:
+            notification.attempts += 1
+        payload = {"embeds": [notification.job.payload["embed"] for notification in batch]}
+        try:
+            response = await clients.get_http_client().post(webhook.url, json=payload, timeout=DISCORD_TIMEOUT_SECONDS)
+        except httpx.HTTPError as e:
+            await self._retry(webhook, batch, f"{type(e).__name__}: {e}")
+            return
+        metrics.inc("discord_webhook_requests_total", status=str(response.status_code))
+        now = time.monotonic()
+
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            # このリクエストでバケットを使い切った。次は解除まで待つ
+            try:
+                webhook.blocked_until = now + float(response.headers.get("X-RateLimit-Reset-After", "1"))
+            except ValueError:
+                webhook.blocked_until = now + 1.0
+
+        if response.status_code == 429:
+            retry_after = _retry_after(response)
+            if response.headers.get("X-RateLimit-Global") or response.headers.get("X-RateLimit-Scope") == "global":
+                self._global_blocked_until = now + retry_after
+            webhook.blocked_until = max(webhook.blocked_until, now + retry_after)
+            print(f"Discord webhook {webhook_key(webhook.url)} rate limited; retrying in {retry_after:.1f}s")
+            metrics.inc("discord_rate_limited_total")
+            # レート制限は送信の失敗ではないので、DISCORD_MAX_ATTEMPTS の試行回数に数えない
+            for notification in batch:
+                notification.attempts -= 1
+            await self._requeue(webhook, batch, "rate limited")
+        elif response.status_code >= 500 or response.status_code == 408:
+            await self._retry(webhook, batch, f"HTTP {response.status_code}")
+        elif response.is_success:
+            webhook.failures = 0
+            await self._finish(batch, "sent")
+        else:
+            # Webhook の削除（404）・不正な内容（400）などはリトライしても成功しない
+            print(f"Discord webhook {webhook_key(webhook.url)} rejected notification: HTTP {response.status_code}")
+            await self._finish(batch, "failed", f"HTTP {response.status_code}")
+
+    async def _retry(self, webhook: _Webhook, batch: list[_Notification], error: str) -> None:
+        webhook.failures += 1
+        delay = min(DISCORD_RETRY_BASE_SECONDS * 2 ** (webhook.failures - 1), DISCORD_RETRY_MAX_SECONDS)
+        delay *= 0.5 + random.random()
+        webhook.blocked_until = max(webhook.blocked_until, time.monotonic() + delay)
+        print(f"Discord webhook {webhook_key(webhook.url)} failed ({error}); retrying in {delay:.1f}s")
+        metrics.inc("discord_notification_retries_total")
+        await self._requeue(webhook, batch, error)
+
+    async def _requeue(self, webhook: _Webhook, batch: list[_Notification], error: str) -> None:
+        """試行回数が残っている通知を送信待ちの先頭に戻す"""
+        exhausted = [notification for notification in batch if notification.attempts >= self.max_attempts]
+        remaining = [notification for notification in batch if notification.attempts < self.max_attempts]
+        webhook.pending.extendleft(reversed(remaining))
+        if exhausted:
+            await self._finish(exhausted, "failed", error)
+
+    async def _finish(self, batch: list[_Notification], status: str, error: str | None = None, held: bool = True) -> None:
+        for notification in batch:
+            job = notification.job
+            if status == "sent":
+                await self.queue.ack(job)
+                metrics.observe("discord_notification_delay_seconds", time.time() - job.created_at)
+            else:
+                await self.queue.nack(job, error or status, retry=False)
+            if held:
+                self._held -= 1
+            metrics.inc("discord_notifications_total", result=status)
+            await self._record(job.payload["document_id"], notification_status(status, notification.attempts, error))
+        metrics.set_gauge("discord_outbox_held", self._held)
@@ -0,0 +1,151 @@
+"""
+Firebase ID トークン検証
+
+/auth/token や /diaries の全リクエストで行う ID トークン検証の結果を、
+トークンのハッシュをキーにプロセス内 LRU でキャッシュします。
+
+- キャッシュの有効期限はトークンの exp（と FIREBASE_TOKEN_CACHE_MAX_TTL の短い方）
+- キャッシュミス時の検証はスレッドで実行し、イベントループをブロックしない
+- 同じトークンの検証が同時に来た場合は1回の検証を共有する
+- 署名検証に使う Google の公開証明書は firebase_admin が Cache-Control に従って
+  キャッシュ・更新している（起動時のウォームアップで prefetch_public_certs を呼ぶと先に取得できる）
+- firebase_admin の import と初期化は最初の検証まで遅らせる（コールドスタート短縮のため）
+"""
+
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import Header, HTTPException
+
+from src import metrics
+
+PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "enikki-cloud")
+FIREBASE_TOKEN_CACHE_SIZE = int(os.getenv("FIREBASE_TOKEN_CACHE_SIZE", "10000"))
+FIREBASE_TOKEN_CACHE_MAX_TTL = float(os.getenv("FIREBASE_TOKEN_CACHE_MAX_TTL", "600"))
+
+
+class VerifiedTokenCache:
+    """検証済み ID トークンの LRU キャッシュ"""
+
+    def __init__(self, max_size: int = FIREBASE_TOKEN_CACHE_SIZE, max_ttl: float = FIREBASE_TOKEN_CACHE_MAX_TTL):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, decoded_token = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return decoded_token
+
+    def set(self, key: str, decoded_token: dict) -> None:
+        expires_at = min(float(decoded_token.get("exp", 0)), time.time() + self.max_ttl)
+        if expires_at <= time.time() or self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (expires_at, decoded_token)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+token_cache = VerifiedTokenCache()
+_inflight: dict[str, asyncio.Future] = {}
+_app_lock = threading.Lock()
+
+
+def _auth():
+    """初期化済みの firebase_admin.auth（初回だけ import と initialize_app を行う）"""
+    import firebase_admin
+    from firebase_admin import auth
+
+    if not firebase_admin._apps:
+        with _app_lock:
+            if not firebase_admin._apps:
+                try:
+                    # 明示的にプロジェクトIDを指定して初期化
+                    firebase_admin.initialize_app(options={"projectId": PROJECT_ID})
+                    print(f"Firebase Admin initialized for project: {PROJECT_ID}")
+                except Exception as e:
+                    print(f"Error initializing Firebase Admin: {e}")
+                    firebase_admin.initialize_app()
+    return auth
+
+
+def verify_id_token(id_token: str) -> dict:
+    """ID トークンを検証する（同期。キャッシュなし）"""
+    return _auth().verify_id_token(id_token)
+
+
+def prefetch_public_certs() -> None:
+    """ID トークンの署名検証に使う公開証明書を取得しておく
+
+    firebase_admin は証明書を Cache-Control 付きの HTTP セッションでキャッシュするので、
+    同じセッションで一度取得すれば最初の検証で取得を待たない（非公開 API を使うため失敗は無視してよい）。
+    """
+    from firebase_admin import _token_gen
+
+    verifier = _auth()._get_client(None)._token_verifier
+    verifier.request(_token_gen.ID_TOKEN_CERT_URI, method="GET")
+
+
+def _token_key(id_token: str) -> str:
+    return hashlib.sha256(id_token.encode("utf-8")).hexdigest()
+
+
+async def verify_id_token_cached(id_token: str) -> dict:
+    """ID トークンを検証する（検証済みならキャッシュを返す）"""
+    key = _token_key(id_token)
+    decoded_token = token_cache.get(key)
+    if decoded_token is not None:
+        metrics.inc("firebase_token_cache_total", result="hit")
+        return decoded_token
+
+    metrics.inc("firebase_token_cache_total", result="miss")
+    while (inflight := _inflight.get(key)) is not None:
+        try:
+            return await asyncio.shield(inflight)
+        except asyncio.CancelledError:
+            if not inflight.cancelled():
+                # キャンセルされたのはこの呼び出し自身
+                raise
+            # 先に検証していた呼び出しがキャンセルされた（クライアントの切断など）ので検証し直す
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        decoded_token = await asyncio.to_thread(verify_id_token, id_token)
+        token_cache.set(key, decoded_token)
+        future.set_result(decoded_token)
+        return decoded_token
+    except Exception as e:
+        future.set_exception(e)
+        # 待っている呼び出しがなければ例外を取り出して警告を抑える
+        future.exception()
+        raise
+    finally:
+        if not future.done():
+            # キャンセルされた（CancelledError は Exception ではない）。待っている呼び出しに知らせる
+            future.cancel()
+        if _inflight.get(key) is future:
+            del _inflight[key]
+
+
+async def verify_firebase_token(x_firebase_token: str = Header(..., alias="X-Firebase-Token")):
+    """Firebase ID トークンを検証する"""
+    try:
+        return await verify_id_token_cached(x_firebase_token)
+    except Exception as e:
+        print(f"Token verification failed: {e}")
+        raise HTTPException(status_code=401, detail="Invalid or expired Firebase token")
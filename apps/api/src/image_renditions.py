@@ -0,0 +1,119 @@
+"""
+画像の後処理とアップロード
+
+生成された PNG をそのまま配信すると、絵日記カード（最大 400px 表示）や Discord の埋め込みでも
+フルサイズの PNG がダウンロードされます。ここでは Pillow で用途ごとのレンディションを作り、
+並列に Cloud Storage へアップロードします。
+
+- original: 元画像の PNG（保存用）
+- avif / webp: 絵日記カード用（高解像度ディスプレイ向けに 800px）
+- thumbnail: 一覧用の小さい WebP
+- discord: Discord の埋め込み用 JPEG
+
+オブジェクト名に内容のハッシュを含めるため、同じ URL の中身が変わることはなく、
+長期間のキャッシュ（IMAGE_CACHE_CONTROL）を指定できます。
+"""
+
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from src import metrics
+
+IMAGE_RENDITIONS_ENABLED = os.getenv("IMAGE_RENDITIONS_ENABLED", "true").lower() == "true"
+IMAGE_CACHE_CONTROL = os.getenv("IMAGE_CACHE_CONTROL", "public, max-age=31536000, immutable")
+
+
+@dataclass(frozen=True)
+class RenditionSpec:
+    name: str
+    format: str  # Pillow の保存形式
+    max_size: int | None  # 長辺の最大ピクセル数（None は元のサイズ）
+    quality: int
+    content_type: str
+    ext: str
+
+
+RENDITIONS = [
+    RenditionSpec("avif", "AVIF", 800, 55, "image/avif", "avif"),
+    RenditionSpec("webp", "WEBP", 800, 80, "image/webp", "webp"),
+    RenditionSpec("thumbnail", "WEBP", 256, 75, "image/webp", "webp"),
+    RenditionSpec("discord", "JPEG", 640, 85, "image/jpeg", "jpg"),
+]
+
+ORIGINAL = RenditionSpec("original", "PNG", None, 0, "image/png", "png")
+
+
+@dataclass
+class Rendition:
+    spec: RenditionSpec
+    data: bytes
+
+
+def render(image_data: bytes, spec: RenditionSpec) -> Rendition:
+    """1つのレンディションを作る"""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_data)) as image:
+        image = image.convert("RGB") if spec.format == "JPEG" else image.convert("RGBA")
+        if spec.max_size:
+            image.thumbnail((spec.max_size, spec.max_size), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format=spec.format, quality=spec.quality)
+    return Rendition(spec, buffer.getvalue())
+
+
+def warmup() -> None:
+    """Pillow のプラグインと各形式のエンコーダーを読み込んでおく（最初の絵日記の後処理で待たないように）"""
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGBA", (16, 16)).save(buffer, format="PNG")
+    for spec in RENDITIONS:
+        render(buffer.getvalue(), spec)
+
+
+def object_name(document_id: str, rendition: Rendition) -> str:
+    """内容のハッシュを含むオブジェクト名"""
+    digest = hashlib.sha256(rendition.data).hexdigest()[:16]
+    return f"diaries/{document_id}/{digest}-{rendition.spec.name}.{rendition.spec.ext}"
+
+
+def _upload(bucket, document_id: str, rendition: Rendition) -> str:
+    filename = object_name(document_id, rendition)
+    blob = bucket.blob(filename)
+    blob.cache_control = IMAGE_CACHE_CONTROL
+    blob.upload_from_string(rendition.data, content_type=rendition.spec.content_type)
+    metrics.inc("image_rendition_bytes_total", len(rendition.data), rendition=rendition.spec.name)
+    # 公開URL（バケットレベルでallUsers読み取り権限設定済み）
+    return f"https://storage.googleapis.com/{bucket.name}/{filename}"
+
+
+def upload_renditions(bucket, document_id: str, image_data: bytes) -> dict[str, str]:
+    """元画像と各レンディションを並列に作成・アップロードし、{名前: URL} を返す
+
+    作成に失敗したレンディションは省く（元画像は必ずアップロードする）。
+    """
+    original = Rendition(ORIGINAL, image_data)
+    specs = RENDITIONS if IMAGE_RENDITIONS_ENABLED else []
+
+    def process(spec: RenditionSpec) -> tuple[str, str] | None:
+        try:
+            rendition = original if spec is ORIGINAL else render(image_data, spec)
+        except Exception as e:
+            print(f"Failed to render {spec.name}: {e}")
+            metrics.inc("image_rendition_failures_total", rendition=spec.name)
+            return None
+        return spec.name, _upload(bucket, document_id, rendition)
+
+    # Pillow のエンコードと GCS へのアップロードはどちらも GIL を手放すのでスレッドで並列化する
+    with ThreadPoolExecutor(max_workers=len(specs) + 1) as executor:
+        results = list(executor.map(process, [ORIGINAL, *specs]))
+    return dict(result for result in results if result)
+
+
+def primary_url(renditions: dict[str, str]) -> str | None:
+    """imageUrl に使う URL（対応していないクライアント向けにどのブラウザでも表示できる形式）"""
+    return renditions.get("webp") or renditions.get("original")
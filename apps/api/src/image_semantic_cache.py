@@ -0,0 +1,385 @@
+"""
+生成画像のセマンティックキャッシュ（似た場面の画像を再利用する）
+
+「公園でブランコ」「おうちでゲーム」のように、別の日の日記でも画像にする場面はよく似ています。
+画像生成（gemini-2.5-flash-image）はワークフローで最も遅く高い呼び出しなので、英訳済みの
+場面（scene / elements）の埋め込みベクトルで過去の画像を探し、十分に似ていれば生成せずに使います。
+完全一致のキャッシュ（src/llm_cache.py）はプロンプトが1文字でも違うと当たりません。
+
+- 埋め込みは IMAGE_EMBEDDING_MODEL（既定 256 次元）。同じ場面の埋め込みは llm_cache に保存する
+- インデックスは正規化した float16 の NumPy 配列（1件 512 バイト）。内積（コサイン類似度）で最も近い画像を探す
+- 追加した画像は IMAGE_SEMANTIC_CACHE_DIR に追記で保存し、起動後の初回利用時に読み込む
+  （インスタンスごとのインデックス。上限を超えたら古いものから捨てて書き直す）
+- 類似度が IMAGE_SEMANTIC_CACHE_THRESHOLD 以上なら再利用する。reuse はアップロード済みの画像の URL を
+  そのまま使い、vary は元画像を読み込んで反転・色味・切り抜きを少し変えた画像をアップロードする
+- IMAGE_SEMANTIC_CACHE_SCOPE=user なら同じユーザーの画像だけ、global なら全ユーザーの画像から探す
+- 日記の作成時に imageReuse=false を指定したユーザーの日記は、再利用もインデックスへの追加もしない
+- IMAGE_SEMANTIC_CACHE=shadow のときは探してメトリクスだけ記録し、常に生成する（しきい値の調整用）
+
+NumPy が入っていない環境ではキャッシュは無効になります（常に生成する）。
+"""
+
+import asyncio
+import datetime
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+from src import clients, llm_cache, metrics
+from src.rate_limiter import PRIORITY_IMAGE, get_limiter
+
+IMAGE_SEMANTIC_CACHE = os.getenv("IMAGE_SEMANTIC_CACHE", "off")  # off / shadow / on
+IMAGE_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("IMAGE_SEMANTIC_CACHE_THRESHOLD", "0.92"))
+IMAGE_SEMANTIC_CACHE_REUSE = os.getenv("IMAGE_SEMANTIC_CACHE_REUSE", "vary")  # reuse / vary
+IMAGE_SEMANTIC_CACHE_SCOPE = os.getenv("IMAGE_SEMANTIC_CACHE_SCOPE", "user")  # user / global
+IMAGE_SEMANTIC_CACHE_DIR = os.getenv("IMAGE_SEMANTIC_CACHE_DIR", "/tmp/enikki-image-index")
+IMAGE_SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_SEMANTIC_CACHE_MAX_ENTRIES", "20000"))
+IMAGE_EMBEDDING_MODEL = os.getenv("IMAGE_EMBEDDING_MODEL", "text-embedding-005")
+IMAGE_EMBEDDING_REGION = os.getenv("IMAGE_EMBEDDING_REGION", "us-central1")
+IMAGE_EMBEDDING_DIMENSIONS = int(os.getenv("IMAGE_EMBEDDING_DIMENSIONS", "256"))
+
+
+def _numpy():
+    """NumPy（入っていなければ None）。import は初回利用時まで遅らせる"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def owner_key(user_id: str) -> str:
+    """インデックスに保存するユーザーの識別子（uid そのものは保存しない）"""
+    return hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:16]
+
+
+def embedding_text(scene_desc: str, elements: str) -> str:
+    return f"{scene_desc}\n{elements}"
+
+
+class VectorIndex:
+    """正規化した埋め込みベクトルと画像の情報（追記でディスクに保存する）
+
+    - vectors.f16: float16 のベクトルを追記したもの
+    - entries.jsonl: 同じ順序の画像の情報（1行1件）
+    - meta.json: 次元数とモデル（変わったらインデックスを作り直す）
+    """
+
+    def __init__(self, directory: str | None, dimensions: int, model: str, max_entries: int):
+        self.np = _numpy()
+        self.directory = Path(directory) if directory else None
+        self.dimensions = dimensions
+        self.model = model
+        self.max_entries = max_entries
+        self.entries: list[dict] = []
+        self._vectors = self.np.zeros((0, dimensions), dtype=self.np.float16)
+        self._count = 0
+        # 持ち主 -> インデックスの行番号（scope=user の検索用）
+        self._by_owner: dict[str, list[int]] = {}
+        self._lock = threading.Lock()
+        if self.directory:
+            self._load()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _paths(self) -> tuple[Path, Path, Path]:
+        return self.directory / "vectors.f16", self.directory / "entries.jsonl", self.directory / "meta.json"
+
+    def _load(self) -> None:
+        vectors_path, entries_path, meta_path = self._paths()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        meta = {"dimensions": self.dimensions, "model": self.model}
+        stale = False
+        try:
+            if json.loads(meta_path.read_text()) != meta:
+                print("Image semantic cache: embedding model changed, rebuilding the index")
+                raise FileNotFoundError
+            vectors = self.np.fromfile(vectors_path, dtype=self.np.float16)
+            with open(entries_path, encoding="utf-8") as f:
+                entries = [json.loads(line) for line in f if line.endswith("\n")]
+        except (FileNotFoundError, ValueError):
+            vectors, entries, stale = self.np.zeros(0, dtype=self.np.float16), [], True
+            meta_path.write_text(json.dumps(meta))
+        # 書き込み途中で止まった分は、ベクトルと情報の揃っている件数までに切り詰める
+        count = min(len(vectors) // self.dimensions, len(entries))
+        self._set(vectors[: count * self.dimensions].reshape(count, self.dimensions), entries[:count])
+        if stale or count != len(entries) or count * self.dimensions != len(vectors):
+            self._rewrite()
+        print(f"Image semantic cache: loaded {count} images from {self.directory}")
+
+    def _set(self, vectors, entries: list[dict]) -> None:
+        self._vectors = self.np.array(vectors, dtype=self.np.float16)
+        self._count = len(entries)
+        self.entries = list(entries)
+        self._by_owner = {}
+        for i, entry in enumerate(self.entries):
+            self._by_owner.setdefault(entry.get("owner"), []).append(i)
+
+    def _rewrite(self) -> None:
+        if not self.directory:
+            return
+        vectors_path, entries_path, _ = self._paths()
+        tmp = vectors_path.with_suffix(".tmp")
+        self._vectors[: self._count].tofile(tmp)
+        tmp.replace(vectors_path)
+        tmp = entries_path.with_suffix(".tmp")
+        tmp.write_text("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in self.entries), encoding="utf-8")
+        tmp.replace(entries_path)
+
+    def normalize(self, vector):
+        vector = self.np.asarray(vector, dtype=self.np.float32)
+        norm = float(self.np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    def search(self, vector, owner: str | None = None) -> tuple[float, dict] | None:
+        """最も類似度の高い画像（owner を指定するとその持ち主の画像だけ）"""
+        query = self.normalize(vector)
+        with self._lock:
+            if owner is None:
+                rows = None
+                candidates = self._vectors[: self._count]
+            else:
+                rows = self._by_owner.get(owner)
+                if not rows:
+                    return None
+                candidates = self._vectors[rows]
+            if not len(candidates):
+                return None
+            scores = candidates.astype(self.np.float32) @ query
+            best = int(self.np.argmax(scores))
+            return float(scores[best]), self.entries[rows[best] if rows is not None else best]
+
+    def add(self, vector, entry: dict) -> None:
+        vector = self.normalize(vector).astype(self.np.float16)
+        with self._lock:
+            if self._count == len(self._vectors):
+                # 容量を倍にして追記のたびにコピーしないようにする
+                grown = self.np.zeros((max(64, self._count * 2), self.dimensions), dtype=self.np.float16)
+                grown[: self._count] = self._vectors[: self._count]
+                self._vectors = grown
+            self._vectors[self._count] = vector
+            self.entries.append(entry)
+            self._by_owner.setdefault(entry.get("owner"), []).append(self._count)
+            self._count += 1
+            if self._count > self.max_entries:
+                # 古いものから捨てる（1件ごとに書き直さないよう 1/4 をまとめて捨てる）
+                keep = self.max_entries * 3 // 4
+                self._set(self._vectors[self._count - keep : self._count], self.entries[-keep:])
+                self._rewrite()
+                return
+            if self.directory:
+                vectors_path, entries_path, _ = self._paths()
+                with open(vectors_path, "ab") as f:
+                    f.write(vector.tobytes())
+                with open(entries_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        metrics.set_gauge("image_semantic_cache_entries", self._count)
+
+
+_index: VectorIndex | None = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> VectorIndex | None:
+    """インデックス（無効・NumPy なしなら None）。初回利用時にディスクから読み込む"""
+    global _index
+    if IMAGE_SEMANTIC_CACHE == "off":
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                if _numpy() is None:
+                    print("Warning: numpy is not installed; image semantic cache is disabled")
+                    return None
+                _index = VectorIndex(
+                    IMAGE_SEMANTIC_CACHE_DIR, IMAGE_EMBEDDING_DIMENSIONS, IMAGE_EMBEDDING_MODEL, IMAGE_SEMANTIC_CACHE_MAX_ENTRIES
+                )
+    return _index
+
+
+def is_enabled(user_id: str | None) -> bool:
+    """この日記でキャッシュを使うか（無効・オプトアウトなら False）"""
+    return IMAGE_SEMANTIC_CACHE != "off" and user_id is not None
+
+
+# --- 埋め込み ---
+
+
+def _embedding_cache_key(text: str) -> str:
+    return llm_cache.cache_key("embedding", model=IMAGE_EMBEDDING_MODEL, text=text, dimensions=IMAGE_EMBEDDING_DIMENSIONS)
+
+
+def _embed_config():
+    from google.genai import types
+
+    return types.EmbedContentConfig(task_type="SEMANTIC_SIMILARITY", output_dimensionality=IMAGE_EMBEDDING_DIMENSIONS)
+
+
+def _vector_from_response(response) -> list[float]:
+    return list(response.embeddings[0].values)
+
+
+async def aembed(text: str) -> list[float]:
+    """場面の埋め込みベクトル（同じ場面は llm_cache から返す）"""
+    key = _embedding_cache_key(text)
+    backend = llm_cache.cache_backend
+    if backend and (cached := await backend.aget(key)):
+        return json.loads(cached)
+    client = clients.get_genai_client(IMAGE_EMBEDDING_REGION)
+    response = await get_limiter(IMAGE_EMBEDDING_MODEL, IMAGE_EMBEDDING_REGION).call(
+        lambda: client.aio.models.embed_content(model=IMAGE_EMBEDDING_MODEL, contents=text, config=_embed_config()),
+        PRIORITY_IMAGE,
+    )
+    vector = _vector_from_response(response)
+    if backend:
+        await backend.aset(key, json.dumps(vector).encode("utf-8"))
+    return vector
+
+
+# --- 検索と登録 ---
+
+
+@dataclass
+class Lookup:
+    """検索結果。hit なら entry の画像を使う（miss でも生成後の登録に vector を使う）"""
+
+    vector: list[float] | None
+    score: float | None
+    entry: dict | None
+    hit: bool
+    started: float
+
+
+def _record_lookup(result: str) -> None:
+    metrics.inc("image_semantic_cache_total", result=result, mode=IMAGE_SEMANTIC_CACHE)
+    hits = metrics.get_value("image_semantic_cache_total", result="hit", mode=IMAGE_SEMANTIC_CACHE)
+    misses = metrics.get_value("image_semantic_cache_total", result="miss", mode=IMAGE_SEMANTIC_CACHE)
+    if hits + misses:
+        metrics.set_gauge("image_semantic_cache_hit_ratio", hits / (hits + misses), mode=IMAGE_SEMANTIC_CACHE)
+
+
+def _search(index: VectorIndex, vector: list[float], user_id: str, started: float) -> Lookup:
+    owner = owner_key(user_id) if IMAGE_SEMANTIC_CACHE_SCOPE == "user" else None
+    found = index.search(vector, owner)
+    score, entry = found if found else (None, None)
+    if score is not None:
+        metrics.observe("image_semantic_cache_similarity", score, buckets=(0.5, 0.7, 0.8, 0.85, 0.9, 0.92, 0.95, 0.98, 1.0))
+    matched = score is not None and score >= IMAGE_SEMANTIC_CACHE_THRESHOLD
+    _record_lookup("hit" if matched else "miss")
+    if matched:
+        print(f"Image semantic cache hit: similarity={score:.3f} diary={entry['documentId']}")
+    # shadow では当たっても生成する
+    return Lookup(vector, score, entry, matched and IMAGE_SEMANTIC_CACHE == "on", started)
+
+
+async def alookup(scene_desc: str, elements: str, user_id: str | None) -> Lookup | None:
+    """似た場面の画像を探す（無効・オプトアウト・失敗時は None。失敗しても生成は続ける）
+
+    インデックスの読み込みと検索はスレッドで行う。
+    """
+    if not is_enabled(user_id):
+        return None
+    started = time.perf_counter()
+    try:
+        index = await asyncio.to_thread(get_index)
+        if index is None:
+            return None
+        vector = await aembed(embedding_text(scene_desc, elements))
+        return await asyncio.to_thread(_search, index, vector, user_id, started)
+    except Exception as e:
+        print(f"Image semantic cache lookup failed: {e}")
+        _record_lookup("error")
+        return None
+
+
+def remember(found: Lookup | None, document_id: str, user_id: str, scene_desc: str, elements: str, uploaded: dict) -> None:
+    """生成・アップロードした画像をインデックスに追加する（所要時間は再利用時に節約できた時間として使う）"""
+    if found is None or found.vector is None or not uploaded.get("image_renditions"):
+        return
+    try:
+        get_index().add(
+            found.vector,
+            {
+                "documentId": document_id,
+                "owner": owner_key(user_id),
+                "scene": embedding_text(scene_desc, elements)[:300],
+                "imageUrl": uploaded["image_url"],
+                "renditions": uploaded["image_renditions"],
+                "generateSeconds": round(time.perf_counter() - found.started, 3),
+                "createdAt": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            },
+        )
+    except Exception as e:
+        print(f"Failed to add image to semantic cache: {e}")
+
+
+def record_saved(found: Lookup) -> None:
+    """再利用で節約できた時間（元の画像の生成・アップロード時間 − 検索と再利用にかかった時間）"""
+    spent = time.perf_counter() - found.started
+    saved = max(0.0, found.entry.get("generateSeconds", 0.0) - spent)
+    metrics.inc("image_semantic_cache_saved_seconds_total", saved)
+    metrics.observe("image_semantic_cache_reuse_seconds", spent)
+
+
+# --- 再利用 ---
+
+
+def vary_image(image_data: bytes, seed: str) -> bytes:
+    """左右反転・色味・明るさ・切り抜きを少し変えた画像（同じ絵が並ばないように）"""
+    from PIL import Image, ImageEnhance, ImageOps
+
+    rng = random.Random(seed)
+    with Image.open(io.BytesIO(image_data)) as image:
+        image = image.convert("RGB")
+        if rng.random() < 0.5:
+            image = ImageOps.mirror(image)
+        width, height = image.size
+        crop = rng.uniform(0.0, 0.08)
+        left, top = int(width * crop * rng.random()), int(height * crop * rng.random())
+        image = image.crop((left, top, left + int(width * (1 - crop)), top + int(height * (1 - crop))))
+        image = image.resize((width, height), Image.Resampling.LANCZOS)
+        image = ImageEnhance.Color(image).enhance(rng.uniform(0.85, 1.2))
+        image = ImageEnhance.Brightness(image).enhance(rng.uniform(0.95, 1.08))
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _download_original(entry: dict) -> bytes | None:
+    """再利用する画像の元画像を Cloud Storage から読む"""
+    bucket = clients.get_image_bucket()
+    url = entry.get("renditions", {}).get("original")
+    prefix = f"https://storage.googleapis.com/{bucket.name}/"
+    if not url or not url.startswith(prefix):
+        return None
+    return bucket.blob(url.removeprefix(prefix)).download_as_bytes()
+
+
+def reuse(found: Lookup, document_id: str, upload: Callable[[str, bytes], dict]) -> dict:
+    """似た画像を再利用して状態の更新内容を返す（同期。スレッドで呼ぶ）
+
+    vary では少し変えた画像を upload(document_id, 画像) でアップロードする。
+    元画像を読めなければ、アップロード済みの URL をそのまま使う。
+    """
+    entry = found.entry
+    uploaded = None
+    if IMAGE_SEMANTIC_CACHE_REUSE == "vary":
+        try:
+            original = _download_original(entry)
+            if original:
+                uploaded = upload(document_id, vary_image(original, document_id))
+        except Exception as e:
+            print(f"Failed to vary cached image, reusing it as is: {e}")
+    if uploaded is None:
+        uploaded = {"image_url": entry["imageUrl"], "image_renditions": entry["renditions"]}
+    metrics.inc("image_semantic_cache_reused_total", reuse="vary" if uploaded["image_url"] != entry["imageUrl"] else "reuse")
+    record_saved(found)
+    return uploaded
@@ -0,0 +1,512 @@
+"""
+ジョブキュー
+
+絵日記生成などの重い処理をジョブとして受け付け、ワーカープールで並列数を制限して実行します。
+
+バックエンド:
+- memory: プロセス内のキュー（インスタンスが落ちるとジョブは失われる）
+- sqlite: ローカル SQLite ファイルに永続化（再起動後もジョブを再配信する）
+
+特徴:
+- ユーザー単位のラウンドロビンで取り出し、1人の大量投稿が他ユーザーを待たせない
+- ワーカーは実行中ジョブのリースを定期的に延長（ハートビート）し、
+  リースが切れたジョブは孤立したとみなして別のワーカーに再配信する
+- キューが上限に達したら QueueFullError を送出してバックプレッシャーをかける
+- sqlite では完了したジョブは削除し、諦めたジョブ（failed）は JOB_QUEUE_RETENTION_HOURS 経過後に削除する
+"""
+
+import abc
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from src import metrics
+
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "memory")  # memory / sqlite
+JOB_QUEUE_SQLITE_PATH = os.getenv("JOB_QUEUE_SQLITE_PATH", "/tmp/enikki-jobs.sqlite3")
+JOB_QUEUE_WORKERS = int(os.getenv("JOB_QUEUE_WORKERS", "4"))
+JOB_QUEUE_MAX_DEPTH = int(os.getenv("JOB_QUEUE_MAX_DEPTH", "200"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# sqlite で failed のジョブ（原因の調査用）を残す時間
+JOB_QUEUE_RETENTION_HOURS = float(os.getenv("JOB_QUEUE_RETENTION_HOURS", "72"))
+
+# sqlite の古い行を削除する間隔（秒）
+_SQLITE_PRUNE_INTERVAL = 3600
+
+
+class QueueFullError(Exception):
+    """キューの上限に達したときに送出される"""
+
+
+@dataclass
+class Job:
+    """キューに積まれる1件のジョブ"""
+
+    id: str
+    user_id: str
+    payload: dict
+    attempts: int = 0  # 取り出された回数（再配信を含む）
+    lease_expires_at: float = 0.0
+    created_at: float = field(default_factory=time.time)
+
+
+class JobQueue(abc.ABC):
+    """ジョブキューの共通インターフェース"""
+
+    def __init__(self, name: str, max_depth: int = JOB_QUEUE_MAX_DEPTH):
+        self.name = name
+        self.max_depth = max_depth
+        self._available = asyncio.Event()
+
+    @abc.abstractmethod
+    async def enqueue(self, user_id: str, payload: dict) -> Job:
+        """ジョブを1件積む（上限に達していれば QueueFullError）"""
+
+    @abc.abstractmethod
+    async def enqueue_many(self, user_id: str, payloads: list[dict]) -> list[Job]:
+        """複数のジョブをまとめて積む（全件入らない場合は1件も積まずに QueueFullError）"""
+
+    @abc.abstractmethod
+    async def claim(self, lease_seconds: float) -> Job | None:
+        """次に実行すべきジョブを取り出してリースする（なければ None）"""
+
+    @abc.abstractmethod
+    async def heartbeat(self, job: Job, lease_seconds: float) -> None:
+        """実行中ジョブのリースを延長する"""
+
+    @abc.abstractmethod
+    async def ack(self, job: Job) -> None:
+        """ジョブの完了を記録する"""
+
+    @abc.abstractmethod
+    async def nack(self, job: Job, error: str, retry: bool) -> None:
+        """ジョブの失敗を記録する（retry=True なら再度キューに戻す）"""
+
+    @abc.abstractmethod
+    async def depth(self) -> int:
+        """待機中のジョブ数"""
+
+    @abc.abstractmethod
+    async def in_flight(self) -> int:
+        """リース中（実行中）のジョブ数"""
+
+    @abc.abstractmethod
+    async def active_values(self, key: str) -> set:
+        """待機中・リース中のジョブの payload[key] の集合（回収スイープが順番待ちの日記を見分けるため）"""
+
+    async def is_full(self, count: int = 1) -> bool:
+        """あと count 件積めなければ True"""
+        return await self.depth() + count > self.max_depth
+
+    async def wait_available(self, timeout: float) -> None:
+        """新しいジョブが積まれるか timeout 秒経過するまで待つ"""
+        try:
+            await asyncio.wait_for(self._available.wait(), timeout=timeout)
+        except TimeoutError:
+            pass
+        self._available.clear()
+
+    async def _publish_metrics(self) -> None:
+        metrics.set_gauge("job_queue_depth", await self.depth(), queue=self.name)
+        metrics.set_gauge("job_queue_in_flight", await self.in_flight(), queue=self.name)
+
+
+class MemoryJobQueue(JobQueue):
+    """プロセス内のジョブキュー"""
+
+    def __init__(self, name: str, max_depth: int = JOB_QUEUE_MAX_DEPTH):
+        super().__init__(name, max_depth)
+        # user_id -> そのユーザーの待機ジョブ。先頭のユーザーから順に取り出す
+        self._pending: OrderedDict[str, deque[Job]] = OrderedDict()
+        self._leased: dict[str, Job] = {}
+
+    async def enqueue(self, user_id: str, payload: dict) -> Job:
+        if await self.is_full():
+            raise QueueFullError(f"Job queue '{self.name}' is full")
+        job = Job(id=str(uuid.uuid4()), user_id=user_id, payload=payload)
+        self._pending.setdefault(user_id, deque()).append(job)
+        self._available.set()
+        await self._publish_metrics()
+        return job
+
+    async def enqueue_many(self, user_id: str, payloads: list[dict]) -> list[Job]:
+        if await self.is_full(len(payloads)):
+            raise QueueFullError(f"Job queue '{self.name}' is full")
+        jobs = [Job(id=str(uuid.uuid4()), user_id=user_id, payload=payload) for payload in payloads]
+        self._pending.setdefault(user_id, deque()).extend(jobs)
+        self._available.set()
+        await self._publish_metrics()
+        return jobs
+
+    def _requeue_expired(self) -> None:
+        now = time.time()
+        for job_id, job in list(self._leased.items()):
+            if job.lease_expires_at < now:
+                print(f"Job {job_id} lease expired, redelivering")
+                del self._leased[job_id]
+                self._pending.setdefault(job.user_id, deque()).appendleft(job)
+                metrics.inc("job_queue_redelivered_total", queue=self.name)
+
+    async def claim(self, lease_seconds: float) -> Job | None:
+        self._requeue_expired()
+        if not self._pending:
+            return None
+        # 先頭ユーザーのジョブを1件取り出し、そのユーザーを末尾に回す
+        user_id, jobs = next(iter(self._pending.items()))
+        job = jobs.popleft()
+        if jobs:
+            self._pending.move_to_end(user_id)
+        else:
+            del self._pending[user_id]
+        job.attempts += 1
+        job.lease_expires_at = time.time() + lease_seconds
+        self._leased[job.id] = job
+        await self._publish_metrics()
+        return job
+
+    async def heartbeat(self, job: Job, lease_seconds: float) -> None:
+        if job.id in self._leased:
+            job.lease_expires_at = time.time() + lease_seconds
+
+    async def ack(self, job: Job) -> None:
+        self._leased.pop(job.id, None)
+        await self._publish_metrics()
+
+    async def nack(self, job: Job, error: str, retry: bool) -> None:
+        self._leased.pop(job.id, None)
+        if retry:
+            self._pending.setdefault(job.user_id, deque()).append(job)
+            self._available.set()
+        await self._publish_metrics()
+
+    async def depth(self) -> int:
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    async def in_flight(self) -> int:
+        return len(self._leased)
+
+    async def active_values(self, key: str) -> set:
+        jobs = [*self._leased.values(), *(job for jobs in self._pending.values() for job in jobs)]
+        return {job.payload.get(key) for job in jobs if job.payload.get(key) is not None}
+
+
+class SQLiteJobQueue(JobQueue):
+    """SQLite に永続化するジョブキュー
+
+    インスタンスの再起動後も、リースが切れたジョブは再配信される。
+    """
+
+    def __init__(self, name: str, path: str = JOB_QUEUE_SQLITE_PATH, max_depth: int = JOB_QUEUE_MAX_DEPTH):
+        super().__init__(name, max_depth)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                queue TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_expires_at REAL NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (queue, status, created_at);
+            CREATE TABLE IF NOT EXISTS job_user_turns (
+                queue TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                last_claimed_at REAL NOT NULL,
+                PRIMARY KEY (queue, user_id)
+            );
+            """
+        )
+        self._pruned_at = 0.0
+        self.delete_expired()
+
+    def delete_expired(self) -> int:
+        """JOB_QUEUE_RETENTION_HOURS より古い failed のジョブと、しばらく投稿のないユーザーの順番を削除する
+
+        以前のバージョンが ack で残していた done のジョブも削除する。削除したジョブ数を返す。
+        """
+        cutoff = time.time() - JOB_QUEUE_RETENTION_HOURS * 3600
+        with self._lock:
+            self._pruned_at = time.time()
+            deleted = self._conn.execute(
+                "DELETE FROM jobs WHERE queue = ? AND status IN ('done', 'failed') AND created_at < ?",
+                (self.name, cutoff),
+            ).rowcount
+            self._conn.execute(
+                "DELETE FROM job_user_turns WHERE queue = ? AND last_claimed_at < ?", (self.name, cutoff)
+            )
+        if deleted:
+            metrics.inc("job_queue_expired_total", deleted, queue=self.name)
+            print(f"Deleted {deleted} expired jobs from '{self.name}'")
+        return deleted
+
+    async def _run(self, fn: Callable, *args):
+        def locked():
+            with self._lock:
+                return fn(*args)
+
+        return await asyncio.to_thread(locked)
+
+    async def enqueue(self, user_id: str, payload: dict) -> Job:
+        if await self.is_full():
+            raise QueueFullError(f"Job queue '{self.name}' is full")
+        job = Job(id=str(uuid.uuid4()), user_id=user_id, payload=payload)
+        await self._run(
+            self._conn.execute,
+            "INSERT INTO jobs (id, queue, user_id, payload, status, created_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+            (job.id, self.name, user_id, json.dumps(payload, ensure_ascii=False), job.created_at),
+        )
+        self._available.set()
+        await self._publish_metrics()
+        return job
+
+    def _insert_many_sync(self, jobs: list[Job]) -> None:
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.executemany(
+                "INSERT INTO jobs (id, queue, user_id, payload, status, created_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+                [
+                    (job.id, self.name, job.user_id, json.dumps(job.payload, ensure_ascii=False), job.created_at)
+                    for job in jobs
+                ],
+            )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    async def enqueue_many(self, user_id: str, payloads: list[dict]) -> list[Job]:
+        if await self.is_full(len(payloads)):
+            raise QueueFullError(f"Job queue '{self.name}' is full")
+        jobs = [Job(id=str(uuid.uuid4()), user_id=user_id, payload=payload) for payload in payloads]
+        await self._run(self._insert_many_sync, jobs)
+        self._available.set()
+        await self._publish_metrics()
+        return jobs
+
+    def _claim_sync(self, lease_seconds: float) -> Job | None:
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 待機中 or リース切れのジョブのうち、最後に処理されてから最も時間が経ったユーザーを優先
+            row = self._conn.execute(
+                """
+                SELECT j.id, j.user_id, j.payload, j.attempts, j.status, j.created_at
+                FROM jobs j
+                LEFT JOIN job_user_turns t ON t.queue = j.queue AND t.user_id = j.user_id
+                WHERE j.queue = ?
+                  AND (j.status = 'queued' OR (j.status = 'leased' AND j.lease_expires_at < ?))
+                ORDER BY COALESCE(t.last_claimed_at, 0), j.created_at
+                LIMIT 1
+                """,
+                (self.name, now),
+            ).fetchone()
+            if row is None:
+                self._conn.execute("COMMIT")
+                return None
+
+            job_id, user_id, payload, attempts, status, created_at = row
+            if status == "leased":
+                print(f"Job {job_id} lease expired, redelivering")
+                metrics.inc("job_queue_redelivered_total", queue=self.name)
+            lease_expires_at = now + lease_seconds
+            self._conn.execute(
+                "UPDATE jobs SET status = 'leased', attempts = attempts + 1, lease_expires_at = ? WHERE id = ?",
+                (lease_expires_at, job_id),
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_user_turns (queue, user_id, last_claimed_at) VALUES (?, ?, ?)",
+                (self.name, user_id, now),
+            )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+        return Job(
+            id=job_id,
+            user_id=user_id,
+            payload=json.loads(payload),
+            attempts=attempts + 1,
+            lease_expires_at=lease_expires_at,
+            created_at=created_at,
+        )
+
+    async def claim(self, lease_seconds: float) -> Job | None:
+        job = await self._run(self._claim_sync, lease_seconds)
+        if job:
+            await self._publish_metrics()
+        return job
+
+    async def heartbeat(self, job: Job, lease_seconds: float) -> None:
+        job.lease_expires_at = time.time() + lease_seconds
+        await self._run(
+            self._conn.execute,
+            "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = 'leased'",
+            (job.lease_expires_at, job.id),
+        )
+
+    async def ack(self, job: Job) -> None:
+        # 完了したジョブは残さない（テーブルが際限なく大きくならないように）
+        await self._run(self._conn.execute, "DELETE FROM jobs WHERE id = ?", (job.id,))
+        await self._publish_metrics()
+
+    async def nack(self, job: Job, error: str, retry: bool) -> None:
+        status = "queued" if retry else "failed"
+        await self._run(
+            self._conn.execute,
+            "UPDATE jobs SET status = ?, error = ?, lease_expires_at = 0 WHERE id = ?",
+            (status, error, job.id),
+        )
+        if retry:
+            self._available.set()
+        elif time.time() - self._pruned_at >= _SQLITE_PRUNE_INTERVAL:
+            await asyncio.to_thread(self.delete_expired)
+        await self._publish_metrics()
+
+    async def _count(self, status: str) -> int:
+        row = await self._run(
+            lambda: self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE queue = ? AND status = ?", (self.name, status)
+            ).fetchone()
+        )
+        return row[0]
+
+    async def depth(self) -> int:
+        return await self._count("queued")
+
+    async def in_flight(self) -> int:
+        return await self._count("leased")
+
+    async def active_values(self, key: str) -> set:
+        rows = await self._run(
+            lambda: self._conn.execute(
+                "SELECT DISTINCT json_extract(payload, ?) FROM jobs WHERE queue = ? AND status IN ('queued', 'leased')",
+                (f"$.{key}", self.name),
+            ).fetchall()
+        )
+        return {row[0] for row in rows if row[0] is not None}
+
+
+def create_job_queue(name: str) -> JobQueue:
+    """環境変数 JOB_QUEUE_BACKEND に応じたジョブキューを作成する"""
+    if JOB_QUEUE_BACKEND == "sqlite":
+        print(f"Using SQLite job queue '{name}' at {JOB_QUEUE_SQLITE_PATH}")
+        return SQLiteJobQueue(name)
+    return MemoryJobQueue(name)
+
+
+JobHandler = Callable[[Job], Awaitable[None]]
+
+
+class WorkerPool:
+    """ジョブキューからジョブを取り出して並列実行するワーカープール"""
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handler: JobHandler,
+        concurrency: int = JOB_QUEUE_WORKERS,
+        lease_seconds: float = JOB_LEASE_SECONDS,
+        max_attempts: int = JOB_MAX_ATTEMPTS,
+        on_dead_letter: JobHandler | None = None,
+        poll_interval: float = 1.0,
+    ):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.on_dead_letter = on_dead_letter
+        self.poll_interval = poll_interval
+        self._tasks: list[asyncio.Task] = []
+        self._stopping = False
+
+    def start(self) -> None:
+        self._stopping = False
+        self._tasks = [
+            asyncio.create_task(self._worker(i), name=f"{self.queue.name}-worker-{i}")
+            for i in range(self.concurrency)
+        ]
+        print(f"Started {self.concurrency} workers for job queue '{self.queue.name}'")
+
+    async def stop(self) -> None:
+        """ワーカーを停止する。実行中のジョブはリースが切れた後に再配信される"""
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _heartbeat(self, job: Job) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            await self.queue.heartbeat(job, self.lease_seconds)
+
+    async def _worker(self, index: int) -> None:
+        while not self._stopping:
+            try:
+                job = await self.queue.claim(self.lease_seconds)
+            except Exception as e:
+                print(f"Failed to claim job from '{self.queue.name}': {e}")
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            if job is None:
+                await self.queue.wait_available(self.poll_interval)
+                continue
+
+            await self._run_job(job)
+
+    async def _dead_letter(self, job: Job, error: str) -> None:
+        print(f"Job {job.id} gave up after {job.attempts} attempts: {error}")
+        metrics.inc("job_queue_dead_lettered_total", queue=self.queue.name)
+        if self.on_dead_letter:
+            try:
+                await self.on_dead_letter(job)
+            except Exception as e:
+                print(f"Dead letter handler failed for job {job.id}: {e}")
+        await self.queue.nack(job, error, retry=False)
+
+    async def _run_job(self, job: Job) -> None:
+        name = self.queue.name
+        if job.attempts > self.max_attempts:
+            # リース切れで再配信され続けたジョブ（インスタンスごと落ちるなど）
+            await self._dead_letter(job, "max attempts exceeded")
+            return
+
+        metrics.inc("job_queue_wait_seconds_total", time.time() - job.created_at, queue=name)
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        started = time.monotonic()
+        try:
+            await self.handler(job)
+        except asyncio.CancelledError:
+            # シャットダウン中: ack せずにリース切れで再配信させる
+            raise
+        except Exception as e:
+            print(f"Job {job.id} failed (attempt {job.attempts}): {e}")
+            metrics.inc("job_queue_failed_total", queue=name)
+            if job.attempts < self.max_attempts:
+                await self.queue.nack(job, str(e), retry=True)
+            else:
+                await self._dead_letter(job, str(e))
+        else:
+            metrics.inc("job_queue_completed_total", queue=name)
+            await self.queue.ack(job)
+        finally:
+            heartbeat.cancel()
+            metrics.inc("job_queue_run_seconds_total", time.monotonic() - started, queue=name)
@@ -0,0 +1,324 @@
+"""
+LLM / 画像生成結果のキャッシュ
+
+同じ（モデル, プロンプト, 生成パラメータ）の呼び出し結果を、内容から計算した
+ハッシュをキーに保存します。クライアントのリトライや二重送信、負荷試験で
+同じ会話ログが届いた場合に、Gemini や画像モデルの再課金を避けます。
+
+バックエンド（LLM_CACHE_BACKEND）:
+- off: キャッシュしない
+- memory: プロセス内 LRU（TTL・エントリ数・合計サイズの上限付き）
+- disk: ローカルディレクトリにファイルとして保存
+- firestore: Firestore のコレクションに保存（インスタンス間で共有）
+
+画像はテキストよりはるかに大きいため、別のバックエンド（LLM_IMAGE_CACHE_BACKEND）に保存します。
+既定ではテキストと同じ種類を使いますが、memory の場合は画像をキャッシュしません
+（プロセス内に画像を溜めるとメモリの小さいインスタンスが OOM になるため）。
+明示的に memory を指定した場合は LLM_IMAGE_CACHE_MAX_BYTES を上限にします。
+"""
+
+import abc
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, Generation
+
+from src import clients, metrics
+
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory")  # off / memory / disk / firestore
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "86400"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "/tmp/enikki-llm-cache")
+LLM_CACHE_COLLECTION = os.getenv("LLM_CACHE_COLLECTION", "llmCache")
+# off / memory / disk / firestore（未設定ならテキストと同じ。ただし memory なら off）
+LLM_IMAGE_CACHE_BACKEND = os.getenv("LLM_IMAGE_CACHE_BACKEND") or ("off" if LLM_CACHE_BACKEND == "memory" else LLM_CACHE_BACKEND)
+LLM_IMAGE_CACHE_MAX_BYTES = int(os.getenv("LLM_IMAGE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Firestore ドキュメントの上限（1 MiB）に収まらない値は保存しない
+_FIRESTORE_MAX_VALUE_BYTES = 900 * 1024
+
+
+def cache_key(kind: str, **parts: Any) -> str:
+    """キャッシュキー（呼び出し内容の SHA-256）を作る"""
+    payload = json.dumps({"kind": kind, **parts}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CacheBackend(abc.ABC):
+    """バイト列を保存するキャッシュバックエンドの共通インターフェース"""
+
+    @abc.abstractmethod
+    def get(self, key: str) -> bytes | None:
+        """値（なければ・期限切れなら None）"""
+
+    @abc.abstractmethod
+    def set(self, key: str, value: bytes) -> None:
+        """値を保存する"""
+
+    @abc.abstractmethod
+    def clear(self) -> None:
+        """保存されている値をすべて削除する"""
+
+    async def aget(self, key: str) -> bytes | None:
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: bytes) -> None:
+        await asyncio.to_thread(self.set, key, value)
+
+
+class MemoryCache(CacheBackend):
+    """プロセス内 LRU キャッシュ"""
+
+    def __init__(
+        self,
+        ttl_seconds: float = LLM_CACHE_TTL_SECONDS,
+        max_entries: int = LLM_CACHE_MAX_ENTRIES,
+        max_bytes: int = LLM_CACHE_MAX_BYTES,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._size += len(value)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        _, value = self._entries.pop(key)
+        self._size -= len(value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    async def aget(self, key: str) -> bytes | None:
+        return self.get(key)
+
+    async def aset(self, key: str, value: bytes) -> None:
+        self.set(key, value)
+
+
+class DiskCache(CacheBackend):
+    """ローカルディレクトリに保存するキャッシュ（有効期限はファイルの更新時刻で判定）"""
+
+    def __init__(self, directory: str = LLM_CACHE_DIR, ttl_seconds: float = LLM_CACHE_TTL_SECONDS):
+        self.directory = Path(directory)
+        self.ttl_seconds = ttl_seconds
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            if path.stat().st_mtime + self.ttl_seconds < time.time():
+                path.unlink(missing_ok=True)
+                return None
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, value: bytes) -> None:
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        # 書き込み途中のファイルを読まないよう、一時ファイルから置き換える
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(value)
+        tmp.replace(path)
+
+    def clear(self) -> None:
+        # ディレクトリ自体は残し、中身（キーの先頭2文字ごとのサブディレクトリ）を削除する
+        for child in self.directory.iterdir():
+            if child.is_dir():
+                shutil.rmtree(child, ignore_errors=True)
+            else:
+                child.unlink(missing_ok=True)
+
+
+class FirestoreCache(CacheBackend):
+    """Firestore に保存するキャッシュ
+
+    expiresAt フィールドに Firestore の TTL ポリシーを設定すると期限切れの値が自動で削除される。
+    クライアントは clients.get_firestore_client() を最初の読み書きで取得する。
+    キャッシュなので、Firestore のエラーは警告を出して「なし」として扱う。
+    """
+
+    def __init__(self, collection: str = LLM_CACHE_COLLECTION, ttl_seconds: float = LLM_CACHE_TTL_SECONDS):
+        self.collection_name = collection
+        self.ttl_seconds = ttl_seconds
+
+    @property
+    def collection(self):
+        return clients.get_firestore_client().collection(self.collection_name)
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            snapshot = self.collection.document(key).get()
+        except Exception as e:
+            print(f"Warning: Failed to read LLM cache ({self.collection_name}): {e}")
+            return None
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        if data["expiresAt"] < datetime.datetime.now(datetime.timezone.utc):
+            return None
+        return data["value"]
+
+    def set(self, key: str, value: bytes) -> None:
+        if len(value) > _FIRESTORE_MAX_VALUE_BYTES:
+            return
+        expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.ttl_seconds)
+        try:
+            self.collection.document(key).set({"value": value, "expiresAt": expires_at})
+        except Exception as e:
+            print(f"Warning: Failed to write LLM cache ({self.collection_name}): {e}")
+
+    def clear(self) -> None:
+        # コレクションのドキュメントをバッチで削除する
+        clients.get_firestore_client().recursive_delete(self.collection)
+
+
+def create_cache_backend(backend: str = LLM_CACHE_BACKEND, max_bytes: int = LLM_CACHE_MAX_BYTES) -> CacheBackend | None:
+    """backend（off / memory / disk / firestore）に応じたキャッシュを作成する（off なら None）
+
+    max_bytes は memory の合計サイズ上限。
+    """
+    try:
+        if backend == "memory":
+            return MemoryCache(max_bytes=max_bytes)
+        if backend == "disk":
+            return DiskCache()
+        if backend == "firestore":
+            return FirestoreCache()
+    except Exception as e:
+        print(f"Warning: Failed to initialize LLM cache ({backend}): {e}")
+    return None
+
+
+cache_backend = create_cache_backend()
+image_cache_backend = create_cache_backend(LLM_IMAGE_CACHE_BACKEND, max_bytes=LLM_IMAGE_CACHE_MAX_BYTES)
+
+
+def _record(kind: str, hit: bool) -> None:
+    metrics.inc("llm_cache_requests_total", kind=kind, result="hit" if hit else "miss")
+    hits = metrics.get_value("llm_cache_requests_total", kind=kind, result="hit")
+    misses = metrics.get_value("llm_cache_requests_total", kind=kind, result="miss")
+    metrics.set_gauge("llm_cache_hit_ratio", hits / (hits + misses), kind=kind)
+
+
+class LLMResponseCache(BaseCache):
+    """LangChain のチャットモデル用キャッシュ
+
+    LangChain が渡す llm_string にはモデル名・temperature・response_schema などの
+    呼び出しパラメータが含まれるため、(モデル, プロンプト, パラメータ) 単位でキャッシュされる。
+    """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return cache_key("text", prompt=prompt, llm=llm_string)
+
+    @staticmethod
+    def _encode(return_val: RETURN_VAL_TYPE) -> bytes:
+        # 本文と使用トークン数だけを保存する（任意オブジェクトの復元は行わない）
+        items = [
+            {
+                "text": generation.text,
+                "usage": getattr(getattr(generation, "message", None), "usage_metadata", None),
+            }
+            for generation in return_val
+        ]
+        return json.dumps(items, ensure_ascii=False).encode("utf-8")
+
+    @staticmethod
+    def _decode(value: bytes | None) -> RETURN_VAL_TYPE | None:
+        if value is None:
+            return None
+        generations: list[Generation] = []
+        for item in json.loads(value.decode("utf-8")):
+            # usage は元の呼び出しのもの。キャッシュから返したことを示し、トークン数・コストに数えないようにする
+            message = AIMessage(content=item["text"], usage_metadata=item["usage"], response_metadata={"cache_hit": True})
+            generations.append(ChatGeneration(message=message))
+        return generations
+
+    def lookup(self, prompt: str, llm_string: str) -> RETURN_VAL_TYPE | None:
+        value = self.backend.get(self._key(prompt, llm_string))
+        _record("text", value is not None)
+        return self._decode(value)
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        self.backend.set(self._key(prompt, llm_string), self._encode(return_val))
+
+    async def alookup(self, prompt: str, llm_string: str) -> RETURN_VAL_TYPE | None:
+        value = await self.backend.aget(self._key(prompt, llm_string))
+        _record("text", value is not None)
+        return self._decode(value)
+
+    async def aupdate(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        await self.backend.aset(self._key(prompt, llm_string), self._encode(return_val))
+
+    def clear(self, **kwargs: Any) -> None:
+        """バックエンドの値をすべて削除する（同じバックエンドに保存している場面の埋め込みも消える）"""
+        self.backend.clear()
+        print("Cleared LLM response cache")
+
+
+def llm_cache() -> LLMResponseCache | None:
+    """ChatVertexAI(cache=...) に渡すキャッシュ（無効なら None）"""
+    return LLMResponseCache(cache_backend) if cache_backend else None
+
+
+def image_cache_key(model: str, prompt: str, config: Any) -> str:
+    """画像生成のキャッシュキー"""
+    return cache_key("image", model=model, prompt=prompt, config=config)
+
+
+async def aget_image(key: str) -> bytes | None:
+    if image_cache_backend is None:
+        return None
+    value = await image_cache_backend.aget(key)
+    _record("image", value is not None)
+    return value
+
+
+async def aset_image(key: str, image_data: bytes) -> None:
+    if image_cache_backend is not None:
+        await image_cache_backend.aset(key, image_data)
@@ -0,0 +1,204 @@
+"""
+LLM 構造化出力ヘルパー
+
+Gemini に JSON スキーマ（response_schema / response_mime_type="application/json"）を
+指定して呼び出し、応答を Pydantic モデルで検証します。
+
+- コードブロック（```json ... ```）や前後の説明文が混ざっても JSON 部分を取り出す
+- 途中で切れた JSON は括弧・引用符を補って復元を試みる
+- それでも解釈できない場合は、元の会話を再送せずに「出力の修正」だけを安く再依頼する
+- ノードごとのパース失敗・再依頼・フォールバックの回数をメトリクスに記録する
+- 呼び出しはモデル・リージョンごとのレートリミッター（src/rate_limiter.py）を通す
+"""
+
+import json
+import os
+from typing import Any, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+from src import metrics, tracing
+from src.rate_limiter import PRIORITY_TEXT, limiter_for_llm
+
+# パース失敗時に修正を再依頼する最大回数
+LLM_PARSE_MAX_REASKS = int(os.getenv("LLM_PARSE_MAX_REASKS", "1"))
+
+T = TypeVar("T", bound=BaseModel)
+
+
+class LLMOutputError(ValueError):
+    """LLM の応答が期待するスキーマとして解釈できない"""
+
+
+def _strip_code_fence(content: str) -> str:
+    content = content.strip()
+    if "```json" in content:
+        content = content.split("```json", 1)[1]
+    elif "```" in content:
+        content = content.split("```", 1)[1]
+    else:
+        return content
+    return content.split("```", 1)[0].strip()
+
+
+def _recover_json(text: str) -> str:
+    """先頭の JSON 値を切り出す。途中で切れていれば括弧・引用符を補って閉じる"""
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        raise LLMOutputError("No JSON object or array found in response")
+    start = min(starts)
+
+    closers: list[str] = []
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]" and closers and closers[-1] == ch:
+            closers.pop()
+            if not closers:
+                return text[start : i + 1]
+
+    # 途中で切れている: 文字列・括弧を閉じる
+    fragment = text[start:]
+    if in_string:
+        fragment += '"'
+    fragment = fragment.rstrip().rstrip(",")
+    if fragment.endswith(":"):
+        fragment += " null"
+    return fragment + "".join(reversed(closers))
+
+
+def parse_json(content: str) -> Any:
+    """LLM の応答から JSON を取り出してパースする"""
+    text = _strip_code_fence(content)
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    try:
+        return json.loads(_recover_json(text))
+    except json.JSONDecodeError as e:
+        raise LLMOutputError(f"Invalid JSON in response: {e}") from e
+
+
+def parse_structured(content: str, schema: type[T]) -> T:
+    """LLM の応答をパースして Pydantic モデルで検証する"""
+    try:
+        return schema.model_validate(parse_json(content))
+    except ValidationError as e:
+        raise LLMOutputError(f"Response does not match {schema.__name__}: {e}") from e
+
+
+def json_schema_llm(llm, schema: type[BaseModel]):
+    """JSON スキーマ付きで出力させる LLM を返す（Gemini の制約付きデコード）"""
+    return llm.bind(
+        response_mime_type="application/json",
+        response_schema=schema.model_json_schema(),
+    )
+
+
+def _reask_prompt(schema: type[BaseModel], raw: str, error: Exception) -> str:
+    return f"""以下の出力は JSON スキーマに合わず解釈できませんでした。
+内容は変えずに、スキーマに合う JSON のみを出力してください。
+
+エラー: {error}
+
+スキーマ:
+{json.dumps(schema.model_json_schema(), ensure_ascii=False)}
+
+出力:
+{raw}
+"""
+
+
+def _content_text(response) -> str:
+    content = response.content
+    if isinstance(content, list):
+        # マルチパート応答はテキスト部分を連結する
+        content = "".join(p if isinstance(p, str) else p.get("text", "") for p in content)
+    return content
+
+
+def _invoke(llm, response) -> str:
+    """応答のトークン数を記録してテキストを返す"""
+    tracing.record_llm_usage(getattr(llm, "model_name", "llm"), response)
+    return _content_text(response)
+
+
+def _record_failure(node: str, error: Exception) -> None:
+    print(f"[{node}] Failed to parse LLM output: {error}")
+    metrics.inc("llm_parse_failures_total", node=node)
+
+
+def invoke_structured(
+    llm,
+    prompt: str,
+    schema: type[T],
+    node: str,
+    max_reasks: int = LLM_PARSE_MAX_REASKS,
+    priority: int = PRIORITY_TEXT,
+) -> T:
+    """スキーマ付きで LLM を呼び出し、検証済みのモデルを返す
+
+    パースに失敗した場合は max_reasks 回まで出力の修正を再依頼し、
+    それでも失敗すれば LLMOutputError を送出する。
+    """
+    structured = json_schema_llm(llm, schema)
+    limiter = limiter_for_llm(llm)
+    raw = _invoke(llm, limiter.call_sync(lambda: structured.invoke(prompt), priority))
+    for attempt in range(max_reasks + 1):
+        try:
+            return parse_structured(raw, schema)
+        except LLMOutputError as e:
+            _record_failure(node, e)
+            if attempt == max_reasks:
+                raise
+            metrics.inc("llm_parse_reasks_total", node=node)
+            tracing.record_retry()
+            reask = _reask_prompt(schema, raw, e)
+            raw = _invoke(llm, limiter.call_sync(lambda: structured.invoke(reask), priority))
+    raise AssertionError("unreachable")
+
+
+async def ainvoke_structured(
+    llm,
+    prompt: str,
+    schema: type[T],
+    node: str,
+    max_reasks: int = LLM_PARSE_MAX_REASKS,
+    priority: int = PRIORITY_TEXT,
+) -> T:
+    """invoke_structured の非同期版"""
+    structured = json_schema_llm(llm, schema)
+    limiter = limiter_for_llm(llm)
+    raw = _invoke(llm, await limiter.call(lambda: structured.ainvoke(prompt), priority))
+    for attempt in range(max_reasks + 1):
+        try:
+            return parse_structured(raw, schema)
+        except LLMOutputError as e:
+            _record_failure(node, e)
+            if attempt == max_reasks:
+                raise
+            metrics.inc("llm_parse_reasks_total", node=node)
+            tracing.record_retry()
+            reask = _reask_prompt(schema, raw, e)
+            raw = _invoke(llm, await limiter.call(lambda: structured.ainvoke(reask), priority))
+    raise AssertionError("unreachable")
+
+
+def record_fallback(node: str, error: Exception) -> None:
+    """ノードがフォールバック値を返したことを記録する"""
+    print(f"[{node}] Falling back to default output: {error}")
+    metrics.inc("llm_fallbacks_total", node=node)
@@ -1,35 +1,112 @@
+import asyncio
 import datetime
+import hashlib
 import os
+from contextlib import asynccontextmanager
 
-import google.auth
-import google.auth.transport.requests
-from fastapi import BackgroundTasks, FastAPI, Header, HTTPException, Depends
+# 起動プロファイルの基準時刻を取るため、ほかのモジュールより先に import する
+from src.startup import run_startup, startup_profile
+
+from fastapi import FastAPI, Header, HTTPException, Depends, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-from google.cloud import firestore
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from google.api_core.exceptions import AlreadyExists
 from pydantic import BaseModel
-import firebase_admin
-from firebase_admin import auth, credentials
 
-from src.models import ConversationLogRequest, DiaryResponse
+from src import clients, diary_reads, diary_store, discord_outbox, metrics
+from src.diary_reads import DIARY_LIST_DEFAULT_LIMIT, DIARY_LIST_MAX_LIMIT, CachedBody, read_cache
+from src.discord_outbox import DiscordDispatcher
+from src.firebase_auth import verify_firebase_token
+from src.job_queue import Job, QueueFullError, WorkerPool, create_job_queue
+from src.models import (
+    BatchDiaryRequest,
+    BatchDiaryResponse,
+    ConversationLogRequest,
+    DiaryListResponse,
+    DiaryResponse,
+    DiarySummary,
+)
+from src.progress import TERMINAL_STATUSES, format_sse, progress_broker
+from src.rate_limiter import deadline_scope
+from src.recovery import DIARY_RECOVERY_ENABLED, DiaryRecovery
+from src.request_limits import BodySizeLimitMiddleware
+from src.token_cache import access_token_cache
+
+# 絵日記生成ジョブのキュー（ワーカープールは lifespan で起動）
+diary_queue = create_job_queue("diaries")
+# Discord 通知のアウトボックス（ディスパッチャーは lifespan で起動）
+notification_queue = create_job_queue("discord")
+
+# 1件の絵日記生成に許す時間（Vertex AI の待ち・リトライはこの締め切りまで）
+DIARY_JOB_DEADLINE_SECONDS = float(os.getenv("DIARY_JOB_DEADLINE_SECONDS", "300"))
+
+# POST /diaries:batch で1回に受け付ける件数の上限
+BATCH_MAX_DIARIES = int(os.getenv("BATCH_MAX_DIARIES", "100"))
+
+
+async def run_diary_job(job: Job):
+    """ジョブキューから取り出した絵日記生成ジョブを実行"""
+    payload = job.payload
+    await process_diary_async(
+        payload["document_id"],
+        payload["conversation_log"],
+        payload.get("discord_webhook_url"),
+        payload.get("image_reuse_user"),
+    )
 
-app = FastAPI()
 
-# Firebase Admin 初期化
+async def fail_diary_job(job: Job):
+    """リトライ上限に達したジョブの日記を failed にする"""
+    document_id = job.payload["document_id"]
+    update = diary_store.failed_update("絵日記の生成が規定回数内に完了しませんでした。")
+    await diary_writer.update(document_id, update)
+    read_cache.invalidate(document_id, job.user_id)
+    # SSE の購読者に終了を知らせる（チャンネルを閉じる）
+    progress_broker.publish(document_id, "status", status="failed", error=update["error"])
+
+
+async def record_notification(document_id: str, status: dict):
+    """Discord 通知の配信状況を日記に記録する"""
+    await diary_writer.update(document_id, {"discordNotification": status})
+    read_cache.invalidate(document_id)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 画像保存用バケットの確認（と STARTUP_WARMUP のウォームアップ）はリクエストの受付を待たせずに行う。
+    # 終わるまで /health は 503 を返す
+    startup_task = asyncio.create_task(run_startup(), name="startup")
+    worker_pool = WorkerPool(diary_queue, run_diary_job, on_dead_letter=fail_diary_job)
+    worker_pool.start()
+    discord_dispatcher.start()
+    # 止まった絵日記（インスタンスの停止などで pending / processing のまま）を定期的に入れ直す
+    recovery = DiaryRecovery(get_db, diary_queue, notification_queue=notification_queue) if DIARY_RECOVERY_ENABLED else None
+    if recovery:
+        recovery.start()
+    yield
+    if recovery:
+        await recovery.stop()
+    startup_task.cancel()
+    await asyncio.gather(startup_task, return_exceptions=True)
+    await worker_pool.stop()
+    await discord_dispatcher.stop()
+    # 残っている書き込みを送ってから終了する
+    await diary_writer.stop()
+    await clients.aclose_clients()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Firebase Admin は最初のトークン検証で初期化する（src/firebase_auth.py）
 project_id = os.getenv("GOOGLE_CLOUD_PROJECT", "enikki-cloud")
 
-if not firebase_admin._apps:
-    try:
-        # 明示的にプロジェクトIDを指定して初期化
-        firebase_admin.initialize_app(options={'projectId': project_id})
-        print(f"Firebase Admin initialized for project: {project_id}")
-    except Exception as e:
-        print(f"Error initializing Firebase Admin: {e}")
-        firebase_admin.initialize_app()
-
 # CORS設定（環境変数から許可オリジンを取得）
 allowed_origins = os.getenv("ALLOWED_ORIGINS", "http://localhost:5173,http://localhost:3000")
 origins = [origin.strip() for origin in allowed_origins.split(",")]
 
+# 大きすぎるボディはパース前に 413 で断る（MAX_REQUEST_BODY_BYTES）
+# 後から追加したミドルウェアが外側になるので、413 にも CORS ヘッダーが付くよう CORS より先に追加する
+app.add_middleware(BodySizeLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -39,17 +116,6 @@ app.add_middleware(
 )
 
 
-# Firebase Token 検証
-def verify_firebase_token(x_firebase_token: str = Header(..., alias="X-Firebase-Token")):
-    """Firebase ID トークンを検証する"""
-    try:
-        decoded_token = auth.verify_id_token(x_firebase_token)
-        return decoded_token
-    except Exception as e:
-        print(f"Token verification failed: {e}")
-        raise HTTPException(status_code=401, detail="Invalid or expired Firebase token")
-
-
 class TokenResponse(BaseModel):
     accessToken: str
     expiresIn: int
@@ -57,14 +123,43 @@ class TokenResponse(BaseModel):
     region: str
 
 
-# Firestore クライアント初期化
-# ローカル開発などでプロジェクトIDが自動取得できない場合や、環境変数で指定したい場合に対応
-project_id = os.getenv("GOOGLE_CLOUD_PROJECT", "enikki-cloud")
-try:
-    db = firestore.Client(project=project_id)
-except Exception as e:
-    print(f"Warning: Failed to initialize Firestore client: {e}")
-    db = None
+# Firestore クライアントは初回利用時に作成する（import と認証情報の探索を起動時に行わない）
+_db = None
+_db_error: Exception | None = None
+
+
+def get_db():
+    """Firestore クライアント（作成できなければ None。失敗したら作り直さない）"""
+    global _db, _db_error
+    if _db is None and _db_error is None:
+        try:
+            _db = clients.get_firestore_client()
+        except Exception as e:
+            print(f"Warning: Failed to initialize Firestore client: {e}")
+            _db_error = e
+    return _db
+
+
+async def aget_db():
+    """get_db の非同期版（初回の作成はスレッドで行い、イベントループを止めない）"""
+    return _db if _db is not None else await asyncio.to_thread(get_db)
+
+
+# ステータス・結果の書き込みは非同期クライアントでまとめて送る（write-behind）
+diary_writer = diary_store.DiaryWriter(project=project_id)
+discord_dispatcher = DiscordDispatcher(notification_queue, on_status=record_notification)
+
+
+def _notification(document_id: str, conversation_log: dict, discord_webhook_url: str | None, result: dict) -> dict | None:
+    return discord_outbox.notification_payload(
+        document_id,
+        discord_webhook_url,
+        title=conversation_log.get("date") or "今日の絵日記",
+        diary_text=result.get("diary_text"),
+        image_url=result.get("image_url"),
+        image_renditions=result.get("image_renditions"),
+        keywords=result.get("keywords"),
+    )
 
 
 @app.get("/")
@@ -73,122 +168,452 @@ def read_root():
 
 
 @app.get("/health")
-def health_check():
+def health_check(response: Response):
+    """起動処理（STARTUP_WARMUP のウォームアップを含む）が終わるまでは 503"""
+    if not startup_profile.ready:
+        response.status_code = 503
+        return {"status": "starting"}
     return {"status": "ok"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus 形式のメトリクス（キュー深さなど）"""
+    return metrics.render_prometheus()
+
+
+@app.get("/metrics/startup")
+def get_startup_profile():
+    """起動の各段階の所要時間と、重いモジュールが読み込み済みか"""
+    return startup_profile.report()
+
+
+@app.get("/metrics/clients")
+def get_client_stats():
+    """共有クライアントの作成・再利用回数"""
+    return clients.connection_stats()
+
+
 @app.post("/auth/token", response_model=TokenResponse)
-def get_auth_token(decoded_token: dict = Depends(verify_firebase_token)):
+async def get_auth_token(decoded_token: dict = Depends(verify_firebase_token)):
     """
     Vertex AI (Multimodal Live API) 接続用のアクセストークンを発行する。
     フロントエンドはこのトークンを使って Gemini に直接接続する。
 
     認証: X-Firebase-Token ヘッダーが必要
+    トークンはプロセス内でキャッシュし、期限が近づいたらバックグラウンドで更新する。
+    expiresIn は実際の残り有効秒数。
     """
 
-    # デフォルト認証情報を取得
-    credentials, project = google.auth.default(
-        scopes=["https://www.googleapis.com/auth/cloud-platform"]
-    )
-
-    # トークンをリフレッシュして取得
-    auth_request = google.auth.transport.requests.Request()
-    credentials.refresh(auth_request)
+    access_token, expires_in = await access_token_cache.get_token()
 
     # 環境変数から設定を取得（デフォルト値付き）
-    project_id = os.getenv("GOOGLE_CLOUD_PROJECT", project or "enikki-cloud")
+    project_id = os.getenv("GOOGLE_CLOUD_PROJECT", access_token_cache.project or "enikki-cloud")
     region = os.getenv("GCP_REGION", "asia-northeast1")
 
     return TokenResponse(
-        accessToken=credentials.token,
-        expiresIn=3600,
+        accessToken=access_token,
+        expiresIn=expires_in,
         projectId=project_id,
         region=region,
     )
 
 
-def process_diary_in_background(document_id: str, conversation_log: dict, discord_webhook_url: str | None = None):
-    """バックグラウンドで絵日記ワークフローを実行"""
-    from src.diary_workflow import run_diary_workflow
+async def process_diary_async(
+    document_id: str,
+    conversation_log: dict,
+    discord_webhook_url: str | None = None,
+    image_reuse_user: str | None = None,
+):
+    """絵日記ワークフローを非同期で実行（ワーカーがスレッドを占有しない）
+
+    失敗したら例外をそのまま送出する。ワーカープールがジョブを再試行し、ワークフローは
+    チェックポイントから続きを実行する。再試行し尽くしたら fail_diary_job が failed にする。
+    """
+    from src.diary_workflow import aclear_checkpoints, run_diary_workflow_async
+
+    def on_event(event: str, data: dict):
+        progress_broker.publish(document_id, event, **data)
 
     try:
-        # ステータスを processing に更新
-        db.collection("diaries").document(document_id).update({
+        # ステータスを processing に更新（完了を待たない。結果の書き込みと1回にまとめられることがある）
+        diary_writer.update(document_id, {
             "status": "processing",
             "updatedAt": datetime.datetime.now(datetime.timezone.utc),
         })
+        progress_broker.publish(document_id, "status", status="processing")
+        read_cache.invalidate(document_id)
+
+        with deadline_scope(DIARY_JOB_DEADLINE_SECONDS):
+            result = await run_diary_workflow_async(
+                document_id, conversation_log, image_reuse_user=image_reuse_user, on_event=on_event
+            )
+
+        # 最終結果は永続化されるまで待つ（その後にジョブが ack される）。
+        # 通知するものは同じ書き込みで queued にしておく（送信はディスパッチャーが行い、完了を待たせない）
+        update_data = diary_store.result_update(result)
+        notification = _notification(document_id, conversation_log, discord_webhook_url, result)
+        if notification:
+            update_data["discordNotification"] = discord_outbox.notification_status("queued")
+        await diary_writer.update(document_id, update_data)
+        # 一覧・詳細のキャッシュに古いステータスが残らないようにする
+        read_cache.invalidate(document_id)
+        progress_broker.publish(
+            document_id,
+            "status",
+            status=update_data["status"],
+            keywords=update_data["keywords"],
+            diaryText=update_data["diaryText"],
+            imageUrl=update_data["imageUrl"],
+            imageRenditions=update_data["imageRenditions"],
+        )
+        print(f"Diary {document_id} completed successfully")
+    except Exception as e:
+        # status は processing のまま（チェックポイントを残して再試行する）
+        print(f"Error processing diary {document_id}: {e}")
+        raise
 
-        result = run_diary_workflow(document_id, conversation_log, discord_webhook_url=discord_webhook_url)
+    if notification:
+        await discord_dispatcher.enqueue(notification)
 
-        # ワークフロー結果で Firestore を更新
-        update_data = {
-            "status": result.get("status", "completed"),
-            "keywords": result.get("keywords"),
-            "diaryText": result.get("diary_text"),
-            "imageUrl": result.get("image_url"),
-            "updatedAt": datetime.datetime.now(datetime.timezone.utc),
-        }
-        if result.get("error"):
-            update_data["error"] = result["error"]
+    try:
+        await aclear_checkpoints(document_id)
+    except Exception as e:
+        print(f"Failed to clear checkpoints for diary {document_id}: {e}")
 
-        db.collection("diaries").document(document_id).update(update_data)
-        print(f"Diary {document_id} completed successfully")
+
+IDEMPOTENCY_TTL = datetime.timedelta(hours=24)
+# 冪等キーを登録してから日記を保存するまでの猶予。これを過ぎても日記がなければ、最初のリクエストは途中で落ちたとみなす
+IDEMPOTENCY_PENDING_TIMEOUT = datetime.timedelta(seconds=60)
+
+
+def _idempotency_ref(user_id: str, idempotency_key: str):
+    key_hash = hashlib.sha256(f"{user_id}:{idempotency_key}".encode("utf-8")).hexdigest()
+    return get_db().collection("idempotencyKeys").document(key_hash)
+
+
+def _claim_idempotency_key(user_id: str, idempotency_key: str, document_id: str) -> dict | None:
+    """
+    冪等キーを登録する。同じキーが既に登録済みなら、その内容（diaryId, createdAt）を返す。
+    expiresAt に Firestore の TTL ポリシーを設定すると古いキーは自動削除される。
+    """
+    ref = _idempotency_ref(user_id, idempotency_key)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        ref.create({"diaryId": document_id, "createdAt": now, "expiresAt": now + IDEMPOTENCY_TTL})
+        return None
+    except AlreadyExists:
+        snapshot = ref.get()
+        # 取得までの間にキーが解放された場合は登録し直す
+        return snapshot.to_dict() if snapshot.exists else _claim_idempotency_key(user_id, idempotency_key, document_id)
+
+
+def _release_idempotency_key(user_id: str, idempotency_key: str) -> None:
+    """受け付けなかったリクエストの冪等キーを解放する（再送時に改めて受け付けられるように）"""
+    try:
+        _idempotency_ref(user_id, idempotency_key).delete()
     except Exception as e:
-        # エラー時は Firestore にエラーを記録
-        print(f"Error processing diary {document_id}: {e}")
-        db.collection("diaries").document(document_id).update({
-            "status": "failed",
-            "error": str(e),
-            "updatedAt": datetime.datetime.now(datetime.timezone.utc),
-        })
+        print(f"Failed to release idempotency key: {e}")
+
+
+async def _replay_idempotent_request(
+    db, user_id: str, idempotency_key: str, claim: dict, document_id: str
+) -> DiaryResponse | None:
+    """
+    登録済みの冪等キーへの再送に応答する。
+    日記がまだ保存されていなければ 409（最初のリクエストが処理中）。猶予を過ぎても日記がなければ
+    最初のリクエストは途中で落ちたので、キーを document_id で登録し直して None を返す（新しいリクエストとして受け付ける）。
+    """
+    existing_id = claim["diaryId"]
+    snapshot = await asyncio.to_thread(db.collection("diaries").document(existing_id).get)
+    if snapshot.exists:
+        print(f"Idempotent replay for diary {existing_id}")
+        return DiaryResponse(id=existing_id, status=snapshot.to_dict().get("status", "pending"))
+
+    in_progress = HTTPException(
+        status_code=409,
+        detail="A request with this Idempotency-Key is still being processed",
+        headers={"Retry-After": "5"},
+    )
+    if datetime.datetime.now(datetime.timezone.utc) - claim["createdAt"] < IDEMPOTENCY_PENDING_TIMEOUT:
+        raise in_progress
+    print(f"Idempotency key for diary {existing_id} was claimed but the diary was never saved; claiming it again")
+    await asyncio.to_thread(_idempotency_ref(user_id, idempotency_key).delete)
+    if await asyncio.to_thread(_claim_idempotency_key, user_id, idempotency_key, document_id) is not None:
+        # 同時に届いた別の再送が先に登録した
+        raise in_progress
+    return None
 
 
 @app.post("/diaries", response_model=DiaryResponse)
-def create_diary(
+async def create_diary(
     request: ConversationLogRequest,
-    background_tasks: BackgroundTasks,
     decoded_token: dict = Depends(verify_firebase_token),
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key"),
 ):
     """
     会話ログ（要約データ）を受け取り、Firestoreに保存し、
-    バックグラウンドで LangGraph ワークフローを実行する。
+    ジョブキュー経由で LangGraph ワークフローを実行する。
+
+    Idempotency-Key ヘッダーを付けると、同じキーでの再送（リトライ・二重送信）には
+    最初に作成した日記の ID と現在のステータスを返し、ワークフローは再実行しない。
     """
     # トークンからUIDを取得
     user_id = decoded_token.get("uid", "unknown-user")
 
+    db = await aget_db()
     if not db:
         raise HTTPException(status_code=500, detail="Firestore database not connected")
 
+    # 自動生成IDを先に確保（冪等キーに紐づけるため）
+    doc_ref = db.collection("diaries").document()
+    document_id = doc_ref.id
+
+    if idempotency_key:
+        claim = await asyncio.to_thread(_claim_idempotency_key, user_id, idempotency_key, document_id)
+        if claim is not None:
+            replay = await _replay_idempotent_request(db, user_id, idempotency_key, claim, document_id)
+            if replay is not None:
+                return replay
+
+    # 受け付けられなかった場合（例外を含む）は finally で冪等キーを解放する
+    accepted = False
     try:
-        # 保存するデータの構築
-        doc_data = request.model_dump()
-        doc_data.update(
+        # キューが溢れている場合は Firestore に書き込む前に断る
+        if await diary_queue.is_full():
+            raise HTTPException(
+                status_code=503,
+                detail="Diary queue is full, please retry later",
+                headers={"Retry-After": "30"},
+            )
+
+        # 保存するデータの構築（transcript は圧縮して1つのフィールドにする）
+        request_data = request.model_dump()
+        doc_data = diary_store.pending_document(request_data, user_id)
+
+        # Firestore に保存（他のリクエストの書き込みとまとめて送られる）
+        await diary_writer.set(document_id, doc_data)
+        read_cache.invalidate_lists(user_id)
+
+        # 会話ログを構築（transcript は検証済みの dict をそのまま使う）
+        conversation_log = {"date": request_data["date"], "transcript": request_data["transcript"]}
+
+        # 進捗イベントの配信を開始（SSE で購読できるようにする）
+        progress_broker.publish(document_id, "status", status="pending")
+
+        # ジョブキューに積む（ワーカープールが並列数を制限して実行）
+        await diary_queue.enqueue(
+            user_id,
             {
-                "userId": user_id,
-                "status": "pending",  # 待機中
-                "createdAt": datetime.datetime.now(datetime.timezone.utc),
-                "updatedAt": datetime.datetime.now(datetime.timezone.utc),
-            }
+                "document_id": document_id,
+                "conversation_log": conversation_log,
+                "discord_webhook_url": request.discordWebhookUrl,
+                "image_reuse_user": diary_store.image_reuse_user(doc_data),
+            },
         )
 
-        # Firestore に保存 (自動生成ID)
-        update_time, doc_ref = db.collection("diaries").add(doc_data)
-        document_id = doc_ref.id
-
-        # 会話ログを構築
-        conversation_log = {
-            "date": request.date,
-            "transcript": [entry.model_dump() for entry in request.transcript],
-        }
-
-        # バックグラウンドでワークフローを実行
-        background_tasks.add_task(process_diary_in_background, document_id, conversation_log, request.discordWebhookUrl)
-
         # 即座に pending ステータスを返す
+        accepted = True
         return DiaryResponse(id=document_id, status="pending")
+    except HTTPException:
+        raise
+    except QueueFullError:
+        await diary_writer.update(document_id, diary_store.failed_update("queue full"))
+        progress_broker.publish(document_id, "status", status="failed", error="queue full")
+        raise HTTPException(
+            status_code=503,
+            detail="Diary queue is full, please retry later",
+            headers={"Retry-After": "30"},
+        )
+    except diary_store.TranscriptTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         print(f"Error creating diary: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to create diary: {str(e)}")
+    finally:
+        if idempotency_key and not accepted:
+            await asyncio.to_thread(_release_idempotency_key, user_id, idempotency_key)
+
+
+@app.post("/diaries:batch", response_model=BatchDiaryResponse)
+async def create_diaries_batch(
+    request: BatchDiaryRequest,
+    decoded_token: dict = Depends(verify_firebase_token),
+):
+    """
+    複数の会話ログから絵日記をまとめて作成する。
+
+    pending ドキュメントはバッチでまとめて作成し、ジョブもまとめてキューに積む。
+    実行の並列数はワーカープール（JOB_QUEUE_WORKERS）で制限される。
+    キューに全件入らない場合は何も作成せずに 503 を返す。
+    """
+    user_id = decoded_token.get("uid", "unknown-user")
+
+    db = await aget_db()
+    if not db:
+        raise HTTPException(status_code=500, detail="Firestore database not connected")
+    if not request.diaries:
+        raise HTTPException(status_code=400, detail="No diaries in request")
+    if len(request.diaries) > BATCH_MAX_DIARIES:
+        raise HTTPException(status_code=413, detail=f"Too many diaries (max {BATCH_MAX_DIARIES})")
+
+    if await diary_queue.is_full(len(request.diaries)):
+        raise HTTPException(
+            status_code=503,
+            detail="Diary queue is full, please retry later",
+            headers={"Retry-After": "30"},
+        )
+
+    diaries = request.model_dump()["diaries"]
+    try:
+        writes = [
+            (db.collection("diaries").document(), diary_store.pending_document(diary, user_id)) for diary in diaries
+        ]
+    except diary_store.TranscriptTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    try:
+        await asyncio.gather(*(diary_writer.set(doc_ref.id, doc_data) for doc_ref, doc_data in writes))
+        read_cache.invalidate_lists(user_id)
+
+        payloads = []
+        for (doc_ref, doc_data), diary in zip(writes, diaries):
+            progress_broker.publish(doc_ref.id, "status", status="pending")
+            payloads.append(
+                {
+                    "document_id": doc_ref.id,
+                    "conversation_log": {"date": diary["date"], "transcript": diary["transcript"]},
+                    "discord_webhook_url": diary["discordWebhookUrl"],
+                    "image_reuse_user": diary_store.image_reuse_user(doc_data),
+                }
+            )
+        await diary_queue.enqueue_many(user_id, payloads)
+    except QueueFullError:
+        await asyncio.gather(
+            *(diary_writer.update(doc_ref.id, diary_store.failed_update("queue full")) for doc_ref, _ in writes)
+        )
+        for doc_ref, _ in writes:
+            progress_broker.publish(doc_ref.id, "status", status="failed", error="queue full")
+        raise HTTPException(
+            status_code=503,
+            detail="Diary queue is full, please retry later",
+            headers={"Retry-After": "30"},
+        )
+    except Exception as e:
+        print(f"Error creating diaries: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to create diaries: {str(e)}")
+
+    metrics.inc("diary_batch_diaries_total", len(writes))
+    return BatchDiaryResponse(diaries=[DiaryResponse(id=doc_ref.id, status="pending") for doc_ref, _ in writes])
+
+
+def _cached_response(cached: CachedBody, if_none_match: str | None) -> Response:
+    """キャッシュした本文を ETag 付きで返す。If-None-Match が一致すれば 304"""
+    # ブラウザのキャッシュは毎回 If-None-Match で確認させる（ユーザーごとの内容なので共有キャッシュには置かない）
+    headers = {"ETag": cached.etag, "Cache-Control": "private, no-cache", "Vary": "X-Firebase-Token"}
+    if diary_reads.etag_matches(if_none_match, cached.etag):
+        metrics.inc("diary_read_not_modified_total")
+        return Response(status_code=304, headers=headers)
+    return Response(content=cached.body, media_type="application/json", headers=headers)
+
+
+@app.get("/diaries", response_model=DiaryListResponse)
+async def list_diaries(
+    limit: int = Query(DIARY_LIST_DEFAULT_LIMIT, ge=1, le=DIARY_LIST_MAX_LIMIT),
+    cursor: str | None = None,
+    decoded_token: dict = Depends(verify_firebase_token),
+    if_none_match: str | None = Header(None, alias="If-None-Match"),
+):
+    """
+    ログイン中のユーザーの日記を新しい順に返す。
+
+    transcript は含めず、表示に必要なフィールドだけを返す。
+    続きはレスポンスの nextCursor を cursor に渡して取得する（null なら最後のページ）。
+    """
+    user_id = decoded_token.get("uid", "unknown-user")
+    key = read_cache.list_key(user_id, cursor, limit)
+    cached = read_cache.get(key)
+    if cached is None:
+        db = await aget_db()
+        if not db:
+            raise HTTPException(status_code=500, detail="Firestore database not connected")
+        try:
+            items, next_cursor = await asyncio.to_thread(diary_reads.list_page, db, user_id, limit, cursor)
+        except diary_reads.InvalidCursorError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        body = DiaryListResponse(diaries=items, nextCursor=next_cursor).model_dump_json().encode("utf-8")
+        cached = CachedBody(body, user_id, [item["id"] for item in items])
+        read_cache.set(key, cached)
+    return _cached_response(cached, if_none_match)
+
+
+@app.get("/diaries/{document_id}", response_model=DiarySummary)
+async def get_diary(
+    document_id: str,
+    decoded_token: dict = Depends(verify_firebase_token),
+    if_none_match: str | None = Header(None, alias="If-None-Match"),
+):
+    """ログイン中のユーザーの日記を1件返す（transcript は含めない）"""
+    user_id = decoded_token.get("uid", "unknown-user")
+    key = read_cache.detail_key(document_id)
+    cached = read_cache.get(key)
+    if cached is None:
+        db = await aget_db()
+        if not db:
+            raise HTTPException(status_code=500, detail="Firestore database not connected")
+        item = await asyncio.to_thread(diary_reads.get_diary, db, document_id, user_id)
+        if item is None:
+            raise HTTPException(status_code=404, detail="Diary not found")
+        body = DiarySummary(**item).model_dump_json().encode("utf-8")
+        cached = CachedBody(body, user_id, [document_id])
+        read_cache.set(key, cached)
+    elif cached.owner != user_id:
+        raise HTTPException(status_code=404, detail="Diary not found")
+    return _cached_response(cached, if_none_match)
+
+
+@app.get("/diaries/{document_id}/events")
+async def stream_diary_events(document_id: str, decoded_token: dict = Depends(verify_firebase_token)):
+    """
+    絵日記生成の進捗を Server-Sent Events で配信する。
+
+    イベント:
+    - status: {"status": "pending" | "processing" | "completed" | "failed", ...}
+    - node: {"node": ノード名, ...そのノードが更新した値}
+    - token: {"text": 生成中の日記テキストの断片}
+    - snapshot: このインスタンスに進捗がない場合の現在の状態（受信後に接続を閉じる）
+    """
+    db = await aget_db()
+    if not db:
+        raise HTTPException(status_code=500, detail="Firestore database not connected")
+
+    snapshot = await asyncio.to_thread(db.collection("diaries").document(document_id).get)
+    if not snapshot.exists or snapshot.to_dict().get("userId") != decoded_token.get("uid"):
+        raise HTTPException(status_code=404, detail="Diary not found")
+
+    async def events():
+        if not progress_broker.has_channel(document_id):
+            # 別インスタンスで実行中、または進捗の保持期間が過ぎている
+            data = snapshot.to_dict()
+            yield format_sse({
+                "event": "snapshot",
+                "data": {
+                    "status": data.get("status"),
+                    "keywords": data.get("keywords"),
+                    "diaryText": data.get("diaryText"),
+                    "imageUrl": data.get("imageUrl"),
+                    "imageRenditions": data.get("imageRenditions"),
+                    "final": data.get("status") in TERMINAL_STATUSES,
+                },
+            })
+            return
+        async for message in progress_broker.subscribe(document_id):
+            yield format_sse(message)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.get("/diary/stub")
@@ -197,3 +622,6 @@ def get_stub_diary():
         "imageSrc": "https://images.unsplash.com/photo-1516934024742-b461fba47600?w=800&auto=format&fit=crop&q=60&ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxzZWFyY2h8MTB8fHN1bW1lciUyMHZpYmV8ZW58MHx8MHx8fDA%3D",
         "text": "今日はとても良い天気でした。近くの公園まで散歩に行きました。セミの声がたくさん聞こえて、夏を感じました。お昼には冷たいそうめんを食べました。",
     }
+
+
+startup_profile.mark("app_imported")
@@ -0,0 +1,109 @@
+"""
+メトリクス
+
+プロセス内でカウンター・ゲージ・ヒストグラムを集計し、Prometheus テキスト形式で出力します。
+外部ライブラリには依存せず、各モジュールから `inc` / `set_gauge` / `observe` で記録します。
+"""
+
+import bisect
+import threading
+
+# レイテンシ（秒）用のデフォルトのバケット
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+_lock = threading.Lock()
+_counters: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+_gauges: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+# (名前, ラベル) -> [バケット上限, バケットごとの件数, 合計, 件数]
+_histograms: dict[tuple[str, tuple[tuple[str, str], ...]], list] = {}
+
+
+def _key(name: str, labels: dict[str, object]) -> tuple[str, tuple[tuple[str, str], ...]]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1.0, **labels: object) -> None:
+    """カウンターを加算する"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0.0) + value
+
+
+def set_gauge(name: str, value: float, **labels: object) -> None:
+    """ゲージの値を設定する"""
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = float(value)
+
+
+def observe(name: str, value: float, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **labels: object) -> None:
+    """ヒストグラムに値を記録する（バケットは最初の記録時のものを使う）"""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [tuple(buckets), [0] * len(buckets), 0.0, 0]
+        bounds, counts, _, _ = histogram
+        index = bisect.bisect_left(bounds, value)
+        if index < len(counts):
+            counts[index] += 1
+        histogram[2] += value
+        histogram[3] += 1
+
+
+def get_value(name: str, **labels: object) -> float:
+    """カウンターまたはゲージの現在値を取得する（未記録なら 0）"""
+    key = _key(name, labels)
+    with _lock:
+        return _counters.get(key, _gauges.get(key, 0.0))
+
+
+def snapshot() -> dict[str, dict[str, float]]:
+    """全メトリクスを {名前: {ラベル文字列: 値}} 形式で返す"""
+    result: dict[str, dict[str, float]] = {}
+    with _lock:
+        items = list(_counters.items()) + list(_gauges.items())
+        for (name, labels), (_, _, total, count) in _histograms.items():
+            items.append(((f"{name}_sum", labels), total))
+            items.append(((f"{name}_count", labels), float(count)))
+    for (name, labels), value in items:
+        result.setdefault(name, {})[_format_labels(labels)] = value
+    return result
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    inner = ",".join(f'{k}="{v}"' for k, v in labels)
+    return "{" + inner + "}"
+
+
+def render_prometheus() -> str:
+    """Prometheus テキスト形式（exposition format）で出力する"""
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted((key, (h[0], list(h[1]), h[2], h[3])) for key, h in _histograms.items())
+
+    lines: list[str] = []
+    for kind, items in (("counter", counters), ("gauge", gauges)):
+        declared: set[str] = set()
+        for (name, labels), value in items:
+            if name not in declared:
+                lines.append(f"# TYPE {name} {kind}")
+                declared.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    declared = set()
+    for (name, labels), (bounds, counts, total, count) in histograms:
+        if name not in declared:
+            lines.append(f"# TYPE {name} histogram")
+            declared.add(name)
+        cumulative = 0
+        for bound, bucket_count in zip(bounds, counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
@@ -1,13 +1,25 @@
 """Pydantic モデル定義"""
 
-from pydantic import BaseModel
+import os
+from typing import Annotated
 
+from pydantic import BaseModel, Field
+from typing_extensions import TypedDict
 
-class TranscriptEntry(BaseModel):
-    """会話 transcript の1エントリ"""
+# 1件の会話ログで受け付ける transcript の上限
+MAX_TRANSCRIPT_ENTRIES = int(os.getenv("MAX_TRANSCRIPT_ENTRIES", "2000"))
+MAX_TRANSCRIPT_TEXT_CHARS = int(os.getenv("MAX_TRANSCRIPT_TEXT_CHARS", "4000"))
+
+
+class TranscriptEntry(TypedDict):
+    """会話 transcript の1エントリ
+
+    件数が多いため BaseModel ではなく TypedDict にしている（検証後も dict のまま扱い、
+    エントリごとのオブジェクト生成と model_dump を避ける）。
+    """
 
     role: str  # 'user' or 'model'
-    text: str
+    text: Annotated[str, Field(max_length=MAX_TRANSCRIPT_TEXT_CHARS)]
     timestamp: int  # Unix ms
 
 
@@ -15,8 +27,9 @@ class ConversationLogRequest(BaseModel):
     """会話ログ（date + transcript）のリクエストモデル"""
 
     date: str  # ブラウザから取得した日付 (例: 2024-01-01)
-    transcript: list[TranscriptEntry]
+    transcript: list[TranscriptEntry] = Field(max_length=MAX_TRANSCRIPT_ENTRIES)
     discordWebhookUrl: str | None = None  # ユーザーが設定した Discord Webhook URL
+    imageReuse: bool = True  # false なら似た場面の画像を再利用しない（src/image_semantic_cache.py）
 
 
 class DiaryResponse(BaseModel):
@@ -24,3 +37,38 @@ class DiaryResponse(BaseModel):
 
     id: str
     status: str
+
+
+class BatchDiaryRequest(BaseModel):
+    """絵日記の一括作成リクエスト"""
+
+    diaries: list[ConversationLogRequest]
+
+
+class BatchDiaryResponse(BaseModel):
+    """絵日記の一括作成レスポンス（リクエストと同じ順序）"""
+
+    diaries: list[DiaryResponse]
+
+
+class DiarySummary(BaseModel):
+    """GET /diaries・GET /diaries/{id} で返す日記（transcript は含めない）"""
+
+    id: str
+    date: str | None = None
+    status: str | None = None
+    keywords: list[str] | None = None
+    diaryText: str | None = None
+    imageUrl: str | None = None
+    imageRenditions: dict[str, str] | None = None
+    error: str | None = None
+    discordNotification: dict | None = None  # Discord 通知の配信状況（status / attempts / error / updatedAt）
+    createdAt: str | None = None
+    updatedAt: str | None = None
+
+
+class DiaryListResponse(BaseModel):
+    """日記一覧のレスポンス（nextCursor が null なら最後のページ）"""
+
+    diaries: list[DiarySummary]
+    nextCursor: str | None = None
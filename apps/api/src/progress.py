@@ -0,0 +1,94 @@
+"""
+絵日記生成の進捗イベント
+
+ワークフロー実行中の進捗（ノード完了、日記テキストのトークン、品質スコア、画像 URL など）を
+プロセス内で配信します。GET /diaries/{id}/events の SSE はここを購読します。
+
+イベントは日記ごとに履歴として保持するため、途中から購読しても最初から受け取れます。
+終了イベント（completed / failed）の後、履歴は PROGRESS_HISTORY_TTL_SECONDS 秒で破棄されます。
+"""
+
+import asyncio
+import json
+import os
+import time
+from typing import AsyncIterator
+
+PROGRESS_HISTORY_TTL_SECONDS = float(os.getenv("PROGRESS_HISTORY_TTL_SECONDS", "300"))
+PROGRESS_HEARTBEAT_SECONDS = float(os.getenv("PROGRESS_HEARTBEAT_SECONDS", "15"))
+
+TERMINAL_STATUSES = ("completed", "failed")
+
+
+class _Channel:
+    def __init__(self):
+        self.history: list[dict] = []
+        self.subscribers: set[asyncio.Queue] = set()
+        self.closed_at: float | None = None
+
+
+class ProgressBroker:
+    """日記ごとの進捗イベントを配信する"""
+
+    def __init__(self, history_ttl: float = PROGRESS_HISTORY_TTL_SECONDS):
+        self.history_ttl = history_ttl
+        self._channels: dict[str, _Channel] = {}
+
+    def _sweep(self) -> None:
+        now = time.monotonic()
+        for document_id, channel in list(self._channels.items()):
+            if channel.closed_at is not None and channel.closed_at + self.history_ttl < now:
+                del self._channels[document_id]
+
+    def has_channel(self, document_id: str) -> bool:
+        return document_id in self._channels
+
+    def publish(self, document_id: str, event: str, **data) -> None:
+        """イベントを配信する。status が completed / failed ならチャンネルを閉じる"""
+        if document_id not in self._channels:
+            self._sweep()
+        channel = self._channels.setdefault(document_id, _Channel())
+        message = {"event": event, "data": data}
+        channel.history.append(message)
+        for queue in channel.subscribers:
+            queue.put_nowait(message)
+        if event == "status" and data.get("status") in TERMINAL_STATUSES:
+            channel.closed_at = time.monotonic()
+            for queue in channel.subscribers:
+                queue.put_nowait(None)
+
+    async def subscribe(self, document_id: str) -> AsyncIterator[dict | None]:
+        """履歴と以降のイベントを返す。一定時間イベントがなければ None（ハートビート用）を返す"""
+        channel = self._channels.setdefault(document_id, _Channel())
+        queue: asyncio.Queue = asyncio.Queue()
+        for message in channel.history:
+            queue.put_nowait(message)
+        if channel.closed_at is not None:
+            # 終了済み: 履歴だけ返して終わる
+            queue.put_nowait(None)
+        else:
+            channel.subscribers.add(queue)
+
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=PROGRESS_HEARTBEAT_SECONDS)
+                except TimeoutError:
+                    yield None
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            channel.subscribers.discard(queue)
+
+
+def format_sse(message: dict | None) -> str:
+    """Server-Sent Events 形式に変換する（None はコメント行のハートビート）"""
+    if message is None:
+        return ": heartbeat\n\n"
+    data = json.dumps(message["data"], ensure_ascii=False)
+    return f"event: {message['event']}\ndata: {data}\n\n"
+
+
+progress_broker = ProgressBroker()
@@ -0,0 +1,175 @@
+"""
+日記テキストのローカル品質スコア（品質チェックの前段）
+
+check_quality の評価基準の多くは機械的に判定できます（文字数・「今日は」で始まるか・ですます調でないか・
+五感や気持ちの表現があるか）。ここでは LLM を呼ばずに文字数・正規表現・文字種の特徴からスコアを付け、
+はっきり良い下書きは合格、はっきり悪い下書きは不合格にして、境界の下書きだけ LLM の判定に回します。
+
+- 特徴ごとのスコア（0.0-1.0）を QUALITY_PRESCORE_WEIGHTS の重みで平均する
+- QUALITY_PRESCORE_ACCEPT 以上なら合格、QUALITY_PRESCORE_REJECT 以下なら不合格、その間は LLM に回す
+- 50文字未満・300文字超、文の半分以上がですます調、日本語でない下書きはスコアによらず不合格
+- QUALITY_PRESCORE=shadow（既定）のときはスコアとメトリクスだけ記録して常に LLM で判定する（しきい値の調整用）
+
+既定のしきい値と重みはまだラベル付きのコーパスで検証していません。on にする前に
+benchmarks/quality_calibration.py で LLM のスコアとの一致率を見て決めてください。
+"""
+
+import os
+import re
+from dataclasses import dataclass, field
+
+from src import metrics
+
+QUALITY_PRESCORE = os.getenv("QUALITY_PRESCORE", "shadow")  # off / shadow / on
+QUALITY_PRESCORE_ACCEPT = float(os.getenv("QUALITY_PRESCORE_ACCEPT", "0.85"))
+QUALITY_PRESCORE_REJECT = float(os.getenv("QUALITY_PRESCORE_REJECT", "0.35"))
+
+DEFAULT_WEIGHTS = {
+    "length": 0.25,  # 100〜200文字か
+    "opening": 0.15,  # 「今日は」で始まるか
+    "casual": 0.2,  # ですます調でないか
+    "sensory": 0.15,  # 五感の描写があるか
+    "emotion": 0.1,  # 気持ちの表現があるか
+    "childlike": 0.1,  # ひらがなが多い子供らしい表記か
+    "clean": 0.05,  # 見出し・説明・英文などが混ざっていないか
+}
+
+# 文字数の満点の範囲と、0点になる下限・上限
+LENGTH_RANGE = (100, 200)
+LENGTH_LIMITS = (50, 300)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_OPENING_RE = re.compile(r"^[「『]?(今日|きょう)は")
+_SENTENCE_RE = re.compile(r"[^。！？!?\n]+[。！？!?]?")
+_POLITE_RE = re.compile(r"(です|ます|でした|ました|ません|でしょう|ましょう)[よねか]?[）)」』]?$")
+_SENSORY_RE = re.compile(
+    r"におい|匂い|香り|かおり|音|声|味|あじ|甘|あま[いか]|しょっぱ|すっぱ|にが[いか]|苦[いか]|からい|辛[いか]|"
+    r"つめた|冷た|あつ[いか]|熱[いか]|暑|あたたか|暖|温|やわらか|柔らか|かた[いか]|ふわ|ふか|ぬる|"
+    r"ベタ|べた|ざら|つる|ぴか|キラ|きら|まぶし|ひんやり|ぽかぽか|しっとり|"
+    r"([ァ-ヴ]{2})\1|([ぁ-ゔ]{2})\2|[ぁ-ゔァ-ヴ]っと"
+)
+_EMOTION_RE = re.compile(
+    r"たのし|楽し|うれし|嬉し|よろこ|喜|わくわく|ワクワク|どきどき|ドキドキ|びっくり|おどろ|驚|"
+    r"さいこう|最高|すごい|すごかった|やった|くやし|悔し|かなし|悲し|さみし|寂し|こわ[いかく]|怖|"
+    r"おもしろ|面白|すき|好き|しあわせ|幸せ|ほっと|がっかり|[！!]"
+)
+_META_RE = re.compile(r"^#|\*\*|^[-・]\s|絵日記テキスト|以下|出力|説明|注釈|[A-Za-z]{4,}", re.MULTILINE)
+_HIRAGANA_RE = re.compile(r"[ぁ-ゖー]")
+_JAPANESE_RE = re.compile(r"[ぁ-ゖァ-ヺー一-鿿々]")
+
+
+def parse_weights(spec: str | None) -> dict[str, float]:
+    """"length=0.3,opening=0.1" 形式の重み指定を読む（指定のない特徴は既定の重み）"""
+    weights = dict(DEFAULT_WEIGHTS)
+    for part in (spec or "").split(","):
+        if not part.strip():
+            continue
+        name, _, value = part.partition("=")
+        name = name.strip()
+        if name not in DEFAULT_WEIGHTS:
+            raise ValueError(f"Unknown quality prescore feature: {name}")
+        weights[name] = float(value)
+    return weights
+
+
+QUALITY_PRESCORE_WEIGHTS = parse_weights(os.getenv("QUALITY_PRESCORE_WEIGHTS"))
+
+
+@dataclass
+class Prescore:
+    """ローカル品質スコアと判定（accept / reject / escalate）"""
+
+    score: float
+    decision: str
+    features: dict[str, float] = field(default_factory=dict)
+
+
+def _length_score(length: int) -> float:
+    low, high = LENGTH_RANGE
+    min_length, max_length = LENGTH_LIMITS
+    if low <= length <= high:
+        return 1.0
+    if length < low:
+        return max(0.0, (length - min_length) / (low - min_length))
+    return max(0.0, (max_length - length) / (max_length - high))
+
+
+def _casual_score(text: str) -> float:
+    sentences = [s.strip() for s in _SENTENCE_RE.findall(text) if s.strip()]
+    if not sentences:
+        return 0.0
+    polite = sum(1 for s in sentences if _POLITE_RE.search(s.rstrip("。！？!?")))
+    return 1.0 - polite / len(sentences)
+
+
+def _childlike_score(text: str) -> float:
+    japanese = len(_JAPANESE_RE.findall(text))
+    if not japanese:
+        return 0.0
+    # 子供の作文はひらがなが多い（大人の文章はおよそ5割、絵日記は6〜7割）
+    ratio = len(_HIRAGANA_RE.findall(text)) / japanese
+    return min(1.0, max(0.0, (ratio - 0.4) / 0.25))
+
+
+def features(diary_text: str) -> dict[str, float]:
+    """特徴ごとのスコア（0.0-1.0）"""
+    text = diary_text.strip()
+    length = len(_WHITESPACE_RE.sub("", text))
+    return {
+        "length": _length_score(length),
+        "opening": 1.0 if _OPENING_RE.match(text) else 0.0,
+        "casual": _casual_score(text),
+        "sensory": 1.0 if _SENSORY_RE.search(text) else 0.0,
+        "emotion": 1.0 if _EMOTION_RE.search(text) else 0.0,
+        "childlike": _childlike_score(text),
+        "clean": 0.0 if _META_RE.search(text) else 1.0,
+    }
+
+
+def prescore(
+    diary_text: str | None,
+    weights: dict[str, float] | None = None,
+    accept: float = QUALITY_PRESCORE_ACCEPT,
+    reject: float = QUALITY_PRESCORE_REJECT,
+) -> Prescore:
+    """日記テキストのローカル品質スコアと判定"""
+    if not diary_text or not diary_text.strip():
+        return Prescore(score=0.0, decision="reject")
+    weights = weights or QUALITY_PRESCORE_WEIGHTS
+    values = features(diary_text)
+    total = sum(weights.values()) or 1.0
+    score = sum(values[name] * weight for name, weight in weights.items()) / total
+    japanese_ratio = len(_JAPANESE_RE.findall(diary_text)) / max(1, len(_WHITESPACE_RE.sub("", diary_text)))
+    if values["length"] == 0.0 or values["casual"] < 0.5 or japanese_ratio < 0.5:
+        # 明らかな違反（短すぎる・長すぎる、半分以上がですます調、日本語でない）はスコアによらず不合格
+        decision = "reject"
+    elif score >= accept:
+        decision = "accept"
+    elif score <= reject:
+        decision = "reject"
+    else:
+        decision = "escalate"
+    return Prescore(score=score, decision=decision, features=values)
+
+
+def evaluate(diary_text: str | None) -> Prescore | None:
+    """品質チェックの前にローカルスコアを付けて記録する（QUALITY_PRESCORE=off なら None）"""
+    if QUALITY_PRESCORE == "off":
+        return None
+    result = prescore(diary_text)
+    metrics.inc("quality_prescore_total", decision=result.decision, mode=QUALITY_PRESCORE)
+    metrics.observe("quality_prescore_score", result.score)
+    return result
+
+
+def is_decisive(result: Prescore | None) -> bool:
+    """LLM の判定を省いてよいか（shadow では常に LLM で判定する）"""
+    return result is not None and QUALITY_PRESCORE == "on" and result.decision != "escalate"
+
+
+def record_agreement(result: Prescore | None, llm_score: float, threshold: float) -> None:
+    """LLM で判定した下書きについて、ローカルの判定と一致したかを記録する"""
+    if result is None or result.decision == "escalate":
+        return
+    agree = (result.decision == "accept") == (llm_score >= threshold)
+    metrics.inc("quality_prescore_agreement_total", decision=result.decision, agree=str(agree).lower())
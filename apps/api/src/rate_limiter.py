@@ -0,0 +1,235 @@
+"""
+Vertex AI 呼び出しのレート制限とリトライ
+
+多数の絵日記を並行して生成すると、Gemini / 画像モデルが 429 (RESOURCE_EXHAUSTED) を返し、
+各ノードがフォールバック（プレースホルダー画像や定型文）に落ちてしまいます。
+ここではモデル・リージョンごとに AIMD で送信レートを調整するトークンバケットを共有し、
+呼び出しをクォータに合わせて流します。
+
+- 成功するたびにレートを少しずつ上げ、スロットリングされたら半分に下げる（AIMD）
+- 一時的なエラーはジッター付き指数バックオフでリトライする
+- ジョブの締め切り（deadline_scope）を超える待ち・リトライは行わず DeadlineExceededError を送出する
+- 同じバケットでは優先度の高い呼び出し（日記本文の生成）を先に通す
+
+現在のレートとスロットリング回数は /metrics の rate_limit_* で確認できます。
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import os
+import random
+import threading
+import time
+from typing import Awaitable, Callable, TypeVar
+
+from google.api_core import exceptions as gexc
+
+from src import metrics, tracing
+
+VERTEX_RATE_LIMIT_INITIAL_RPS = float(os.getenv("VERTEX_RATE_LIMIT_INITIAL_RPS", "5"))
+VERTEX_RATE_LIMIT_MIN_RPS = float(os.getenv("VERTEX_RATE_LIMIT_MIN_RPS", "0.2"))
+VERTEX_RATE_LIMIT_MAX_RPS = float(os.getenv("VERTEX_RATE_LIMIT_MAX_RPS", "50"))
+VERTEX_MAX_RETRIES = int(os.getenv("VERTEX_MAX_RETRIES", "5"))
+VERTEX_RETRY_BASE_SECONDS = float(os.getenv("VERTEX_RETRY_BASE_SECONDS", "1"))
+VERTEX_RETRY_MAX_SECONDS = float(os.getenv("VERTEX_RETRY_MAX_SECONDS", "30"))
+
+# 優先度（小さいほど先に通す）
+PRIORITY_TEXT = 0  # 日記本文までのテキスト生成
+PRIORITY_IMAGE = 1  # 画像生成と、そのための英訳
+
+# スロットリングが続けて届いてもレートを下げるのはこの間隔に1回まで
+_DECREASE_COOLDOWN_SECONDS = 1.0
+
+T = TypeVar("T")
+
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("vertex_deadline", default=None)
+
+
+class DeadlineExceededError(Exception):
+    """ジョブの締め切りまでに呼び出しを完了できない"""
+
+
+@contextlib.contextmanager
+def deadline_scope(seconds: float | None):
+    """このスコープ内（と、そこから起動したタスク）の呼び出しに締め切りを設定する"""
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def _remaining() -> float | None:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def is_retryable(error: Exception) -> bool:
+    """スロットリング・一時的なエラーかどうか"""
+    if isinstance(
+        error,
+        (gexc.TooManyRequests, gexc.ResourceExhausted, gexc.ServiceUnavailable, gexc.InternalServerError),
+    ):
+        return True
+    # google-genai の APIError などは HTTP ステータスを code に持つ
+    return getattr(error, "code", None) in (429, 500, 503)
+
+
+def is_throttled(error: Exception) -> bool:
+    return isinstance(error, (gexc.TooManyRequests, gexc.ResourceExhausted)) or getattr(error, "code", None) == 429
+
+
+class AdaptiveRateLimiter:
+    """AIMD で送信レートを調整するトークンバケット（スレッド・イベントループの両方から使える）"""
+
+    def __init__(
+        self,
+        name: str,
+        rate: float = VERTEX_RATE_LIMIT_INITIAL_RPS,
+        min_rate: float = VERTEX_RATE_LIMIT_MIN_RPS,
+        max_rate: float = VERTEX_RATE_LIMIT_MAX_RPS,
+    ):
+        self.name = name
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._waiting = [0, 0]  # 優先度ごとの待ち数
+        self._lock = threading.Lock()
+        metrics.set_gauge("rate_limit_rps", self.rate, limiter=name)
+
+    def _try_acquire(self, priority: int) -> float:
+        """トークンを取れれば 0、取れなければ次に試すまでの秒数を返す"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(max(self.rate, 1.0), self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # 優先度の高い呼び出しが待っている間は譲る
+            if any(self._waiting[:priority]):
+                return 1.0 / self.rate
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return 0.0
+            return (1.0 - self._tokens) / self.rate
+
+    def _check_deadline(self, wait: float) -> None:
+        remaining = _remaining()
+        if remaining is not None and wait > remaining:
+            metrics.inc("rate_limit_deadline_exceeded_total", limiter=self.name)
+            raise DeadlineExceededError(f"{self.name}: deadline exceeded while waiting for quota")
+
+    async def acquire(self, priority: int = PRIORITY_TEXT) -> None:
+        started = time.monotonic()
+        self._waiting[priority] += 1
+        try:
+            while (wait := self._try_acquire(priority)) > 0:
+                self._check_deadline(wait)
+                await asyncio.sleep(wait)
+        finally:
+            self._waiting[priority] -= 1
+        metrics.inc("rate_limit_wait_seconds_total", time.monotonic() - started, limiter=self.name)
+
+    def acquire_sync(self, priority: int = PRIORITY_TEXT) -> None:
+        started = time.monotonic()
+        with self._lock:
+            self._waiting[priority] += 1
+        try:
+            while (wait := self._try_acquire(priority)) > 0:
+                self._check_deadline(wait)
+                time.sleep(wait)
+        finally:
+            with self._lock:
+                self._waiting[priority] -= 1
+        metrics.inc("rate_limit_wait_seconds_total", time.monotonic() - started, limiter=self.name)
+
+    def on_success(self) -> None:
+        """加算的にレートを上げる（1秒分の成功でおよそ +1 rps）"""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+        metrics.set_gauge("rate_limit_rps", self.rate, limiter=self.name)
+
+    def on_throttle(self) -> None:
+        """乗算的にレートを下げる"""
+        metrics.inc("rate_limit_throttled_total", limiter=self.name)
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < _DECREASE_COOLDOWN_SECONDS:
+                return
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+        metrics.set_gauge("rate_limit_rps", self.rate, limiter=self.name)
+        print(f"Rate limiter {self.name} throttled, rate={self.rate:.2f}/s")
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """ジッター付き指数バックオフ（締め切りを超えるなら DeadlineExceededError）"""
+        delay = random.uniform(0, min(VERTEX_RETRY_MAX_SECONDS, VERTEX_RETRY_BASE_SECONDS * 2**attempt))
+        remaining = _remaining()
+        if remaining is not None and delay > remaining:
+            metrics.inc("rate_limit_deadline_exceeded_total", limiter=self.name)
+            raise DeadlineExceededError(f"{self.name}: deadline exceeded after {error}") from error
+        metrics.inc("vertex_retries_total", limiter=self.name)
+        tracing.record_retry()
+        print(f"{self.name} call failed ({error}), retrying in {delay:.2f}s")
+        return delay
+
+    async def call(self, fn: Callable[[], Awaitable[T]], priority: int = PRIORITY_TEXT) -> T:
+        """レート制限とリトライ付きで fn() を呼び出す"""
+        for attempt in range(VERTEX_MAX_RETRIES + 1):
+            await self.acquire(priority)
+            try:
+                result = await fn()
+            except Exception as e:
+                if not is_retryable(e) or attempt == VERTEX_MAX_RETRIES:
+                    raise
+                if is_throttled(e):
+                    self.on_throttle()
+                await asyncio.sleep(self._backoff(attempt, e))
+                continue
+            self.on_success()
+            return result
+        raise AssertionError("unreachable")
+
+    def call_sync(self, fn: Callable[[], T], priority: int = PRIORITY_TEXT) -> T:
+        """call の同期版"""
+        for attempt in range(VERTEX_MAX_RETRIES + 1):
+            self.acquire_sync(priority)
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_retryable(e) or attempt == VERTEX_MAX_RETRIES:
+                    raise
+                if is_throttled(e):
+                    self.on_throttle()
+                time.sleep(self._backoff(attempt, e))
+                continue
+            self.on_success()
+            return result
+        raise AssertionError("unreachable")
+
+
+_limiters: dict[str, AdaptiveRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(model: str, region: str) -> AdaptiveRateLimiter:
+    """モデル・リージョンごとのレートリミッター（クォータの単位）"""
+    name = f"{model}@{region}"
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = _limiters[name] = AdaptiveRateLimiter(name)
+        return limiter
+
+
+def limiter_for_llm(llm) -> AdaptiveRateLimiter:
+    """ChatVertexAI のモデル名・リージョンに対応するリミッター"""
+    return get_limiter(getattr(llm, "model_name", "llm"), getattr(llm, "location", "default"))
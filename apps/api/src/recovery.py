@@ -0,0 +1,280 @@
+"""
+止まった絵日記の回収（リカバリースイープ）
+
+インスタンスが落ちたり、メモリ上のジョブキューごと失われたりすると、
+pending / processing のまま進まない絵日記が残ります。
+一定間隔で updatedAt が古いものを探し、ジョブキューに入れ直します。
+スイープのたびに、このインスタンスのキューで順番待ち・実行中の日記の updatedAt を更新するので
+（ハートビート）、キューが混んでいるだけの日記は回収されず、二重に実行されません。
+ワークフローはチェックポイント（src/checkpoints.py）から続きを実行するので、
+完了済みのノード（LLM 呼び出し・画像生成）はやり直しません。
+
+同じ日記を複数のインスタンスが同時に回収しないよう、読み取り時の update_time を条件に
+recoveryCount と updatedAt を更新できたものだけを入れ直します。
+DIARY_RECOVERY_MAX_ATTEMPTS 回回収しても終わらないものは failed にします。
+
+Discord 通知も同じように回収します。日記ドキュメントの discordNotification がアウトボックスで、
+通知キューがメモリ上にあって失われても、queued のまま discordNotification.updatedAt が古いものを
+通知キューに入れ直します（ディスパッチャーが抱えている通知はハートビートで updatedAt を更新します）。
+
+Firestore では diaries の (status, updatedAt) と
+(discordNotification.status, discordNotification.updatedAt) の複合インデックスが必要です。
+"""
+
+import asyncio
+import datetime
+import os
+from typing import Callable
+
+from google.api_core.exceptions import FailedPrecondition, NotFound
+
+from src import diary_store, discord_outbox, metrics
+from src.job_queue import JobQueue, QueueFullError
+from src.progress import progress_broker
+
+DIARY_RECOVERY_ENABLED = os.getenv("DIARY_RECOVERY_ENABLED", "true").lower() == "true"
+DIARY_RECOVERY_INTERVAL_SECONDS = float(os.getenv("DIARY_RECOVERY_INTERVAL_SECONDS", "300"))
+# これより長く updatedAt が更新されていない pending / processing を止まったものとみなす
+# （1件の生成の締め切り DIARY_JOB_DEADLINE_SECONDS より十分長くすること）
+DIARY_RECOVERY_STALE_SECONDS = float(os.getenv("DIARY_RECOVERY_STALE_SECONDS", "600"))
+DIARY_RECOVERY_MAX_ATTEMPTS = int(os.getenv("DIARY_RECOVERY_MAX_ATTEMPTS", "3"))
+DIARY_RECOVERY_BATCH_SIZE = int(os.getenv("DIARY_RECOVERY_BATCH_SIZE", "50"))
+
+STALE_STATUSES = ["pending", "processing"]
+
+
+def job_payload(document_id: str, doc_data: dict) -> dict:
+    """日記ドキュメントから絵日記生成ジョブの payload を組み立てる"""
+    return {
+        "document_id": document_id,
+        "conversation_log": {
+            "date": doc_data.get("date"),
+            "transcript": diary_store.decode_transcript(doc_data),
+        },
+        "discord_webhook_url": doc_data.get("discordWebhookUrl"),
+        "image_reuse_user": diary_store.image_reuse_user(doc_data),
+    }
+
+
+def notification_job_payload(document_id: str, doc_data: dict) -> dict | None:
+    """完了した日記ドキュメントから Discord 通知ジョブの payload を組み立てる"""
+    return discord_outbox.notification_payload(
+        document_id,
+        doc_data.get("discordWebhookUrl"),
+        title=doc_data.get("date") or "今日の絵日記",
+        diary_text=doc_data.get("diaryText"),
+        image_url=doc_data.get("imageUrl"),
+        image_renditions=doc_data.get("imageRenditions"),
+        keywords=doc_data.get("keywords"),
+    )
+
+
+class DiaryRecovery:
+    """止まった絵日記を定期的にジョブキューへ入れ直す"""
+
+    def __init__(
+        self,
+        get_db: Callable[[], object | None],
+        queue: JobQueue,
+        interval: float = DIARY_RECOVERY_INTERVAL_SECONDS,
+        stale_seconds: float = DIARY_RECOVERY_STALE_SECONDS,
+        max_attempts: int = DIARY_RECOVERY_MAX_ATTEMPTS,
+        batch_size: int = DIARY_RECOVERY_BATCH_SIZE,
+        notification_queue: JobQueue | None = None,
+    ):
+        # Firestore クライアントは最初のスイープで作る（起動を待たせない）
+        self.get_db = get_db
+        self.queue = queue
+        self.notification_queue = notification_queue
+        self.interval = interval
+        self.stale_seconds = stale_seconds
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self._task: asyncio.Task | None = None
+        if interval >= stale_seconds:
+            print(
+                "Warning: DIARY_RECOVERY_INTERVAL_SECONDS should be shorter than DIARY_RECOVERY_STALE_SECONDS; "
+                "queued diaries may be recovered twice"
+            )
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name="diary-recovery")
+        print(f"Started diary recovery sweep (every {self.interval:.0f}s, stale after {self.stale_seconds:.0f}s)")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Diary recovery sweep failed: {e}")
+            if self.notification_queue is not None:
+                try:
+                    await self.sweep_notifications()
+                except Exception as e:
+                    print(f"Discord notification recovery sweep failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def _cutoff(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.stale_seconds)
+
+    def _stale_snapshots(self, db) -> list:
+        from google.cloud.firestore import FieldFilter
+
+        query = (
+            db.collection("diaries")
+            .where(filter=FieldFilter("status", "in", STALE_STATUSES))
+            .where(filter=FieldFilter("updatedAt", "<", self._cutoff()))
+            .limit(self.batch_size)
+        )
+        return list(query.stream())
+
+    def _stale_notification_snapshots(self, db) -> list:
+        from google.cloud.firestore import FieldFilter
+
+        query = (
+            db.collection("diaries")
+            .where(filter=FieldFilter("discordNotification.status", "==", "queued"))
+            .where(filter=FieldFilter("discordNotification.updatedAt", "<", self._cutoff()))
+            .limit(self.batch_size)
+        )
+        return list(query.stream())
+
+    def _touch(self, db, document_ids: set[str], field: str = "updatedAt") -> None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        updates = [(db.collection("diaries").document(document_id), {field: now}) for document_id in sorted(document_ids)]
+        try:
+            diary_store.batch_update(db, updates)
+        except NotFound:
+            # 削除された日記があるとバッチごと失敗するので1件ずつ更新する
+            for doc_ref, data in updates:
+                try:
+                    doc_ref.update(data)
+                except NotFound:
+                    pass
+
+    async def heartbeat(self, db) -> set[str]:
+        """このインスタンスのキューで順番待ち・実行中の日記の updatedAt を更新し、その ID を返す"""
+        document_ids = await self.queue.active_values("document_id")
+        if document_ids:
+            await asyncio.to_thread(self._touch, db, document_ids)
+            metrics.inc("diary_recovery_heartbeats_total", len(document_ids))
+        return document_ids
+
+    async def notification_heartbeat(self, db) -> set[str]:
+        """このインスタンスの通知キューにある（ディスパッチャーが抱えている）通知の discordNotification.updatedAt を更新する"""
+        document_ids = await self.notification_queue.active_values("document_id")
+        if document_ids:
+            await asyncio.to_thread(self._touch, db, document_ids, "discordNotification.updatedAt")
+            metrics.inc("discord_notification_recovery_heartbeats_total", len(document_ids))
+        return document_ids
+
+    def _claim(self, db, snapshot) -> dict | None:
+        """update_time が読み取り時のままなら回収する。回収した場合は更新内容を返す"""
+        doc_data = snapshot.to_dict()
+        attempts = doc_data.get("recoveryCount", 0) + 1
+        if attempts > self.max_attempts:
+            update = diary_store.failed_update("絵日記の生成が中断され、再開できませんでした。")
+        else:
+            update = {"recoveryCount": attempts, "updatedAt": datetime.datetime.now(datetime.timezone.utc)}
+        try:
+            snapshot.reference.update(update, option=db.write_option(last_update_time=snapshot.update_time))
+        except (FailedPrecondition, NotFound):
+            # 他のインスタンスが回収した・処理が進んだ・削除された
+            return None
+        return update
+
+    def _claim_notification(self, db, snapshot, payload: dict | None) -> dict | None:
+        """_claim の Discord 通知版。回収した場合は discordNotification の新しい内容を返す"""
+        notification = snapshot.to_dict().get("discordNotification") or {}
+        attempts = notification.get("recoveryCount", 0) + 1
+        if payload is None:
+            # Webhook URL か本文がない（送るものがない）
+            status = discord_outbox.notification_status("failed", notification.get("attempts", 0), "nothing to send")
+        elif attempts > self.max_attempts:
+            status = discord_outbox.notification_status("failed", notification.get("attempts", 0), "notification lost")
+        else:
+            status = {**discord_outbox.notification_status("queued", notification.get("attempts", 0)), "recoveryCount": attempts}
+        try:
+            snapshot.reference.update(
+                {"discordNotification": status}, option=db.write_option(last_update_time=snapshot.update_time)
+            )
+        except (FailedPrecondition, NotFound):
+            return None
+        return status
+
+    async def sweep(self) -> int:
+        """止まった絵日記を1回探して入れ直す。入れ直した件数を返す"""
+        db = await asyncio.to_thread(self.get_db)
+        if db is None:
+            return 0
+        active = await self.heartbeat(db)
+        snapshots = await asyncio.to_thread(self._stale_snapshots, db)
+        requeued = 0
+        for snapshot in snapshots:
+            if snapshot.id in active:
+                # このインスタンスのキューにある（ハートビートより前に読んだ古い updatedAt）
+                continue
+            if await self.queue.is_full():
+                # 回収回数を無駄に増やさないよう、空きがなければ次のスイープに回す
+                metrics.inc("diary_recovery_total", result="queue_full")
+                break
+            update = await asyncio.to_thread(self._claim, db, snapshot)
+            if update is None:
+                continue
+            if update.get("status") == "failed":
+                print(f"Diary {snapshot.id} gave up after {self.max_attempts} recoveries")
+                metrics.inc("diary_recovery_total", result="failed")
+                # このインスタンスで購読している SSE を閉じる
+                progress_broker.publish(snapshot.id, "status", status="failed", error=update["error"])
+                continue
+            doc_data = snapshot.to_dict()
+            try:
+                await self.queue.enqueue(doc_data["userId"], job_payload(snapshot.id, doc_data))
+            except QueueFullError:
+                # updatedAt を更新済みなので、DIARY_RECOVERY_STALE_SECONDS 後のスイープで再び対象になる
+                print(f"Job queue full; diary {snapshot.id} will be recovered later")
+                metrics.inc("diary_recovery_total", result="queue_full")
+                break
+            print(f"Recovered stale diary {snapshot.id} (status={doc_data.get('status')}, attempt {update['recoveryCount']})")
+            metrics.inc("diary_recovery_total", result="requeued")
+            requeued += 1
+        return requeued
+
+    async def sweep_notifications(self) -> int:
+        """queued のまま止まった Discord 通知を1回探して通知キューに入れ直す。入れ直した件数を返す"""
+        db = await asyncio.to_thread(self.get_db)
+        if db is None:
+            return 0
+        active = await self.notification_heartbeat(db)
+        snapshots = await asyncio.to_thread(self._stale_notification_snapshots, db)
+        requeued = 0
+        for snapshot in snapshots:
+            if snapshot.id in active:
+                continue
+            if await self.notification_queue.is_full():
+                metrics.inc("discord_notification_recovery_total", result="queue_full")
+                break
+            payload = notification_job_payload(snapshot.id, snapshot.to_dict())
+            status = await asyncio.to_thread(self._claim_notification, db, snapshot, payload)
+            if status is None:
+                continue
+            if status["status"] == "failed":
+                print(f"Discord notification for diary {snapshot.id} gave up: {status['error']}")
+                metrics.inc("discord_notification_recovery_total", result="failed")
+                continue
+            try:
+                await self.notification_queue.enqueue(discord_outbox.webhook_key(payload["webhook_url"]), payload)
+            except QueueFullError:
+                print(f"Discord notification queue full; diary {snapshot.id} will be notified later")
+                metrics.inc("discord_notification_recovery_total", result="queue_full")
+                break
+            print(f"Recovered stale Discord notification for diary {snapshot.id} (attempt {status['recoveryCount']})")
+            metrics.inc("discord_notification_recovery_total", result="requeued")
+            requeued += 1
+        return requeued
@@ -0,0 +1,216 @@
+"""
+リージョンプール
+
+同じモデルを複数のリージョンで呼び出せる場合に、リクエストをリージョン間で振り分けます。
+
+- 直近のレイテンシ（EWMA）とエラー率から、最も速く安定しているリージョンを選ぶ
+- リージョンごとのサーキットブレーカー: 連続で失敗したリージョンは一定時間使わない
+- 失敗したら別のリージョンで1回やり直す（フェイルオーバー）
+- ヘッジ: 最初のリージョンが p95 レイテンシを超えても返ってこなければ、
+  別のリージョンにも同じリクエストを送り、先に返った方を使う
+
+リージョンごとの状態は /metrics の region_* で確認できます。
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, TypeVar
+
+from src import metrics
+
+REGION_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("REGION_CIRCUIT_FAILURE_THRESHOLD", "5"))
+REGION_CIRCUIT_RESET_SECONDS = float(os.getenv("REGION_CIRCUIT_RESET_SECONDS", "30"))
+REGION_HEDGE_PERCENTILE = float(os.getenv("REGION_HEDGE_PERCENTILE", "0.95"))
+REGION_HEDGE_MIN_SAMPLES = int(os.getenv("REGION_HEDGE_MIN_SAMPLES", "20"))
+
+# レイテンシ・エラー率の EWMA の重み
+_EWMA_ALPHA = 0.2
+_LATENCY_WINDOW = 200
+
+T = TypeVar("T")
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """連続失敗で開き、reset_seconds 後に1件だけ試して閉じるか判断する"""
+
+    def __init__(
+        self,
+        failure_threshold: int = REGION_CIRCUIT_FAILURE_THRESHOLD,
+        reset_seconds: float = REGION_CIRCUIT_RESET_SECONDS,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == HALF_OPEN:
+            # 試行は同時に1件まで
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+        return self.state == CLOSED
+
+    def record_success(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+
+    def record_cancelled(self) -> None:
+        """結果を待たずに打ち切った試行（成功とも失敗とも数えない）"""
+        if self.state == HALF_OPEN:
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+
+class _Region:
+    def __init__(self, name: str):
+        self.name = name
+        self.breaker = CircuitBreaker()
+        self.latency_ewma: float | None = None
+        self.error_ewma = 0.0
+        self.latencies: deque[float] = deque(maxlen=_LATENCY_WINDOW)
+
+    def score(self) -> float:
+        # 計測前のリージョンは 0（一度は試す）
+        latency = self.latency_ewma or 0.0
+        return latency * (1 + 4 * self.error_ewma)
+
+
+class RegionPool:
+    """レイテンシ・エラーを見てリージョンを選ぶプール"""
+
+    def __init__(self, name: str, regions: list[str], hedge: bool = True):
+        if not regions:
+            raise ValueError("RegionPool needs at least one region")
+        self.name = name
+        self.regions = {region: _Region(region) for region in regions}
+        self.hedge = hedge
+        self._lock = threading.Lock()
+        for region in regions:
+            self._publish_state(self.regions[region])
+
+    def _publish_state(self, region: _Region) -> None:
+        metrics.set_gauge("region_circuit_state", _STATE_GAUGE[region.breaker.state], pool=self.name, region=region.name)
+
+    def pick(self, exclude: set[str] = frozenset()) -> str | None:
+        """使えるリージョンのうちスコアが最も良いものを返す（なければ None）"""
+        with self._lock:
+            candidates = sorted(
+                (r for name, r in self.regions.items() if name not in exclude),
+                key=lambda r: r.score(),
+            )
+            for region in candidates:
+                allowed = region.breaker.allow()
+                self._publish_state(region)
+                if allowed:
+                    return region.name
+        return None
+
+    def _record(self, name: str, latency: float, error: Exception | None) -> None:
+        with self._lock:
+            region = self.regions[name]
+            if error is None:
+                region.breaker.record_success()
+                region.latencies.append(latency)
+                region.latency_ewma = (
+                    latency
+                    if region.latency_ewma is None
+                    else _EWMA_ALPHA * latency + (1 - _EWMA_ALPHA) * region.latency_ewma
+                )
+                region.error_ewma *= 1 - _EWMA_ALPHA
+            else:
+                region.breaker.record_failure()
+                region.error_ewma = _EWMA_ALPHA + (1 - _EWMA_ALPHA) * region.error_ewma
+            self._publish_state(region)
+        metrics.inc("region_requests_total", pool=self.name, region=name, outcome="error" if error else "ok")
+
+    def hedge_delay(self, name: str) -> float | None:
+        """ヘッジを送るまでの待ち時間（そのリージョンの p95。サンプル不足なら None）"""
+        region = self.regions[name]
+        if len(region.latencies) < REGION_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(region.latencies)
+        delay = ordered[min(len(ordered) - 1, int(len(ordered) * REGION_HEDGE_PERCENTILE))]
+        metrics.set_gauge("region_hedge_delay_seconds", delay, pool=self.name, region=name)
+        return delay
+
+    async def _attempt(self, name: str, fn: Callable[[str], Awaitable[T]]) -> T:
+        started = time.monotonic()
+        try:
+            result = await fn(name)
+        except asyncio.CancelledError:
+            # ヘッジで負けた側。リージョンの失敗としては数えない
+            with self._lock:
+                self.regions[name].breaker.record_cancelled()
+            raise
+        except Exception as e:
+            self._record(name, time.monotonic() - started, e)
+            raise
+        self._record(name, time.monotonic() - started, None)
+        return result
+
+    async def call(self, fn: Callable[[str], Awaitable[T]]) -> T:
+        """fn(region) をリージョンを選んで呼び出す（失敗時は別リージョンで1回やり直す）"""
+        tried: set[str] = set()
+        primary = self.pick() or next(iter(self.regions))
+        tried.add(primary)
+        tasks = {asyncio.create_task(self._attempt(primary, fn)): primary}
+        hedged = False
+        last_error: Exception | None = None
+
+        try:
+            while tasks:
+                timeout = None
+                if self.hedge and not hedged and len(tasks) == 1:
+                    timeout = self.hedge_delay(primary)
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # p95 を超えたので別リージョンにもヘッジを送る
+                    hedged = True
+                    secondary = self.pick(exclude=tried)
+                    if secondary is not None:
+                        tried.add(secondary)
+                        metrics.inc("region_hedges_total", pool=self.name, outcome="sent")
+                        tasks[asyncio.create_task(self._attempt(secondary, fn))] = secondary
+                    continue
+
+                for task in done:
+                    region = tasks.pop(task)
+                    if task.exception() is None:
+                        if hedged and region != primary:
+                            metrics.inc("region_hedges_total", pool=self.name, outcome="won")
+                        return task.result()
+                    last_error = task.exception()
+                    print(f"[{self.name}] {region} failed: {last_error}")
+
+                if not tasks:
+                    # フェイルオーバー（1回まで）
+                    fallback = self.pick(exclude=tried) if len(tried) < 2 else None
+                    if fallback is None:
+                        break
+                    tried.add(fallback)
+                    metrics.inc("region_failovers_total", pool=self.name)
+                    tasks[asyncio.create_task(self._attempt(fallback, fn))] = fallback
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        raise last_error
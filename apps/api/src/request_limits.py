@@ -0,0 +1,64 @@
+"""
+リクエストボディのサイズ制限
+
+ボディを受信しながらバイト数を数え、上限を超えた時点で 413 を返します。
+JSON のパースや Pydantic の検証より前に打ち切るので、巨大な transcript を
+全部読み込んでから断ることはありません（Content-Length があればボディを読む前に断る）。
+"""
+
+import os
+
+from fastapi import HTTPException
+from starlette.responses import JSONResponse
+
+MAX_REQUEST_BODY_BYTES = int(os.getenv("MAX_REQUEST_BODY_BYTES", str(1024 * 1024)))
+# POST /diaries:batch は複数件をまとめて送るので別の上限
+MAX_BATCH_REQUEST_BODY_BYTES = int(os.getenv("MAX_BATCH_REQUEST_BODY_BYTES", str(16 * 1024 * 1024)))
+
+
+def _too_large(limit: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Request body too large (max {limit} bytes)")
+
+
+class BodySizeLimitMiddleware:
+    """パスごとの上限を超えるリクエストボディを 413 で断る ASGI ミドルウェア"""
+
+    def __init__(
+        self,
+        app,
+        max_bytes: int = MAX_REQUEST_BODY_BYTES,
+        batch_max_bytes: int = MAX_BATCH_REQUEST_BODY_BYTES,
+    ):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.batch_max_bytes = batch_max_bytes
+
+    def limit_for(self, path: str) -> int:
+        return self.batch_max_bytes if path.endswith(":batch") else self.max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.limit_for(scope["path"])
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            error = _too_large(limit)
+            response = JSONResponse({"detail": error.detail}, status_code=error.status_code)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # ボディを読んでいるエンドポイント側で 413 として返される
+                    raise _too_large(limit)
+            return message
+
+        await self.app(scope, limited_receive, send)
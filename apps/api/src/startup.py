@@ -0,0 +1,147 @@
+"""
+起動処理とコールドスタートのプロファイル
+
+Cloud Run のコールドスタートでは、モジュールの import とクライアントの作成がそのまま
+起動時間と最初の絵日記の待ち時間になります。
+
+- 重い import（firebase_admin / google.cloud.firestore / LangGraph / Vertex AI / GenAI / Cloud Storage）と
+  クライアントの作成は初回利用時まで遅らせる（src/clients.py のレジストリ、src/firebase_auth.py）。
+  src.main の import ではこれらを読み込まない
+- 起動後の処理（画像バケットの確認）はバックグラウンドで行い、その間もリクエストは受け付ける
+- STARTUP_WARMUP=true のときは、その中でワークフローの import・コンパイル、共有クライアントの作成、
+  Firebase の公開証明書とアクセストークンの取得も済ませ、最初の絵日記が import 待ちにならないようにする
+- 起動処理が終わるまで GET /health は 503 を返す（Cloud Run の起動プローブに使う）
+- 段階ごとの所要時間は GET /metrics/startup と startup_phase_seconds メトリクスで確認できる
+"""
+
+import asyncio
+import contextlib
+import importlib
+import os
+import sys
+import time
+from typing import Callable
+
+from src import metrics
+
+# src.main の最初に import されるので、アプリの import 開始時刻とみなす
+_IMPORTED_AT = time.perf_counter()
+
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "false").lower() == "true"
+
+# 遅延 import の対象（GET /metrics/startup で読み込み済みかを表示する）
+HEAVY_MODULES = (
+    "firebase_admin",
+    "google.cloud.firestore",
+    "google.cloud.storage",
+    "google.genai",
+    "langgraph",
+    "langchain_google_vertexai",
+    "PIL",
+)
+
+
+def _process_age() -> float | None:
+    """プロセス起動からの経過秒数（Linux 以外では None）"""
+    try:
+        with open("/proc/self/stat") as f:
+            # comm に空白が含まれることがあるので ")" より後ろを読む
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupProfile:
+    """起動の各段階の所要時間と、起動処理が終わったか（ready）"""
+
+    def __init__(self):
+        self.started = _IMPORTED_AT
+        # プロセス起動から src.main の import 開始まで（インタプリタと uvicorn の起動）
+        self.process_age_at_import = _process_age()
+        self.marks: dict[str, float] = {}
+        self.phases: list[dict] = []
+        self.ready = False
+
+    def mark(self, name: str) -> None:
+        """import 開始からの経過時間を記録する"""
+        self.marks[name] = time.perf_counter() - self.started
+        metrics.set_gauge("startup_mark_seconds", self.marks[name], mark=name)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """段階の所要時間を記録する。失敗しても起動は止めない（初回利用時にもう一度作られる）"""
+        started = time.perf_counter()
+        entry: dict = {"name": name}
+        try:
+            yield
+        except Exception as e:
+            print(f"Startup phase {name} failed: {e}")
+            entry["error"] = str(e)
+        finally:
+            entry["seconds"] = time.perf_counter() - started
+            self.phases.append(entry)
+            metrics.observe("startup_phase_seconds", entry["seconds"], phase=name)
+
+    async def run_step(self, name: str, fn: Callable, *args) -> None:
+        """同期処理をスレッドで実行して段階として記録する"""
+        with self.phase(name):
+            await asyncio.to_thread(fn, *args)
+
+    def report(self) -> dict:
+        return {
+            "ready": self.ready,
+            "warmup": STARTUP_WARMUP,
+            "process_age_at_import": self.process_age_at_import,
+            "uptime": time.perf_counter() - self.started,
+            "marks": dict(self.marks),
+            "phases": list(self.phases),
+            "modules_loaded": len(sys.modules),
+            "heavy_modules_loaded": {name: name in sys.modules for name in HEAVY_MODULES},
+        }
+
+
+startup_profile = StartupProfile()
+
+
+def _warm_workflow() -> None:
+    # ワークフローのコンパイル・ChatVertexAI の作成と、画像生成で使うクライアントの作成
+    from src import clients
+
+    workflow = importlib.import_module("src.diary_workflow")
+    for region in workflow.IMAGE_REGIONS:
+        clients.get_genai_client(region)
+    from google.genai import types  # noqa: F401  画像生成の設定で使う
+
+    workflow.image_renditions.warmup()
+
+
+async def _warm_access_token() -> None:
+    from src.token_cache import access_token_cache
+
+    with startup_profile.phase("access_token"):
+        await access_token_cache.get_token()
+
+
+async def run_startup() -> None:
+    """lifespan からバックグラウンドで実行する起動処理"""
+    from src import clients, firebase_auth
+
+    steps = [startup_profile.run_step("image_bucket", clients.validate_image_bucket)]
+    if STARTUP_WARMUP:
+        steps += [
+            startup_profile.run_step("workflow", _warm_workflow),
+            startup_profile.run_step("firestore", clients.get_firestore_client),
+            startup_profile.run_step("firebase_certs", firebase_auth.prefetch_public_certs),
+            _warm_access_token(),
+        ]
+        clients.get_http_client()
+    # ネットワーク待ちと import を重ねるため並行に実行する
+    await asyncio.gather(*steps)
+
+    startup_profile.ready = True
+    startup_profile.mark("ready")
+    phases = ", ".join(f"{p['name']}={p['seconds']:.2f}s" for p in startup_profile.phases)
+    print(f"Startup finished in {startup_profile.marks['ready']:.2f}s (warmup={STARTUP_WARMUP}): {phases}")
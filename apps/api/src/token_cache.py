@@ -0,0 +1,86 @@
+"""
+アクセストークンキャッシュ
+
+/auth/token で発行する Vertex AI 用アクセストークンをプロセス内で使い回します。
+
+- 認証情報（google.auth.default）は初回に1回だけ取得する
+- 有効期限まで TOKEN_REFRESH_MARGIN_SECONDS 以上残っていればキャッシュを返す
+- 残りがマージンを切ったら、現在のトークンを返しつつバックグラウンドで更新する
+- 期限切れの場合は更新を待つ。同時に来たリクエストは1回の更新を共有する（single-flight）
+"""
+
+import asyncio
+import datetime
+import os
+
+from src import metrics
+
+TOKEN_REFRESH_MARGIN_SECONDS = float(os.getenv("TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+
+class AccessTokenCache:
+    """サービスアカウント（ADC）のアクセストークンキャッシュ"""
+
+    def __init__(self, scopes: list[str] = SCOPES, refresh_margin: float = TOKEN_REFRESH_MARGIN_SECONDS):
+        self.scopes = scopes
+        self.refresh_margin = refresh_margin
+        self.credentials = None
+        self.project: str | None = None
+        self._refresh_task: asyncio.Task | None = None
+
+    def _remaining_seconds(self) -> float:
+        """現在のトークンの残り有効秒数（トークンがなければ 0）"""
+        if self.credentials is None or not self.credentials.token:
+            return 0.0
+        expiry = self.credentials.expiry
+        if expiry is None:
+            # 有効期限の情報がない認証情報は常に有効とみなす
+            return float("inf")
+        # google-auth の expiry はタイムゾーンなしの UTC
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (expiry - now).total_seconds()
+
+    def _refresh_sync(self) -> None:
+        # google.auth（requests を含む）は最初の更新まで import しない
+        import google.auth
+        import google.auth.transport.requests
+
+        if self.credentials is None:
+            self.credentials, self.project = google.auth.default(scopes=self.scopes)
+        self.credentials.refresh(google.auth.transport.requests.Request())
+
+    def _start_refresh(self) -> asyncio.Task:
+        # 更新中ならその結果を共有する
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(asyncio.to_thread(self._refresh_sync))
+            self._refresh_task.add_done_callback(self._on_refreshed)
+        return self._refresh_task
+
+    @staticmethod
+    def _on_refreshed(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            print(f"Failed to refresh access token: {task.exception()}")
+            metrics.inc("access_token_refresh_failures_total")
+
+    async def get_token(self) -> tuple[str, int]:
+        """(アクセストークン, 残り有効秒数) を返す"""
+        remaining = self._remaining_seconds()
+
+        if remaining > self.refresh_margin:
+            metrics.inc("access_token_cache_total", result="hit")
+        elif remaining > 0:
+            # まだ使えるので待たずに返し、裏で更新しておく
+            metrics.inc("access_token_cache_total", result="background_refresh")
+            self._start_refresh()
+        else:
+            metrics.inc("access_token_cache_total", result="refresh")
+            await asyncio.shield(self._start_refresh())
+            remaining = self._remaining_seconds()
+
+        expires_in = int(remaining) if remaining != float("inf") else 3600
+        return self.credentials.token, expires_in
+
+
+access_token_cache = AccessTokenCache()
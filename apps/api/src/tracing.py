@@ -0,0 +1,246 @@
+"""
+ワークフローの計測
+
+絵日記1件ごと・ノードごとに、実行時間・リトライ回数・入出力トークン数・推定コストを記録します。
+
+- Prometheus: /metrics の diary_node_duration_seconds などのヒストグラム・カウンター
+- OpenTelemetry: tracing extra（opentelemetry-api / -sdk / OTLP エクスポーター）がインストールされていれば、
+  絵日記ごとに diary スパン、ノードごとに子スパンを作る。OTEL_EXPORTER_OTLP_ENDPOINT
+  （または OTEL_EXPORTER_OTLP_TRACES_ENDPOINT）が設定されていれば OTLP/HTTP で送る。
+  extra がない・エンドポイントが未設定なら送らない（opentelemetry-instrument で起動した場合はその設定に従う）
+- トレース ID は Firestore の日記ドキュメント（traceId）に保存する
+
+推定コストは LLM_PRICE_* 環境変数（USD / 100万トークン、画像は1枚あたり）から計算します。
+"""
+
+import contextlib
+import contextvars
+import functools
+import inspect
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from src import metrics
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+# モデルごとの価格（USD）。テキストは100万トークンあたり、画像は1枚あたり
+LLM_PRICES = {
+    "gemini-2.0-flash": {
+        "input": float(os.getenv("LLM_PRICE_TEXT_INPUT_PER_MTOK", "0.10")),
+        "output": float(os.getenv("LLM_PRICE_TEXT_OUTPUT_PER_MTOK", "0.40")),
+    },
+    "gemini-2.5-flash-image": {
+        "image": float(os.getenv("LLM_PRICE_IMAGE_PER_IMAGE", "0.039")),
+    },
+}
+
+# トークン数・コスト用のバケット
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+COST_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5)
+
+
+def _configure_exporter() -> None:
+    """OTLP のエンドポイントが設定されていれば、スパンを送る TracerProvider を登録する"""
+    if not (os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT") or os.getenv("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")):
+        return
+    if not isinstance(otel_trace.get_tracer_provider(), otel_trace.ProxyTracerProvider):
+        # opentelemetry-instrument などで設定済み
+        return
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        print("Warning: OTEL_EXPORTER_OTLP_ENDPOINT is set but the tracing extra is not installed")
+        return
+    # サービス名などは OTEL_SERVICE_NAME / OTEL_RESOURCE_ATTRIBUTES から読まれる
+    provider = TracerProvider()
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    otel_trace.set_tracer_provider(provider)
+
+
+if otel_trace:
+    _configure_exporter()
+_tracer = otel_trace.get_tracer("enikki.diary_workflow") if otel_trace else None
+
+
+@dataclass
+class NodeStats:
+    seconds: float = 0.0
+    calls: int = 0
+    retries: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cost_usd: float = 0.0
+    cache_hits: int = 0  # LLM_CACHE_BACKEND のキャッシュから返した（課金されていない）呼び出し
+
+
+@dataclass
+class DiaryTrace:
+    """絵日記1件分の計測結果"""
+
+    trace_id: str
+    nodes: dict[str, NodeStats] = field(default_factory=dict)
+
+    def node(self, name: str) -> NodeStats:
+        return self.nodes.setdefault(name, NodeStats())
+
+    def total_cost(self) -> float:
+        return sum(stats.cost_usd for stats in self.nodes.values())
+
+    def total_tokens(self) -> int:
+        return sum(stats.input_tokens + stats.output_tokens for stats in self.nodes.values())
+
+    def usage(self) -> dict:
+        """Firestore に保存する要約"""
+        return {
+            "costUsd": round(self.total_cost(), 6),
+            "tokens": self.total_tokens(),
+            "nodes": {
+                name: {
+                    "seconds": round(stats.seconds, 3),
+                    "retries": stats.retries,
+                    "costUsd": round(stats.cost_usd, 6),
+                    "cacheHits": stats.cache_hits,
+                }
+                for name, stats in self.nodes.items()
+            },
+        }
+
+
+_current_trace: contextvars.ContextVar[DiaryTrace | None] = contextvars.ContextVar("diary_trace", default=None)
+_current_node: contextvars.ContextVar[str | None] = contextvars.ContextVar("diary_node", default=None)
+
+
+def _span(name: str, **attributes):
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.start_as_current_span(name, attributes=attributes)
+
+
+@contextlib.contextmanager
+def diary_trace(document_id: str):
+    """絵日記1件の計測を開始する（このスコープ内のノード・LLM 呼び出しが集計される）"""
+    with _span("diary", **{"diary.id": document_id}) as span:
+        trace_id = None
+        if span is not None and span.get_span_context().is_valid:
+            trace_id = format(span.get_span_context().trace_id, "032x")
+        diary = DiaryTrace(trace_id=trace_id or uuid.uuid4().hex)
+        token = _current_trace.set(diary)
+        started = time.perf_counter()
+        try:
+            yield diary
+        finally:
+            _current_trace.reset(token)
+            metrics.observe("diary_duration_seconds", time.perf_counter() - started)
+            metrics.observe("diary_cost_usd", diary.total_cost(), buckets=COST_BUCKETS)
+            metrics.observe("diary_tokens", diary.total_tokens(), buckets=TOKEN_BUCKETS)
+            if span is not None:
+                span.set_attribute("diary.cost_usd", diary.total_cost())
+                span.set_attribute("diary.tokens", diary.total_tokens())
+
+
+def current_trace_id() -> str | None:
+    diary = _current_trace.get()
+    return diary.trace_id if diary else None
+
+
+@contextlib.contextmanager
+def _node_scope(name: str):
+    diary = _current_trace.get()
+    token = _current_node.set(name)
+    started = time.perf_counter()
+    with _span(f"node:{name}", **{"diary.node": name}) as span:
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            _current_node.reset(token)
+            metrics.observe("diary_node_duration_seconds", elapsed, node=name)
+            if diary is not None:
+                stats = diary.node(name)
+                stats.seconds += elapsed
+                stats.calls += 1
+                if span is not None:
+                    span.set_attribute("diary.node.retries", stats.retries)
+                    span.set_attribute("diary.node.input_tokens", stats.input_tokens)
+                    span.set_attribute("diary.node.output_tokens", stats.output_tokens)
+                    span.set_attribute("diary.node.cost_usd", stats.cost_usd)
+
+
+def instrument_node(name: str, fn):
+    """ワークフローのノード関数（同期・非同期）を計測付きで包む"""
+    if inspect.iscoroutinefunction(fn):
+
+        @functools.wraps(fn)
+        async def async_wrapper(state):
+            with _node_scope(name):
+                return await fn(state)
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(state):
+        with _node_scope(name):
+            return fn(state)
+
+    return wrapper
+
+
+def _node_stats() -> tuple[str, NodeStats | None]:
+    node = _current_node.get() or "unknown"
+    diary = _current_trace.get()
+    return node, diary.node(node) if diary else None
+
+
+def record_retry() -> None:
+    """現在のノードで Vertex AI 呼び出しをリトライした"""
+    node, stats = _node_stats()
+    metrics.inc("diary_node_retries_total", node=node)
+    if stats is not None:
+        stats.retries += 1
+
+
+def _usage_tokens(usage) -> tuple[int, int]:
+    """LangChain の usage_metadata（dict）と google-genai の UsageMetadata の両方から取り出す"""
+    if usage is None:
+        return 0, 0
+    if isinstance(usage, dict):
+        return int(usage.get("input_tokens") or 0), int(usage.get("output_tokens") or 0)
+    return int(getattr(usage, "prompt_token_count", 0) or 0), int(getattr(usage, "candidates_token_count", 0) or 0)
+
+
+def record_llm_usage(model: str, response, images: int = 0) -> None:
+    """LLM 呼び出しのトークン数・推定コストを現在のノードに記録する
+
+    LLM_CACHE_BACKEND のキャッシュから返した応答（response_metadata の cache_hit）は課金されていないので、
+    トークン数・コストには数えずキャッシュヒットとして記録する。
+    """
+    node, stats = _node_stats()
+    if (getattr(response, "response_metadata", None) or {}).get("cache_hit"):
+        metrics.inc("llm_cache_served_total", node=node, model=model)
+        if stats is not None:
+            stats.cache_hits += 1
+        return
+
+    input_tokens, output_tokens = _usage_tokens(getattr(response, "usage_metadata", None))
+    prices = LLM_PRICES.get(model, {})
+    cost = (
+        input_tokens * prices.get("input", 0.0) / 1_000_000
+        + output_tokens * prices.get("output", 0.0) / 1_000_000
+        + images * prices.get("image", 0.0)
+    )
+
+    metrics.inc("llm_tokens_total", input_tokens, node=node, model=model, kind="input")
+    metrics.inc("llm_tokens_total", output_tokens, node=node, model=model, kind="output")
+    metrics.inc("llm_cost_usd_total", cost, node=node, model=model)
+    if stats is not None:
+        stats.input_tokens += input_tokens
+        stats.output_tokens += output_tokens
+        stats.cost_usd += cost
@@ -0,0 +1,187 @@
+"""
+会話ログ（transcript）の前処理
+
+Live API の長いセッションでは、transcript に相づち・言いよどみだけのターンや、
+途中経過の部分的な文字起こし（同じ発話が少しずつ伸びながら何度も届く）が大量に含まれます。
+これをそのままプロンプトに埋め込むと、入力トークンと LLM のレイテンシが膨らみます。
+
+ここでは絵日記1件につき1回だけ、次の処理を行います（ワークフローの prepare_transcript ノード）。
+- タイムスタンプ順に並べ、同じ (role, timestamp) の重複は最も長いものだけ残す
+  （同じ発話の途中経過と最終結果）
+- 直前の断片で始まり、それより長い発話は途中経過が伸びたものとして置き換える
+- 空のターン、言いよどみ（「えーと」「うーん」など）だけのターンを捨てる
+  （「うん」「はい」などの返事は内容を持つので残す）
+- 同じ話者の連続する別々の発話は「。」（英語は空白）で区切って1つのターンにつなげる
+  （前の発話の末尾と同じでも、別の時刻の発話は捨てない）
+- TRANSCRIPT_TOKEN_BUDGET を超える場合は新しいターンを優先して残し、
+  それより前のターンは要約（できなければ省略）する
+
+トークン数は文字種からの概算です（日本語はおよそ1文字1トークン、英数字は4文字1トークン）。
+"""
+
+import os
+import re
+
+TRANSCRIPT_TOKEN_BUDGET = int(os.getenv("TRANSCRIPT_TOKEN_BUDGET", "4000"))
+TRANSCRIPT_SUMMARY_ENABLED = os.getenv("TRANSCRIPT_SUMMARY_ENABLED", "true").lower() == "true"
+TRANSCRIPT_SUMMARY_MAX_TOKENS = int(os.getenv("TRANSCRIPT_SUMMARY_MAX_TOKENS", "400"))
+# 要約に渡す古いターンの上限（超えた分は要約にも含めない）
+TRANSCRIPT_SUMMARY_INPUT_TOKENS = int(os.getenv("TRANSCRIPT_SUMMARY_INPUT_TOKENS", "30000"))
+
+# 言いよどみだけの発話（句読点・空白を除いて比較する）
+_FILLER_RE = re.compile(r"^(え[ーっ]*と?|えっと|あ[ー]+|あの[ー]*|その[ー]+|う[ー]+ん|ん[ー]*|uh+|um+|hmm+|erm?)$")
+_PUNCTUATION_RE = re.compile(r"[\s、。,.!?！？…・「」『』]+")
+
+
+def _normalize(text: str) -> str:
+    return _PUNCTUATION_RE.sub("", text).lower()
+
+
+def is_filler(text: str) -> bool:
+    """空、または言いよどみだけの発話か"""
+    normalized = _normalize(text)
+    return not normalized or bool(_FILLER_RE.match(normalized))
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算"""
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+# これで終わる発話には区切りを足さない
+_SENTENCE_END = "。、！？…」』"
+
+
+def _join(left: str, right: str) -> str:
+    """別々の発話をつなげる（英語は空白、日本語は文末記号がなければ「。」で区切る）"""
+    if not left:
+        return right
+    if left[-1].isascii() or right[0].isascii():
+        return f"{left} {right}"
+    if left[-1] in _SENTENCE_END:
+        return left + right
+    return f"{left}。{right}"
+
+
+def _is_partial_of(last: str, text: str) -> bool:
+    """text が last の途中経過を伸ばしたもの（last で始まり、より長い）か"""
+    if len(text) > len(last) and text.startswith(last):
+        return True
+    last, text = _normalize(last), _normalize(text)
+    return len(text) > len(last) and text.startswith(last)
+
+
+def _dedupe_by_timestamp(transcript: list[dict]) -> list[dict]:
+    """同じ (role, timestamp) の発話は最も長いもの（最後の文字起こし結果）だけ残し、時刻順に並べる"""
+    latest: dict[tuple, dict] = {}
+    order: list[tuple] = []
+    for index, entry in enumerate(transcript):
+        text = (entry.get("text") or "").strip()
+        timestamp = entry.get("timestamp")
+        key = (entry.get("role"), timestamp) if timestamp is not None else (entry.get("role"), None, index)
+        current = latest.get(key)
+        if current is None:
+            order.append(key)
+            latest[key] = {**entry, "text": text, "_index": index}
+        elif len(text) >= len(current["text"]):
+            latest[key] = {**entry, "text": text, "_index": current["_index"]}
+    entries = [latest[key] for key in order]
+    entries.sort(key=lambda e: (e.get("timestamp") is None, e.get("timestamp") or 0, e["_index"]))
+    return entries
+
+
+def compact(transcript: list[dict] | None) -> list[dict]:
+    """transcript を圧縮したターンのリスト（{role, text, timestamp}）を返す"""
+    if not transcript:
+        return []
+
+    turns: list[dict] = []
+    fragments: list[str] = []  # 最後のターンを構成する発話
+    for entry in _dedupe_by_timestamp(transcript):
+        text = entry["text"]
+        if is_filler(text):
+            continue
+        role = entry.get("role")
+        if turns and turns[-1]["role"] == role:
+            if _is_partial_of(fragments[-1], text):
+                # 途中経過の文字起こしが伸びたもの
+                fragments[-1] = text
+            else:
+                fragments.append(text)
+            turns[-1]["text"] = ""
+            for fragment in fragments:
+                turns[-1]["text"] = _join(turns[-1]["text"], fragment)
+            continue
+        fragments = [text]
+        turns.append({"role": role, "text": text, "timestamp": entry.get("timestamp")})
+    return turns
+
+
+def format_transcript(transcript: list[dict] | None) -> str:
+    """transcript を読みやすいテキスト形式に変換する"""
+    if not transcript:
+        return ""
+
+    lines = []
+    for entry in transcript:
+        role_label = "ユーザー" if entry.get("role") == "user" else "AI"
+        text = entry.get("text", "").strip()
+        if text:
+            lines.append(f"{role_label}: {text}")
+
+    return "\n".join(lines)
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep: str = "head") -> str:
+    """概算トークン数が max_tokens に収まるよう、先頭（head）または末尾（tail）を残して切る"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        part = text[:mid] if keep == "head" else text[-mid:]
+        if estimate_tokens(part) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return (text[:low] + "…") if keep == "head" else ("…" + text[len(text) - low :])
+
+
+def split_for_budget(turns: list[dict], budget: int = TRANSCRIPT_TOKEN_BUDGET) -> tuple[list[dict], list[dict]]:
+    """(要約・省略するターン, そのまま残すターン) に分ける
+
+    全体が予算に収まればすべて残す。収まらなければ要約の分を空けて、新しいターンから残す。
+    """
+    line_tokens = [estimate_tokens(format_transcript([turn])) + 1 for turn in turns]
+    if sum(line_tokens) <= budget:
+        return [], turns
+
+    recent_budget = max(budget - TRANSCRIPT_SUMMARY_MAX_TOKENS, budget // 2)
+    used = 0
+    start = len(turns)
+    while start > 0 and used + line_tokens[start - 1] <= recent_budget:
+        start -= 1
+        used += line_tokens[start]
+    if start == len(turns):
+        # 最新のターンだけで予算を超える場合は、その末尾を残す
+        newest = turns[-1]
+        truncated = {**newest, "text": truncate_to_tokens(newest["text"], recent_budget - 8, keep="tail")}
+        return turns[:-1], [truncated]
+    return turns[:start], turns[start:]
+
+
+def summary_source(older: list[dict]) -> str:
+    """要約に渡すテキスト（TRANSCRIPT_SUMMARY_INPUT_TOKENS まで）"""
+    return truncate_to_tokens(format_transcript(older), TRANSCRIPT_SUMMARY_INPUT_TOKENS)
+
+
+def render(recent: list[dict], older: list[dict] | None = None, summary: str | None = None) -> str:
+    """プロンプトに埋め込む会話テキスト"""
+    text = format_transcript(recent)
+    if not older:
+        return text
+    if summary:
+        summary = truncate_to_tokens(summary.strip(), TRANSCRIPT_SUMMARY_MAX_TOKENS)
+        return f"（これより前の会話の要約）\n{summary}\n\n（最近の会話）\n{text}"
+    return f"（これより前の会話 {len(older)} 件は省略）\n{text}"
@@ -0,0 +1,47 @@
+import base64
+import datetime
+import json
+
+import pytest
+
+from src.diary_reads import InvalidCursorError, decode_cursor, encode_cursor, etag_matches
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def test_cursor_round_trip():
+    created_at = datetime.datetime(2026, 1, 2, 3, 4, 5, 678901, tzinfo=datetime.timezone.utc)
+    cursor = encode_cursor(created_at, "abc123")
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (created_at, "abc123")
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "",
+        "not base64!",
+        _b64(b"not json"),
+        _b64(b"[]"),
+        _b64(json.dumps({"createdAt": "2026-01-02T03:04:05+00:00"}).encode()),
+        _b64(json.dumps({"createdAt": "yesterday", "id": "abc"}).encode()),
+        _b64(json.dumps({"createdAt": "2026-01-02T03:04:05+00:00", "id": 1}).encode()),
+        _b64(json.dumps({"createdAt": "2026-01-02T03:04:05+00:00", "id": ""}).encode()),
+        _b64(json.dumps({"createdAt": "2026-01-02T03:04:05+00:00", "id": "users/x"}).encode()),
+    ],
+)
+def test_invalid_cursor(cursor):
+    with pytest.raises(InvalidCursorError):
+        decode_cursor(cursor)
+
+
+def test_etag_matches():
+    etag = 'W/"abc"'
+    assert etag_matches('W/"abc"', etag)
+    assert etag_matches('"abc"', etag)
+    assert etag_matches('"xyz", W/"abc"', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"xyz"', etag)
+    assert not etag_matches(None, etag)
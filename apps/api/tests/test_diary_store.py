@@ -0,0 +1,45 @@
+import zlib
+
+import pytest
+
+from src import diary_store
+from src.diary_store import TRANSCRIPT_ENCODING, TranscriptTooLargeError, decode_transcript, encode_transcript
+
+TRANSCRIPT = [
+    {"role": "user", "text": "きょうは公園に行った", "timestamp": 1700000000000},
+    {"role": "model", "text": "何をして遊んだの？", "timestamp": 1700000001000},
+]
+
+
+def test_transcript_round_trip():
+    blob = encode_transcript(TRANSCRIPT)
+    assert isinstance(blob, bytes)
+    assert decode_transcript({"transcriptBlob": blob}) == TRANSCRIPT
+
+
+def test_transcript_is_compressed():
+    transcript = TRANSCRIPT * 500
+    blob = encode_transcript(transcript)
+    assert len(blob) < len(zlib.decompress(blob)) / 10
+    assert decode_transcript({"transcriptBlob": blob}) == transcript
+
+
+def test_transcript_too_large(monkeypatch):
+    monkeypatch.setattr(diary_store, "TRANSCRIPT_BLOB_MAX_BYTES", 16)
+    with pytest.raises(TranscriptTooLargeError):
+        encode_transcript(TRANSCRIPT)
+
+
+def test_decode_legacy_array_document():
+    assert decode_transcript({"transcript": TRANSCRIPT}) == TRANSCRIPT
+    assert decode_transcript({}) == []
+
+
+def test_pending_document_stores_blob_instead_of_array():
+    doc = diary_store.pending_document({"date": "2026-01-02", "transcript": TRANSCRIPT}, "alice")
+    assert "transcript" not in doc
+    assert doc["transcriptEncoding"] == TRANSCRIPT_ENCODING
+    assert doc["transcriptEntries"] == 2
+    assert doc["userId"] == "alice"
+    assert doc["status"] == "pending"
+    assert decode_transcript(doc) == TRANSCRIPT
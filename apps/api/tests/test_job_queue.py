@@ -0,0 +1,313 @@
+import asyncio
+
+import pytest
+
+from src import job_queue
+from src.job_queue import MemoryJobQueue, QueueFullError, SQLiteJobQueue, WorkerPool
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_queue(request, tmp_path):
+    """バックエンドごとのキューを作る関数（asyncio.Event をテストのイベントループで作るため遅延させる）"""
+
+    def make(max_depth: int = 100):
+        if request.param == "sqlite":
+            return SQLiteJobQueue("test", path=str(tmp_path / "jobs.sqlite3"), max_depth=max_depth)
+        return MemoryJobQueue("test", max_depth=max_depth)
+
+    return make
+
+
+def _rows(queue: SQLiteJobQueue) -> list[tuple]:
+    return queue._conn.execute("SELECT status, error FROM jobs").fetchall()
+
+
+def test_claim_ack(make_queue):
+    async def scenario():
+        queue = make_queue()
+        job = await queue.enqueue("alice", {"diary_id": "d1"})
+        assert await queue.depth() == 1
+        assert await queue.active_values("diary_id") == {"d1"}
+
+        claimed = await queue.claim(60)
+        assert claimed.id == job.id
+        assert claimed.payload == {"diary_id": "d1"}
+        assert claimed.attempts == 1
+        assert await queue.depth() == 0
+        assert await queue.in_flight() == 1
+        assert await queue.claim(60) is None
+
+        await queue.ack(claimed)
+        assert await queue.in_flight() == 0
+        assert await queue.active_values("diary_id") == set()
+
+    asyncio.run(scenario())
+
+
+def test_lease_expiry_redelivers(make_queue):
+    async def scenario():
+        queue = make_queue()
+        job = await queue.enqueue("alice", {"n": 1})
+        await queue.claim(0.05)
+        await asyncio.sleep(0.1)
+
+        redelivered = await queue.claim(60)
+        assert redelivered.id == job.id
+        assert redelivered.attempts == 2
+
+    asyncio.run(scenario())
+
+
+def test_heartbeat_extends_lease(make_queue):
+    async def scenario():
+        queue = make_queue()
+        await queue.enqueue("alice", {"n": 1})
+        job = await queue.claim(0.05)
+        await queue.heartbeat(job, 60)
+        await asyncio.sleep(0.1)
+        assert await queue.claim(60) is None
+        assert await queue.in_flight() == 1
+
+    asyncio.run(scenario())
+
+
+def test_round_robin_between_users(make_queue):
+    async def scenario():
+        queue = make_queue()
+        await queue.enqueue_many("alice", [{"n": 1}, {"n": 2}, {"n": 3}])
+        await queue.enqueue("bob", {"n": 4})
+        await queue.enqueue("carol", {"n": 5})
+
+        order = []
+        while job := await queue.claim(60):
+            order.append((job.user_id, job.payload["n"]))
+        assert order == [("alice", 1), ("bob", 4), ("carol", 5), ("alice", 2), ("alice", 3)]
+
+    asyncio.run(scenario())
+
+
+def test_nack_retry_and_give_up(make_queue):
+    async def scenario():
+        queue = make_queue()
+        await queue.enqueue("alice", {"n": 1})
+        job = await queue.claim(60)
+        await queue.nack(job, "boom", retry=True)
+        assert await queue.depth() == 1
+        assert await queue.in_flight() == 0
+
+        job = await queue.claim(60)
+        assert job.attempts == 2
+        await queue.nack(job, "boom", retry=False)
+        assert await queue.depth() == 0
+        assert await queue.in_flight() == 0
+        assert await queue.claim(60) is None
+
+    asyncio.run(scenario())
+
+
+def test_queue_full(make_queue):
+    async def scenario():
+        queue = make_queue(max_depth=2)
+        await queue.enqueue("alice", {"n": 1})
+        await queue.enqueue("bob", {"n": 2})
+        with pytest.raises(QueueFullError):
+            await queue.enqueue("carol", {"n": 3})
+        assert await queue.depth() == 2
+
+        # 取り出せば空きができる
+        await queue.claim(60)
+        with pytest.raises(QueueFullError):
+            await queue.enqueue_many("carol", [{"n": 3}, {"n": 4}])
+        assert await queue.depth() == 1
+        await queue.enqueue("carol", {"n": 3})
+        assert await queue.depth() == 2
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_ack_deletes_row(tmp_path):
+    async def scenario():
+        queue = SQLiteJobQueue("test", path=str(tmp_path / "jobs.sqlite3"))
+        await queue.enqueue("alice", {"n": 1})
+        await queue.ack(await queue.claim(60))
+        assert _rows(queue) == []
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_prunes_failed_jobs(tmp_path, monkeypatch):
+    async def scenario():
+        queue = SQLiteJobQueue("test", path=str(tmp_path / "jobs.sqlite3"))
+        await queue.enqueue("alice", {"n": 1})
+        await queue.nack(await queue.claim(60), "boom", retry=False)
+        await queue.enqueue("bob", {"n": 2})
+        assert sorted(_rows(queue)) == [("failed", "boom"), ("queued", None)]
+
+        # 保持期間内なら残す
+        assert queue.delete_expired() == 0
+
+        monkeypatch.setattr(job_queue, "JOB_QUEUE_RETENTION_HOURS", 0)
+        assert queue.delete_expired() == 1
+        assert _rows(queue) == [("queued", None)]
+        assert queue._conn.execute("SELECT COUNT(*) FROM job_user_turns").fetchone()[0] == 0
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_redelivers_after_restart(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+
+    async def before_crash():
+        queue = SQLiteJobQueue("test", path=path)
+        job = await queue.enqueue("alice", {"n": 1})
+        await queue.claim(0.05)
+        return job
+
+    async def after_restart():
+        queue = SQLiteJobQueue("test", path=path)
+        await asyncio.sleep(0.1)
+        return await queue.claim(60)
+
+    job = asyncio.run(before_crash())
+    redelivered = asyncio.run(after_restart())
+    assert redelivered.id == job.id
+    assert redelivered.attempts == 2
+
+
+async def _wait_for(condition, timeout: float = 5.0) -> None:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+async def _wait_idle(queue, timeout: float = 5.0) -> None:
+    """待機中・実行中のジョブがなくなるまで待つ"""
+    deadline = asyncio.get_running_loop().time() + timeout
+    while await queue.depth() or await queue.in_flight():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_worker_pool_runs_jobs(make_queue):
+    async def scenario():
+        queue = make_queue()
+        done = []
+
+        async def handler(job):
+            done.append(job.payload["n"])
+
+        pool = WorkerPool(queue, handler, concurrency=2, poll_interval=0.01)
+        pool.start()
+        await queue.enqueue_many("alice", [{"n": n} for n in range(5)])
+        await _wait_for(lambda: len(done) == 5)
+        await _wait_idle(queue)
+        await pool.stop()
+        assert sorted(done) == list(range(5))
+
+    asyncio.run(scenario())
+
+
+def test_worker_pool_retries_then_succeeds(make_queue):
+    async def scenario():
+        queue = make_queue()
+        attempts = []
+
+        async def handler(job):
+            attempts.append(job.attempts)
+            if job.attempts < 2:
+                raise RuntimeError("transient")
+
+        pool = WorkerPool(queue, handler, concurrency=1, max_attempts=3, poll_interval=0.01)
+        pool.start()
+        await queue.enqueue("alice", {"n": 1})
+        await _wait_for(lambda: len(attempts) == 2)
+        await _wait_idle(queue)
+        await pool.stop()
+        assert attempts == [1, 2]
+
+    asyncio.run(scenario())
+
+
+def test_worker_pool_dead_letters_after_max_attempts(make_queue):
+    async def scenario():
+        queue = make_queue()
+        attempts = []
+        dead = []
+
+        async def handler(job):
+            attempts.append(job.attempts)
+            raise RuntimeError("boom")
+
+        async def on_dead_letter(job):
+            dead.append(job)
+
+        pool = WorkerPool(
+            queue, handler, concurrency=1, max_attempts=2, on_dead_letter=on_dead_letter, poll_interval=0.01
+        )
+        pool.start()
+        await queue.enqueue("alice", {"n": 1})
+        await _wait_for(lambda: dead)
+        await _wait_idle(queue)
+        await pool.stop()
+        assert attempts == [1, 2]
+        assert dead[0].attempts == 2
+        if isinstance(queue, SQLiteJobQueue):
+            assert _rows(queue) == [("failed", "boom")]
+
+    asyncio.run(scenario())
+
+
+def test_worker_pool_dead_letters_orphaned_job_without_running(make_queue):
+    async def scenario():
+        queue = make_queue()
+        await queue.enqueue("alice", {"n": 1})
+        # 実行中にインスタンスが落ちてリースが切れた状態を2回再現する
+        for _ in range(2):
+            await queue.claim(0.01)
+            await asyncio.sleep(0.05)
+
+        ran = []
+        dead = []
+
+        async def handler(job):
+            ran.append(job)
+
+        async def on_dead_letter(job):
+            dead.append(job)
+
+        pool = WorkerPool(
+            queue, handler, concurrency=1, max_attempts=2, on_dead_letter=on_dead_letter, poll_interval=0.01
+        )
+        pool.start()
+        await _wait_for(lambda: dead)
+        await _wait_idle(queue)
+        await pool.stop()
+        assert ran == []
+        assert dead[0].attempts == 3
+
+    asyncio.run(scenario())
+
+
+def test_worker_pool_heartbeat_keeps_long_job_leased(make_queue):
+    async def scenario():
+        queue = make_queue()
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def handler(job):
+            started.set()
+            await release.wait()
+
+        pool = WorkerPool(queue, handler, concurrency=1, lease_seconds=0.15, poll_interval=0.01)
+        pool.start()
+        await queue.enqueue("alice", {"n": 1})
+        await started.wait()
+        # リースの数倍の時間が経っても、ハートビートで延長されて再配信されない
+        await asyncio.sleep(0.5)
+        assert await queue.claim(60) is None
+        release.set()
+        await _wait_idle(queue)
+        await pool.stop()
+
+    asyncio.run(scenario())
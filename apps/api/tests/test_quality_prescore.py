@@ -0,0 +1,75 @@
+import pytest
+
+from src import quality_prescore
+from src.quality_prescore import DEFAULT_WEIGHTS, Prescore, is_decisive, parse_weights, prescore
+
+GOOD = (
+    "今日は近所の公園でブランコにのった。風がびゅーびゅーふいて、ほっぺたがひんやりした。"
+    "たくさんこいだら空までとんでいけそうで、すごくたのしかった。かえりにじどうはんばいきでジュースをかった。"
+    "つめたくておいしかった。おとなになってもブランコはたのしい（ひざがいたい）。"
+)
+PLAIN = "今日は動物園に行った。ゾウが大きかった。キリンも大きかった。ライオンはねていた。おべんとうを食べた。帰った。"
+POLITE = (
+    "今日は公園に行きました。とても楽しかったです。ブランコに乗りました。すべり台もすべりました。"
+    "また行きたいと思います。お母さんと一緒に行きました。お弁当も食べました。おいしかったです。"
+)
+ENGLISH = (
+    "I went to the park today and played on the swings with my friends. "
+    "It was so much fun and I want to go again tomorrow. The wind was cold."
+)
+
+
+def test_good_diary_is_accepted():
+    result = prescore(GOOD)
+    assert result.decision == "accept"
+    assert result.score == pytest.approx(1.0)
+    assert set(result.features) == set(DEFAULT_WEIGHTS)
+
+
+def test_borderline_diary_is_escalated():
+    result = prescore(PLAIN)
+    assert result.decision == "escalate"
+    assert result.features["emotion"] == 0.0
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        None,
+        "   ",
+        "今日はたのしい一日だった。またあしたあそびたい。",  # 短すぎる
+        "今日は" + "あそんだ。" * 80,  # 長すぎる
+        POLITE,  # ですます調
+        ENGLISH,  # 日本語でない
+    ],
+)
+def test_obvious_violations_are_rejected(text):
+    assert prescore(text).decision == "reject"
+
+
+def test_meta_text_is_penalized():
+    assert prescore("## 絵日記テキスト\n" + GOOD).features["clean"] == 0.0
+
+
+def test_thresholds():
+    assert prescore(PLAIN, accept=0.5).decision == "accept"
+    assert prescore(PLAIN, reject=0.9).decision == "reject"
+
+
+def test_parse_weights():
+    weights = parse_weights("length=0.5, opening=0")
+    assert weights == {**DEFAULT_WEIGHTS, "length": 0.5, "opening": 0.0}
+    assert parse_weights(None) == DEFAULT_WEIGHTS
+    with pytest.raises(ValueError):
+        parse_weights("unknown=1")
+
+
+def test_is_decisive_only_when_on(monkeypatch):
+    accepted = Prescore(score=1.0, decision="accept")
+    escalated = Prescore(score=0.5, decision="escalate")
+    monkeypatch.setattr(quality_prescore, "QUALITY_PRESCORE", "shadow")
+    assert not is_decisive(accepted)
+    monkeypatch.setattr(quality_prescore, "QUALITY_PRESCORE", "on")
+    assert is_decisive(accepted)
+    assert not is_decisive(escalated)
+    assert not is_decisive(None)
@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+from google.api_core import exceptions as gexc
+
+from src import rate_limiter
+from src.rate_limiter import AdaptiveRateLimiter, DeadlineExceededError, deadline_scope, is_retryable, is_throttled
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "VERTEX_RETRY_BASE_SECONDS", 0)
+    monkeypatch.setattr(rate_limiter, "VERTEX_MAX_RETRIES", 2)
+
+
+def test_additive_increase():
+    limiter = AdaptiveRateLimiter("test", rate=4, max_rate=4.5)
+    limiter.on_success()
+    assert limiter.rate == pytest.approx(4.25)
+    for _ in range(10):
+        limiter.on_success()
+    assert limiter.rate == 4.5
+
+
+def test_multiplicative_decrease_with_cooldown():
+    limiter = AdaptiveRateLimiter("test", rate=8, min_rate=3)
+    limiter.on_throttle()
+    assert limiter.rate == 4
+    # 続けて届いたスロットリングでは下げない
+    limiter.on_throttle()
+    assert limiter.rate == 4
+    limiter._last_decrease -= 10
+    limiter.on_throttle()
+    assert limiter.rate == 3
+
+
+def test_error_classification():
+    assert is_retryable(gexc.ResourceExhausted("quota"))
+    assert is_retryable(gexc.ServiceUnavailable("down"))
+    assert not is_retryable(gexc.InvalidArgument("bad"))
+    assert is_throttled(gexc.TooManyRequests("slow down"))
+    assert not is_throttled(gexc.ServiceUnavailable("down"))
+
+
+class _CodedError(Exception):
+    def __init__(self, code: int):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+def test_error_classification_by_code():
+    assert is_retryable(_CodedError(503))
+    assert is_throttled(_CodedError(429))
+    assert not is_retryable(_CodedError(400))
+
+
+def _flaky(errors: list[Exception]):
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    return fn, calls
+
+
+def test_call_retries_throttling_and_halves_rate():
+    limiter = AdaptiveRateLimiter("test", rate=10)
+    fn, calls = _flaky([gexc.ResourceExhausted("quota")])
+    assert asyncio.run(limiter.call(fn)) == "ok"
+    assert len(calls) == 2
+    assert limiter.rate == pytest.approx(5 + 1 / 5)
+
+
+def test_call_does_not_retry_other_errors():
+    limiter = AdaptiveRateLimiter("test", rate=10)
+    fn, calls = _flaky([gexc.InvalidArgument("bad")])
+    with pytest.raises(gexc.InvalidArgument):
+        asyncio.run(limiter.call(fn))
+    assert len(calls) == 1
+    assert limiter.rate == 10
+
+
+def test_call_gives_up_after_max_retries():
+    limiter = AdaptiveRateLimiter("test", rate=100)
+    fn, calls = _flaky([gexc.ServiceUnavailable("down") for _ in range(5)])
+    with pytest.raises(gexc.ServiceUnavailable):
+        asyncio.run(limiter.call(fn))
+    assert len(calls) == 3
+
+
+def test_call_sync_retries():
+    limiter = AdaptiveRateLimiter("test", rate=10)
+    errors = [gexc.ServiceUnavailable("down")]
+
+    def fn():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    assert limiter.call_sync(fn) == "ok"
+
+
+def test_deadline_exceeded_while_waiting_for_quota():
+    async def scenario():
+        limiter = AdaptiveRateLimiter("test", rate=0.5, min_rate=0.1)
+        await limiter.acquire()
+        with deadline_scope(0.1):
+            with pytest.raises(DeadlineExceededError):
+                await limiter.acquire()
+
+    asyncio.run(scenario())
+
+
+def test_high_priority_goes_first():
+    async def scenario():
+        limiter = AdaptiveRateLimiter("test", rate=20)
+        await limiter.acquire()
+        order = []
+
+        async def acquire(priority: int):
+            await limiter.acquire(priority)
+            order.append(priority)
+
+        # 低優先度が先に待ち始めても、高優先度の呼び出しが先に通る
+        low = asyncio.create_task(acquire(rate_limiter.PRIORITY_IMAGE))
+        await asyncio.sleep(0)
+        high = asyncio.create_task(acquire(rate_limiter.PRIORITY_TEXT))
+        await asyncio.gather(low, high)
+        return order
+
+    assert asyncio.run(scenario()) == [rate_limiter.PRIORITY_TEXT, rate_limiter.PRIORITY_IMAGE]
@@ -0,0 +1,63 @@
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from src.request_limits import BodySizeLimitMiddleware
+
+
+def _client() -> TestClient:
+    app = FastAPI()
+    app.add_middleware(BodySizeLimitMiddleware, max_bytes=10, batch_max_bytes=100)
+
+    @app.post("/diaries")
+    async def create(request: Request):
+        return {"size": len(await request.body())}
+
+    @app.post("/diaries:batch")
+    async def create_batch(request: Request):
+        return {"size": len(await request.body())}
+
+    return TestClient(app)
+
+
+def _chunks(count: int, size: int = 4):
+    for _ in range(count):
+        yield b"x" * size
+
+
+def test_within_limit():
+    response = _client().post("/diaries", content=b"x" * 10)
+    assert response.status_code == 200
+    assert response.json() == {"size": 10}
+
+
+def test_content_length_over_limit():
+    response = _client().post("/diaries", content=b"x" * 11)
+    assert response.status_code == 413
+    assert response.json() == {"detail": "Request body too large (max 10 bytes)"}
+
+
+def test_streamed_body_over_limit():
+    # Content-Length がなくても、受信したバイト数が上限を超えた時点で断る
+    response = _client().post("/diaries", content=_chunks(3))
+    assert response.status_code == 413
+
+
+def test_streamed_body_within_limit():
+    response = _client().post("/diaries", content=_chunks(2))
+    assert response.status_code == 200
+    assert response.json() == {"size": 8}
+
+
+def test_batch_path_has_its_own_limit():
+    client = _client()
+    assert client.post("/diaries:batch", content=b"x" * 100).status_code == 200
+    assert client.post("/diaries:batch", content=b"x" * 101).status_code == 413
+
+
+def test_app_413_carries_cors_headers():
+    from src.main import app
+
+    origin = "http://localhost:5173"
+    response = TestClient(app).post("/diaries", content=b"x" * (2 * 1024 * 1024), headers={"Origin": origin})
+    assert response.status_code == 413
+    assert response.headers["access-control-allow-origin"] == origin
@@ -0,0 +1,129 @@
+from src import transcript
+from src.transcript import compact, estimate_tokens, format_transcript, render, split_for_budget, summary_source
+
+
+def _entry(text: str, timestamp: int | None, role: str = "user") -> dict:
+    return {"role": role, "text": text, "timestamp": timestamp}
+
+
+def _texts(turns: list[dict]) -> list[str]:
+    return [turn["text"] for turn in turns]
+
+
+def test_empty():
+    assert compact(None) == []
+    assert compact([]) == []
+
+
+def test_partial_growth_is_one_utterance():
+    turns = compact([
+        _entry("きょうは", 1),
+        _entry("きょうは公園に", 2),
+        _entry("きょうは公園に行った", 3),
+    ])
+    assert _texts(turns) == ["きょうは公園に行った"]
+    assert turns[0]["timestamp"] == 1
+
+
+def test_partial_growth_ignores_punctuation():
+    assert _texts(compact([_entry("I went", 1), _entry("I went, to the park.", 2)])) == ["I went, to the park."]
+
+
+def test_same_timestamp_keeps_longest():
+    turns = compact([_entry("公園に", 1), _entry("公園に行った", 1), _entry("公園", 1)])
+    assert _texts(turns) == ["公園に行った"]
+
+
+def test_distinct_utterances_are_joined_not_dropped():
+    # 前の発話の末尾と同じ発話・同じ返事の繰り返しも、別の時刻なら残す
+    turns = compact([_entry("行った", 1), _entry("た", 2), _entry("うん", 3), _entry("うん", 4)])
+    assert _texts(turns) == ["行った。た。うん。うん"]
+
+
+def test_join_delimiters():
+    assert _texts(compact([_entry("楽しかった！", 1), _entry("また行きたい", 2)])) == ["楽しかった！また行きたい"]
+    assert _texts(compact([_entry("I played", 1), _entry("soccer", 2)])) == ["I played soccer"]
+
+
+def test_filler_is_dropped_but_replies_are_kept():
+    turns = compact([
+        _entry("えーと", 1),
+        _entry("うーん…", 2),
+        _entry("  ", 3),
+        _entry("uhh", 4),
+        _entry("はい", 5),
+        _entry("何をしたの？", 6, role="model"),
+        _entry("あのー", 7),
+        _entry("サッカー", 8),
+    ])
+    assert _texts(turns) == ["はい", "何をしたの？", "サッカー"]
+
+
+def test_roles_alternate_and_sort_by_timestamp():
+    turns = compact([
+        _entry("サッカーした", 3),
+        _entry("今日は何した？", 2, role="model"),
+        _entry("こんにちは", 1),
+    ])
+    assert [(turn["role"], turn["text"]) for turn in turns] == [
+        ("user", "こんにちは"),
+        ("model", "今日は何した？"),
+        ("user", "サッカーした"),
+    ]
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("こんにちは") == 5
+    assert estimate_tokens("abcd") == 1
+    assert estimate_tokens("abcde") == 2
+
+
+def _long_conversation(count: int) -> list[dict]:
+    return [_entry(f"これは{i}番目の発話です", i, role="user" if i % 2 else "model") for i in range(count)]
+
+
+def test_split_within_budget_keeps_everything():
+    turns = compact(_long_conversation(4))
+    assert split_for_budget(turns, budget=1000) == ([], turns)
+
+
+def test_split_keeps_newest_turns():
+    turns = compact(_long_conversation(50))
+    older, recent = split_for_budget(turns, budget=200)
+    assert older + recent == turns
+    assert older and recent
+    assert recent[-1] == turns[-1]
+    assert estimate_tokens(format_transcript(recent)) <= 200
+
+
+def test_split_truncates_single_huge_turn():
+    turns = compact([_entry("短い", 1, role="model"), _entry("あ" * 5000, 2)])
+    older, recent = split_for_budget(turns, budget=100)
+    assert older == turns[:1]
+    assert len(recent) == 1
+    assert recent[0]["text"].startswith("…")
+    assert estimate_tokens(recent[0]["text"]) < 100
+
+
+def test_render_with_summary(monkeypatch):
+    monkeypatch.setattr(transcript, "TRANSCRIPT_SUMMARY_MAX_TOKENS", 5)
+    older = compact(_long_conversation(2))
+    recent = [_entry("またね", 10)]
+    text = render(recent, older=older, summary="  公園でサッカーをした話をしていました  ")
+    assert text.startswith("（これより前の会話の要約）\n公園でサッ…\n\n（最近の会話）\n")
+    assert text.endswith("ユーザー: またね")
+
+
+def test_render_without_summary_notes_omitted_turns():
+    older = compact(_long_conversation(3))
+    assert render([_entry("またね", 10)], older=older) == "（これより前の会話 3 件は省略）\nユーザー: またね"
+    assert render([_entry("またね", 10)]) == "ユーザー: またね"
+
+
+def test_summary_source_is_capped(monkeypatch):
+    monkeypatch.setattr(transcript, "TRANSCRIPT_SUMMARY_INPUT_TOKENS", 20)
+    older = compact(_long_conversation(10))
+    source = summary_source(older)
+    assert source.startswith("AI: これは0番目の発話です")
+    assert source.endswith("…")
+    assert estimate_tokens(source) <= 21
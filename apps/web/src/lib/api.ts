@@ -63,14 +63,24 @@ export async function createDiary(log: {
 		? localStorage.getItem('discord_webhook_url') || undefined
 		: undefined;
 
+	// localStorage の image_reuse が 'false' なら似た場面の画像を再利用しない（自分の画像も再利用させない）
+	const imageReuse = typeof window !== 'undefined'
+		? localStorage.getItem('image_reuse') !== 'false'
+		: true;
+
+	// 同じ会話の二重送信・リトライで日記が重複生成されないよう冪等キーを付ける
+	const idempotencyKey = `${log.date}-${log.transcript[0]?.timestamp ?? 0}-${log.transcript.length}`;
+
 	const response = await fetchWithAuth('/diaries', {
 		method: 'POST',
 		headers: {
-			'Content-Type': 'application/json'
+			'Content-Type': 'application/json',
+			'Idempotency-Key': idempotencyKey
 		},
 		body: JSON.stringify({
 			...log,
-			discordWebhookUrl
+			discordWebhookUrl,
+			imageReuse
 		})
 	});
 
@@ -82,6 +92,109 @@ export async function createDiary(log: {
 	return response.json();
 }
 
+export type DiarySummary = {
+	id: string;
+	date: string | null;
+	status: 'pending' | 'processing' | 'completed' | 'failed' | null;
+	keywords: string[] | null;
+	diaryText: string | null;
+	imageUrl: string | null;
+	imageRenditions: { avif?: string; webp?: string; thumbnail?: string } | null;
+	error: string | null;
+	discordNotification: {
+		status: 'queued' | 'sent' | 'failed';
+		attempts: number;
+		error: string | null;
+		updatedAt: string;
+	} | null;
+	createdAt: string | null;
+	updatedAt: string | null;
+};
+
+/**
+ * 自分の日記を新しい順に取得する（transcript は含まれない）
+ * 続きは戻り値の nextCursor を cursor に渡す（null なら最後のページ）
+ * API は ETag を返すので、ブラウザのキャッシュは If-None-Match で再検証される
+ */
+export async function listDiaries(
+	options: { limit?: number; cursor?: string } = {}
+): Promise<{ diaries: DiarySummary[]; nextCursor: string | null }> {
+	const params = new URLSearchParams();
+	if (options.limit) params.set('limit', String(options.limit));
+	if (options.cursor) params.set('cursor', options.cursor);
+	const query = params.toString();
+
+	const response = await fetchWithAuth(`/diaries${query ? `?${query}` : ''}`);
+	if (!response.ok) {
+		const error = await response.json();
+		throw new Error(error.detail || 'Failed to list diaries');
+	}
+
+	return response.json();
+}
+
+/**
+ * 日記を1件取得する（transcript は含まれない）
+ */
+export async function getDiary(id: string): Promise<DiarySummary> {
+	const response = await fetchWithAuth(`/diaries/${id}`);
+	if (!response.ok) {
+		const error = await response.json();
+		throw new Error(error.detail || 'Failed to get diary');
+	}
+
+	return response.json();
+}
+
+export type DiaryEvent = {
+	event: 'status' | 'node' | 'token' | 'snapshot';
+	data: Record<string, unknown>;
+};
+
+/**
+ * 日記生成の進捗を SSE で購読する
+ * EventSource はヘッダーを付けられないため fetch のストリームを読む
+ */
+export async function streamDiaryEvents(
+	id: string,
+	onEvent: (event: DiaryEvent) => void,
+	signal?: AbortSignal
+): Promise<void> {
+	const response = await fetchWithAuth(`/diaries/${id}/events`, {
+		headers: { Accept: 'text/event-stream' },
+		signal
+	});
+
+	if (!response.ok || !response.body) {
+		throw new Error('Failed to subscribe diary events');
+	}
+
+	const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+	let buffer = '';
+	while (true) {
+		const { value, done } = await reader.read();
+		if (done) break;
+		buffer += value;
+
+		// イベントは空行で区切られる
+		let index;
+		while ((index = buffer.indexOf('\n\n')) >= 0) {
+			const block = buffer.slice(0, index);
+			buffer = buffer.slice(index + 2);
+
+			let event = 'message';
+			let data = '';
+			for (const line of block.split('\n')) {
+				if (line.startsWith('event: ')) event = line.slice(7);
+				else if (line.startsWith('data: ')) data += line.slice(6);
+			}
+			if (data) {
+				onEvent({ event, data: JSON.parse(data) } as DiaryEvent);
+			}
+		}
+	}
+}
+
 /**
  * Ephemeral Token を取得（Gemini Live API 用）
  */